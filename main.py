@@ -1,16 +1,32 @@
 # Main ETL Pipeline 
 # This script orchestrates the entire ETL process: extraction, transformation, and loading data
 
+import argparse
+from contextlib import ExitStack
 from datetime import datetime
 import logging
+import tempfile
 import pandas as pd
+import pyarrow.parquet as pq
 from pathlib import Path
+from functools import partial
+import os
 import gc  # For garbage collection
 
 # Import our modules 
-from src.data.data_extraction import download_file, extract_files, URLS
-from src.data.data_transformation import handle_na_data, convert_column, remove_duplicates
-from src.data.data_load import load_data
+from src.data.data_extraction import download_file, extract_files, extract_chunked, URLS, raw_dir
+from src.data.transform_engine import apply_spec
+from src.data.transform_specs import TRANSFORM_SPECS
+from src.data.data_load import load_data, ChunkWriter
+from src.data.order_items import explode_items
+from src.data.geo import merchant_locations
+from src.data.star_schema import build_star
+from src.data.customer_lookup import build_customer_index, INDEX_NAME
+from src.data.out_of_core import parse_size, chunk_bytes, iter_parquet_chunks, transform_chunks, dedup_chunks
+from src.data.schemas import to_pandas, parquet_to_pandas
+from src.data.scheduler import Stage, run_stages, MAX_WORKERS, MAX_LARGE_STAGES
+from src.data import manifest, instrumentation
+from src.data.instrumentation import stage, path_size
 
 
 #==============================
@@ -23,11 +39,208 @@ logging.basicConfig(
 )
 logger = logging.getLogger('main')
 
+LARGE_FILE_BYTES = 100 * 1024 * 1024  # Compressed size from which a dataset is treated as large by the scheduler
+TRANSFORM_ENGINE = 'arrow'            # 'arrow' (single pass) or 'pandas' (functions of data_transformation.py)
+
+# Source code that produces each output, a change on them makes the outputs stale on the manifest
+code_dir = Path(__file__).resolve().parent
+EXTRACT_CODE = [
+    code_dir / 'src/data/data_extraction.py',
+    code_dir / 'src/data/data_load.py',  # data_load has the write_options
+    code_dir / 'src/data/schemas.py'     # The dtype of each extracted column
+]
+PROCESS_CODE = [
+    code_dir / 'main.py',
+    code_dir / 'src/data/schemas.py',
+    code_dir / 'src/data/transform_specs.py',
+    code_dir / 'src/data/data_transformation.py',
+    code_dir / 'src/data/transform_engine.py',
+    code_dir / 'src/data/data_load.py',
+    code_dir / 'src/data/order_items.py',
+    code_dir / 'src/data/out_of_core.py',
+    code_dir / 'src/data/geo.py',
+    code_dir / 'src/data/column_profile.py'  # The profiles are written with the outputs
+]
+STAR_CODE = PROCESS_CODE + [code_dir / 'src/data/star_schema.py']
+INDEX_CODE = PROCESS_CODE + [code_dir / 'src/analysis/segmentation.py', code_dir / 'src/data/customer_lookup.py']
+INDEX_INPUTS = ['orders.json.gz', 'ab_test.tar.gz']  # Raw files of the outputs read by the customer index
+processed_dir = Path("data/processed")
+
+
+#==============================
+# Run manifest
+#==============================
+def stage_fingerprints(filename, name):
+    """
+    Fingerprints of the extracted and processed outputs of a dataset
+    
+    Args:
+        filename (str): Name of the raw file
+        name (str): Name of the dataset
+        
+    Returns:
+        tuple: (extracted fingerprint, processed fingerprint)
+    """
+    fp_extract = manifest.fingerprint(raw=manifest.file_hash(raw_dir / filename), code=manifest.code_version(EXTRACT_CODE))
+    fp_process = manifest.fingerprint(
+        extracted=fp_extract,
+        spec=TRANSFORM_SPECS.get(name),
+        engine=TRANSFORM_ENGINE,
+        code=manifest.code_version(PROCESS_CODE)
+    )
+    return fp_extract, fp_process
+
+
+def extract_or_reuse(filename, file_type, path_extract, fp_extract, keep_extracted=True):
+    """
+    Extract a raw file, or read the extracted parquet when the manifest says it is up to date
+    
+    Args:
+        filename (str): Name of the file to process
+        file_type (str): File format, as extract_files
+        path_extract (str): Path to extract the data to
+        fp_extract (str): Fingerprint of the extraction
+        keep_extracted (bool): Write the extracted parquet (written once, by extract_files); False skips it
+        
+    Returns:
+        pd.DataFrame: extracted data
+    """
+    extracted_file = path_extract + '.parquet'
+    if manifest.is_fresh(extracted_file, fp_extract):
+        logger.info(f"Step 1: Raw file unchanged, reusing {extracted_file}")
+        with stage('read_extracted', bytes_read=path_size(extracted_file)) as record:
+            df = parquet_to_pandas(pq.read_table(extracted_file))
+            record.set(rows_out=len(df))
+        return df
+
+    with stage('extract', bytes_read=path_size(raw_dir / filename)) as record:
+        df = extract_files(filename, file_type, write_extracted=keep_extracted)
+        record.set(rows_out=len(df), bytes_written=path_size(extracted_file) if keep_extracted else 0)
+
+    if keep_extracted:
+        manifest.record(extracted_file, fp_extract)
+    return df
+
+
+def is_processed_fresh(output_name, fp_process):
+    """
+    Verify if the processed outputs of a dataset are up to date, logging the skip
+    
+    Args:
+        output_name (str | list): Name of the processed file, without extension; or a list of names if the dataset has more outputs
+        fp_process (str): Fingerprint of the processed outputs
+        
+    Returns:
+        bool: True if the whole dataset can be skipped
+    """
+    output_names = [output_name] if isinstance(output_name, str) else output_name
+    if all(manifest.is_fresh(processed_dir / f"{name}.parquet", fp_process) for name in output_names):
+        logger.info(f"Inputs, spec and code unchanged, skipping {', '.join(output_names)}")
+        return True
+    return False
+
+
+def load_and_record(df, output_name, fp_process):
+    """
+    Load the transformed data and record it on the manifest
+    
+    Args:
+        df (pd.DataFrame): Transformed data
+        output_name (str): Name of the processed file, without extension
+        fp_process (str): Fingerprint of the processed output
+        
+    Returns:
+        None
+    """
+    with stage('load', rows_in=len(df)) as record:
+        parquet_file_path = load_data(df, output_name)
+        record.set(rows_out=len(df) if parquet_file_path is not None else 0, bytes_written=path_size(parquet_file_path))
+
+    if parquet_file_path is not None:
+        manifest.record(parquet_file_path, fp_process)
+
+
+#==============================
+# Out-of-core mode
+#==============================
+def process_streaming(filename, file_type, name, outputs, path_extract, fp_extract, fp_process, memory_budget, keep_extracted=True):
+    """
+    Extract, transform and load a dataset in chunks sized by the memory budget, with the same outputs of the in-memory path
+    
+    Args:
+        filename (str): Name of the raw file
+        file_type (str): File format, as extract_files
+        name (str): Name of the dataset on TRANSFORM_SPECS
+        outputs (list): Processed files; the first one gets the transformed rows, 'order_items' the exploded items
+            and 'merchant_locations' the latest location of each merchant
+        path_extract (str): Path to extract the data to
+        fp_extract (str): Fingerprint of the extraction
+        fp_process (str): Fingerprint of the processed outputs
+        memory_budget (int): Bytes this stage can use for data
+        keep_extracted (bool): Keep the extracted parquet; False extracts it to the temporary folder of the stage
+            (it is still the file read in chunks) and removes it at the end
+        
+    Returns:
+        None
+    """
+    chunk_size = chunk_bytes(memory_budget)
+    extracted_file = path_extract + '.parquet'
+
+    with tempfile.TemporaryDirectory(dir=Path(path_extract).parent) as spill_dir:
+        #--------------
+        # Step 1: Extract, chunk by chunk, to the extracted parquet
+        #--------------
+        if manifest.is_fresh(extracted_file, fp_extract):
+            logger.info(f"Step 1: Raw file unchanged, reusing {extracted_file}")
+        else:
+            logger.info(f"Step 1: Extracting data for: {filename}, in chunks of {chunk_size / 1024 ** 2:.0f}MB")
+            extract_path = Path(extracted_file).parent if keep_extracted else Path(spill_dir)
+            with stage('extract', bytes_read=path_size(raw_dir / filename)) as record:
+                rows = extract_chunked(filename, file_type, chunk_size, extract_path=extract_path)
+                extracted_file = str(extract_path / Path(extracted_file).name)
+                record.set(rows_out=rows, bytes_written=path_size(extracted_file))
+            if keep_extracted:
+                manifest.record(extracted_file, fp_extract)
+
+        #--------------
+        # Step 2 and 3: Transform each chunk (dedup through a spill file) and load it
+        #--------------
+        logger.info(f"Step 2: Transforming and loading {name} in chunks")
+        spec = TRANSFORM_SPECS.get(name)
+        with stage('transform_load', bytes_read=path_size(extracted_file)) as record:
+            chunks = iter_parquet_chunks(extracted_file, chunk_size)
+            if spec:
+                chunks = transform_chunks(chunks, spec, engine=TRANSFORM_ENGINE)
+                if spec.get('dedup'):
+                    chunks = dedup_chunks(chunks, spec['dedup'], spill_dir, chunk_size)
+
+            # The writers finish their files when the block ends without errors, and remove them otherwise
+            with ExitStack() as writers_stack:
+                writers = {output: writers_stack.enter_context(ChunkWriter(output)) for output in outputs}
+                locations = []
+                for df in chunks:
+                    writers[outputs[0]].write(df)
+                    if 'order_items' in writers:
+                        writers['order_items'].write(to_pandas(explode_items(df)))
+                    if 'merchant_locations' in writers:
+                        # One row per merchant of the chunk, combined at the end
+                        locations.append(merchant_locations(df))
+                if locations:
+                    writers['merchant_locations'].write(merchant_locations(pd.concat(locations, ignore_index=True)))
+
+            paths = {output: writer.path for output, writer in writers.items()}
+            record.set(rows_out=writers[outputs[0]].rows, bytes_written=sum(path_size(path) or 0 for path in paths.values()))
+
+    for path in paths.values():
+        if path is not None:
+            manifest.record(path, fp_process)
+
+
 
 #==============================
 # Process Tar Files
 #==============================
-def process_tar_file(filename, file_name_only, path_extract):
+def process_tar_file(filename, file_name_only, path_extract, memory_budget=None, keep_extracted=True):
     """
     Process tar.gz files through the ETL pipeline
     
@@ -35,16 +248,26 @@ def process_tar_file(filename, file_name_only, path_extract):
         filename (str): Name of the file to process
         file_name_only (str): Name of the file without extension
         path_extract (str): Path to extract the data to
+        memory_budget (int): Bytes for data of this stage, runs in chunks (process_streaming) if given
+        keep_extracted (bool): Write the extracted parquet, see extract_or_reuse
         
     Returns:
         None
     """
+    instrumentation.current().set(dataset=file_name_only)
+    with stage('fingerprint', bytes_read=path_size(raw_dir / filename)):
+        fp_extract, fp_process = stage_fingerprints(filename, file_name_only)
+    if is_processed_fresh(file_name_only, fp_process):
+        return
+    if memory_budget:
+        process_streaming(filename, 'tar_csv', file_name_only, [file_name_only], path_extract, fp_extract, fp_process, memory_budget, keep_extracted)
+        return
+
     #--------------
     # Step 1: Extract Data
     #--------------
     logger.info(f"Step 1: Extracting data for: {filename}")
-    df_tar = extract_files(filename, 'tar_csv')
-    df_tar.to_parquet(path_extract + '.parquet', index=False, compression="gzip")
+    df_tar = extract_or_reuse(filename, 'tar_csv', path_extract, fp_extract, keep_extracted)
     
     #--------------
     # Step 2: Transform Data                
@@ -56,7 +279,7 @@ def process_tar_file(filename, file_name_only, path_extract):
     # Step 3: Load data
     #--------------
     logger.info(f"Step 3: Loading transformed {file_name_only} data")
-    load_data(df_tar, file_name_only)
+    load_and_record(df_tar, file_name_only, fp_process)
     
     # Free memory
     del df_tar
@@ -66,7 +289,7 @@ def process_tar_file(filename, file_name_only, path_extract):
 #==============================
 # Process CSV Files
 #==============================
-def process_csv_file(filename, file_name_only, path_extract):
+def process_csv_file(filename, file_name_only, path_extract, memory_budget=None, keep_extracted=True):
     """
     Process csv.gz files through the ETL pipeline.
     
@@ -74,16 +297,26 @@ def process_csv_file(filename, file_name_only, path_extract):
         filename (str): Name of the file to process
         file_name_only (str): Name of the file without extension
         path_extract (str): Path to extract the data to
+        memory_budget (int): Bytes for data of this stage, runs in chunks (process_streaming) if given
+        keep_extracted (bool): Write the extracted parquet, see extract_or_reuse
         
     Returns:
         None
     """
+    instrumentation.current().set(dataset=file_name_only)
+    with stage('fingerprint', bytes_read=path_size(raw_dir / filename)):
+        fp_extract, fp_process = stage_fingerprints(filename, file_name_only)
+    if is_processed_fresh(f"{file_name_only}_processed", fp_process):
+        return
+    if memory_budget:
+        process_streaming(filename, 'gzip_csv', file_name_only, [f"{file_name_only}_processed"], path_extract, fp_extract, fp_process, memory_budget, keep_extracted)
+        return
+
     #--------------
     # Step 1: Extracting Data
     #--------------
     logger.info(f"Step 1: Extracting data for: {filename}")
-    df_csv = extract_files(filename, 'gzip_csv')
-    df_csv.to_parquet(path_extract + ".parquet", index=False, compression="gzip")
+    df_csv = extract_or_reuse(filename, 'gzip_csv', path_extract, fp_extract, keep_extracted)
 
     
     #--------------
@@ -91,41 +324,12 @@ def process_csv_file(filename, file_name_only, path_extract):
     #--------------
     name = file_name_only #filename.replace('.csv.gz', '')
     
-    # Restaurants transformation
-    if name == 'restaurants':
+    # Restaurants and consumers transformations, described on src/data/transform_specs.py
+    if name in TRANSFORM_SPECS:
         logger.info(f"Step 2: Transforming data of: {name}")
-
-        # Converting columns
-        conversions = [
-            ('created_at', 'datetime'),
-            ('price_range', 'int'),
-            ('takeout_time', 'int'),
-            ('average_ticket', 'float'),
-            ('delivery_time', 'float'),
-            ('minimum_order_value', 'float')
-        ]
-        # Instead of doing: "df_rest = convert_column(df_csv, conversions)", using pipe to not generate multiple DFs
-        df_transformed  = (
-            df_csv.pipe(handle_na_data, ['minimum_order_value'], 'fill', 0)
-                  .pipe(convert_column, conversions)
-                  .pipe(remove_duplicates, 'id', 'created_at')
-        )
-
-  
-    # Consumers transformation
-    elif name == 'consumers':
-        logger.info(f"Step 2: Transforming data of: {name}")
-
-        # Converting columns
-        conversions = [
-            ('created_at', 'datetime'),
-            ('customer_phone_number', 'int')
-        ]
-        df_transformed = (
-            df_csv.pipe(handle_na_data, ['customer_name'], 'fill', 'n/d')
-                  .pipe(convert_column, conversions)
-                  .pipe(remove_duplicates, 'customer_id', 'created_at')
-        )
+        with stage('transform', rows_in=len(df_csv)) as record:
+            df_transformed = apply_spec(df_csv, TRANSFORM_SPECS[name], engine=TRANSFORM_ENGINE)
+            record.set(rows_out=len(df_transformed))
         
     else:
         logger.warning(f"No specific transformation for {name}, using original data")
@@ -136,7 +340,7 @@ def process_csv_file(filename, file_name_only, path_extract):
     # Step 3: Load Data
     #--------------
     logger.info(f"Step 3: Loading transformed {name} data")
-    load_data(df_transformed , f"{name}_processed")
+    load_and_record(df_transformed, f"{name}_processed", fp_process)
 
     # Free memory
     del df_csv, df_transformed
@@ -147,7 +351,7 @@ def process_csv_file(filename, file_name_only, path_extract):
 #==============================
 # Process Tar Files
 #==============================
-def process_json_file(filename, file_name_only, path_extract):
+def process_json_file(filename, file_name_only, path_extract, memory_budget=None, keep_extracted=True):
     """
     Process json.gz files through the ETL pipeline
     
@@ -155,56 +359,223 @@ def process_json_file(filename, file_name_only, path_extract):
         filename (str): Name of the file to process
         file_name_only (str): Name of the file without extension
         path_extract (str): Path to extract the data to
+        memory_budget (int): Bytes for data of this stage, runs in chunks (process_streaming) if given
+        keep_extracted (bool): Write the extracted parquet, see extract_or_reuse
         
     Returns:
         None
     """
     name = file_name_only
 
+    instrumentation.current().set(dataset=name)
+    with stage('fingerprint', bytes_read=path_size(raw_dir / filename)):
+        fp_extract, fp_process = stage_fingerprints(filename, name)
+    # The orders also produce the order_items table (one row per item, see src/data/order_items.py)
+    #   and the merchant_locations (coordinates and grid cell of each merchant, see src/data/geo.py)
+    outputs = [f"{name}_processed"] + (['order_items', 'merchant_locations'] if name == 'orders' else [])
+    if is_processed_fresh(outputs, fp_process):
+        return
+    if memory_budget:
+        process_streaming(filename, 'gzip_json', name, outputs, path_extract, fp_extract, fp_process, memory_budget, keep_extracted)
+        return
+
     #--------------
     # Step 1: Extract Data
     #--------------
     logger.info(f"Step 1: Extracting data for: {filename}")
-    df_json = extract_files(filename, 'gzip_json')
-    df_json.to_parquet(path_extract + '.parquet', index=False, compression="gzip")
+    df_json = extract_or_reuse(filename, 'gzip_json', path_extract, fp_extract, keep_extracted)
     
     #--------------
     # Step 2: Transform Data
     #--------------
     logger.info(f"Step 2: Transforming data for: {filename}")
-    if name == 'orders':
+    if name in TRANSFORM_SPECS:
         logger.info(f"Step 2: Transforming data of: {name}")
+        with stage('transform', rows_in=len(df_json)) as record:
+            df_transformed = apply_spec(df_json, TRANSFORM_SPECS[name], engine=TRANSFORM_ENGINE)
+            record.set(rows_out=len(df_transformed))
 
-        # Converting columns
-        conversions = [
-            ('order_created_at', 'datetime'),
-            ('order_total_amount', 'float'),
-            ('order_scheduled_date', 'datetime')
-        ]        
-        df_transformed  = (
-            df_json.pipe(handle_na_data, ['customer_id'], 'drop') # Deleting rows without a customer_id as we wont be able to joinn with the other datasets to understand the a/b tests
-                  .pipe(convert_column, conversions)
-                  .pipe(remove_duplicates, 'order_id', 'order_created_at')
-        )
-
+    else:
+        logger.warning(f"No specific transformation for {name}, using original data")
+        df_transformed = df_json
+    
     
     
     #--------------
     # Step 3: Load data
     #--------------
     logger.info(f"Step 3: Loading transformed {file_name_only} data")
-    load_data(df_transformed, f"{name}_processed")
+    load_and_record(df_transformed, f"{name}_processed", fp_process)
+
+    #--------------
+    # Step 4: Normalize the nested items
+    #--------------
+    if 'order_items' in outputs:
+        logger.info("Step 4: Loading order_items")
+        with stage('order_items', rows_in=len(df_transformed)) as record:
+            df_items = to_pandas(explode_items(df_transformed))
+            record.set(rows_out=len(df_items))
+        load_and_record(df_items, 'order_items', fp_process)
+        del df_items
+
+    #--------------
+    # Step 5: Locations of the merchants, for the spatial index
+    #--------------
+    if 'merchant_locations' in outputs:
+        logger.info("Step 5: Loading merchant_locations")
+        with stage('merchant_locations', rows_in=len(df_transformed)) as record:
+            df_locations = merchant_locations(df_transformed)
+            record.set(rows_out=len(df_locations))
+        load_and_record(df_locations, 'merchant_locations', fp_process)
     
     # Free memory
-    del df_transformed
+    del df_json, df_transformed
     gc.collect()
 
 
 
+#==============================
+# Star Table
+#==============================
+def process_star(urls=URLS):
+    """
+    Build the surrogate keys and the orders_star fact table once all the datasets are processed
+
+    Args:
+        urls (dict): file name -> URL of the datasets joined on the star table
+
+    Returns:
+        None, but creates data/processed/orders_star.parquet and the key dictionaries on data/processed/keys
+    """
+    instrumentation.current().set(dataset='orders_star')
+    with stage('fingerprint'):
+        fp_star = manifest.fingerprint(
+            processed={filename: stage_fingerprints(filename, filename.split('.')[0])[1] for filename in urls},
+            code=manifest.code_version(STAR_CODE)
+        )
+    if is_processed_fresh('orders_star', fp_star):
+        return
+
+    with stage('join') as record:
+        parquet_file_path = build_star(processed_dir)
+        record.set(bytes_written=path_size(parquet_file_path))
+
+    if parquet_file_path is not None:
+        manifest.record(parquet_file_path, fp_star)
+
+
+
+#==============================
+# Customer Index
+#==============================
+def process_customer_index(inputs=INDEX_INPUTS):
+    """
+    Rebuild the customer lookup index once the orders and the ab_test are processed
+
+    The index is replaced in place, so a running CustomerIndex / lookup server loads the new one on its next lookup
+
+    Args:
+        inputs (list): raw files of the processed outputs read by the index
+
+    Returns:
+        None, but creates data/processed/customer_index.parquet (see src/data/customer_lookup.py)
+    """
+    instrumentation.current().set(dataset=INDEX_NAME)
+    with stage('fingerprint'):
+        fp_index = manifest.fingerprint(
+            processed={filename: stage_fingerprints(filename, filename.split('.')[0])[1] for filename in inputs},
+            code=manifest.code_version(INDEX_CODE)
+        )
+    if is_processed_fresh(INDEX_NAME, fp_index):
+        return
+
+    with stage('build') as record:
+        index_path = build_customer_index(processed_dir)
+        record.set(bytes_written=path_size(index_path))
+
+    manifest.record(index_path, fp_index)
+
+
+
+#==============================
+# ETL Graph
+#==============================
+def is_large_file(filename, folder=raw_dir):
+    """
+    Verify if a downloaded file is large enough to be limited by the scheduler
+    
+    Args:
+        filename (str): Name of the downloaded file
+        folder (Path): Directory of the downloaded files
+        
+    Returns:
+        bool: True if the file has more than LARGE_FILE_BYTES
+    """
+    path = Path(folder) / filename
+    return path.exists() and os.path.getsize(path) > LARGE_FILE_BYTES
+
+
+def build_stages(urls=URLS, memory_budget=None, keep_extracted=True):
+    """
+    Describe the ETL of each dataset as a dependency graph
+    
+    Each dataset has a download stage followed by a process stage (extract, transform and load),
+    the datasets don't depend on each other, so they can run in parallel; build_star waits for all of them and
+    build_customer_index for the orders and the ab_test
+    The downloads are io stages: they all start at once on threads, so the first run waits only for the largest file
+    
+    Args:
+        urls (dict): file name -> URL to download
+        memory_budget (int): Bytes for data of each process stage (out-of-core mode), None to process in memory
+        keep_extracted (bool): Write the extracted parquet of each dataset (read by notebooks/01 and by reruns)
+        
+    Returns:
+        list: Stage list for the scheduler
+    """
+    stages = []
+    for filename, url in urls.items():
+        # Set up file paths
+        file_name_only = filename.split('.')[0]  # Getting filename without extension
+        path_extract = f'data/extracted/{file_name_only}'
+
+        # Process each file types
+        if ".tar.gz" in filename:
+            process_file = process_tar_file
+        elif ".csv.gz" in filename:
+            process_file = process_csv_file
+        elif ".json.gz" in filename:
+            process_file = process_json_file
+        else:
+            logger.warning(f"Unsupported file format: {filename}")
+            continue
+
+        stages.append(Stage(name=f"download_{file_name_only}", func=download_file, args=(url, filename), check_result=True, io=True))
+        stages.append(Stage(
+            name=f"process_{file_name_only}",
+            func=process_file,
+            args=(filename, file_name_only, path_extract, memory_budget, keep_extracted),
+            depends_on=[f"download_{file_name_only}"],
+            large=partial(is_large_file, filename, raw_dir)
+        ))
+
+    # The star table joins all the datasets, so it runs after every process stage
+    process_stages = [item.name for item in stages if item.name.startswith('process_')]
+    if len(process_stages) == len(urls):
+        stages.append(Stage(name='build_star', func=process_star, args=(urls,), depends_on=process_stages))
+
+    # The customer index reads the processed orders and ab_test
+    index_stages = [f"process_{filename.split('.')[0]}" for filename in INDEX_INPUTS]
+    if all(name in process_stages for name in index_stages):
+        stages.append(Stage(name='build_customer_index', func=process_customer_index, args=(INDEX_INPUTS,), depends_on=index_stages))
+
+    return stages
+
+
+
 #==============================
 # Main ETL Pipeline
 #==============================
-def main():
+def main(max_workers=MAX_WORKERS, max_large=MAX_LARGE_STAGES, metrics=True, profile_stage=None, memory_budget=None, keep_extracted=True):
     """
     Execute the complete ETL pipeline
     
@@ -216,12 +587,25 @@ def main():
        - For production/scheduled ETL, a more automated approach would be implemented; being a selected trade-off due to time management
     3. Load - Saves the transformed data in parquet format for better performance and storage
     
+    The datasets are independent, so their stages run in parallel on a process pool (see build_stages),
+    a failure on one dataset is logged and doesn't stop the others
+    
     Data Sources:
         - Orders (JSON)
         - Consumers (CSV)
         - Restaurants (CSV)
         - AB Test Data (TAR)
     
+    Args:
+        max_workers (int): Amount of stages running at the same time
+        max_large (int): Amount of large datasets being processed at the same time
+        metrics (bool): Record the time, memory, rows and bytes of each stage on data/metrics/<run>.jsonl
+        profile_stage (str): Stage to run under cProfile, ex.: 'process_orders/transform'
+        memory_budget (int | str): Memory for data of the whole run, ex.: '2GB'; if given, the datasets are processed
+            in chunks (out-of-core mode, see process_streaming) and the budget is split between the max_workers stages
+        keep_extracted (bool): Write data/extracted/; False skips this copy when nothing reads it (a rerun after a
+            change of the transform then extracts the raw file again)
+    
     Returns:
         None, but creates processed parquet files in the data/processed directory
     """
@@ -229,36 +613,28 @@ def main():
     logger.info("Starting ETL pipeline")
     
     # Create necessary directories if they dont exist
+    Path("data/raw").mkdir(parents=True, exist_ok=True)
     Path("data/extracted").mkdir(parents=True, exist_ok=True)
     Path("data/processed").mkdir(parents=True, exist_ok=True)
 
-    # Process each file from the URLs dictionary
-    for filename, url in URLS.items(): # URLS is a dictionary that contains the file name and URL to download the datasets
-        try:
-            if download_file(url, filename):
-                # Set up file paths
-                file_name_only = filename.split('.')[0]  # Getting filename without extension
-                path_extract = f'data/extracted/{file_name_only}'
-                
-                # Process each file types
-                if ".tar.gz" in filename:
-                    process_tar_file(filename, file_name_only, path_extract)
-                
-                elif ".csv.gz" in filename:
-                    process_csv_file(filename, file_name_only, path_extract)
-                
-                elif ".json.gz" in filename:
-                    process_json_file(filename, file_name_only, path_extract)
-                
-                else:
-                    logger.warning(f"Unsupported file format: {filename}")
-
-            else:
-                logger.error(f"Failed to download {filename} from {url}")
-        
-        except Exception as e:
-            logger.error(f"Error processing {filename}: {str(e)}", exc_info=True)
+    # Stage metrics of this run (see src/data/instrumentation.py)
+    metrics_file = instrumentation.configure(enabled=metrics, profile_stage=profile_stage)
+
+    # Process each file from the URLs dictionary as a graph of stages
+    stage_budget = None
+    if memory_budget:
+        stage_budget = parse_size(memory_budget) // max_workers
+        logger.info(f"Out-of-core mode: {stage_budget / 1024 ** 2:.0f}MB of data per stage, {max_workers} stages at the same time")
+    status = run_stages(build_stages(URLS, stage_budget, keep_extracted), max_workers=max_workers, max_large=max_large)
     
+    failed = [name for name, result in status.items() if result != 'success']
+    if failed:
+        logger.error(f"Stages that did not succeed: {failed}")
+
+    if metrics_file:
+        instrumentation.summarize(metrics_file)
+        logger.info(f"Stage metrics saved on {metrics_file}")
+
     end_time = datetime.now()
     logger.info(f"ETL pipeline completed in {end_time - start_time}")
 
@@ -268,4 +644,13 @@ def main():
 # Main
 #==============================
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="iFood coupon analysis ETL")
+    parser.add_argument('--memory-budget', default=None, help="Memory for data of the whole run (ex.: 2GB), processes the datasets in chunks")
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS, help="Stages running at the same time")
+    parser.add_argument('--profile-stage', default=None, help="Stage to run under cProfile, ex.: process_orders/transform")
+    parser.add_argument('--no-metrics', action='store_true', help="Don't record the stage metrics")
+    parser.add_argument('--no-extracted', action='store_true', help="Don't write data/extracted/ (only the processed files)")
+    args = parser.parse_args()
+
+    main(max_workers=args.max_workers, metrics=not args.no_metrics, profile_stage=args.profile_stage, memory_budget=args.memory_budget,
+         keep_extracted=not args.no_extracted)
\ No newline at end of file
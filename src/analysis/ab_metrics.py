@@ -0,0 +1,182 @@
+# A/B Test Metrics
+# KPIs of the A/B test of notebooks/02_ab_test_analysis.ipynb for any amount of variants, computed in one grouped pass
+#   Before, the notebook looped over ['target', 'control'] filtering and grouping the whole orders.merge(ab_test) frame per group
+
+import logging
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('ab_metrics')
+
+KPIS = [
+    'total_users', 'active_users', 'activation_rate', 'retention_rate',
+    'avg_orders_per_user', 'avg_order_value', 'revenue_per_user', 'total_revenue'
+]
+
+# Per user metrics compared by the Welch t-tests, as the notebook
+TEST_METRICS = ['qt_orders', 'avg_value']
+
+
+
+#==============================
+# Per user metrics
+#==============================
+def user_metrics(orders: pd.DataFrame, ab_test: pd.DataFrame, group_column: str = 'is_target',
+                 user_column: str = 'customer_id', value_column: str = 'order_total_amount'):
+    """
+    Orders and revenue of each user of the test, in one pass over the orders
+
+    The orders are mapped to the position of their user on the test (a hash lookup) and summed with np.bincount,
+    without merging the orders with the test
+
+    Parameters:
+        orders (pd.DataFrame): processed orders (one row per order)
+        ab_test (pd.DataFrame): group of each user
+        group_column (str): column of the group on ab_test
+        user_column (str): user column on both
+        value_column (str): value of the orders
+
+    Returns:
+        pd.DataFrame: one row per user of the test with the group, qt_orders, total_value and avg_value
+            (avg_value is NaN for users without orders)
+    """
+    users = ab_test[[user_column, group_column]].drop_duplicates(subset=user_column).reset_index(drop=True)
+
+    # Position of the user of each order on the test, -1 for users out of the test
+    position = pd.Index(users[user_column]).get_indexer(orders[user_column])
+    in_test = position >= 0
+    position = position[in_test]
+    values = orders[value_column].to_numpy(dtype='float64', na_value=np.nan)[in_test]
+    has_value = ~np.isnan(values)
+
+    n_users = len(users)
+    qt_orders = np.bincount(position, minlength=n_users)
+    total_value = np.bincount(position[has_value], weights=values[has_value], minlength=n_users)
+    qt_values = np.bincount(position[has_value], minlength=n_users)
+
+    users['qt_orders'] = qt_orders
+    users['total_value'] = total_value
+    with np.errstate(invalid='ignore', divide='ignore'):
+        users['avg_value'] = np.where(qt_values > 0, total_value / np.maximum(qt_values, 1), np.nan)
+    users['qt_values'] = qt_values
+    return users
+
+
+
+#==============================
+# Group KPIs
+#==============================
+def group_kpis(per_user: pd.DataFrame, group_column: str = 'is_target'):
+    """
+    KPIs of each group from the per user metrics
+
+    Parameters:
+        per_user (pd.DataFrame): output of user_metrics
+        group_column (str): column of the group
+
+    Returns:
+        pd.DataFrame: one row per group (index) with the KPIS columns
+    """
+    flags = per_user.assign(active=per_user['qt_orders'] > 0, retained=per_user['qt_orders'] > 1)
+    grouped = flags.groupby(group_column, observed=True, sort=True).agg(
+        total_users=('qt_orders', 'size'),
+        active_users=('active', 'sum'),
+        retained_users=('retained', 'sum'),
+        total_orders=('qt_orders', 'sum'),
+        qt_values=('qt_values', 'sum'),
+        total_revenue=('total_value', 'sum')
+    )
+
+    kpis = pd.DataFrame(index=grouped.index)
+    kpis['total_users'] = grouped['total_users']
+    kpis['active_users'] = grouped['active_users']
+    # Active: at least 1 order; retained: at least 2 orders (the coupon is assumed to be for 1 order)
+    kpis['activation_rate'] = grouped['active_users'] / grouped['total_users']
+    kpis['retention_rate'] = grouped['retained_users'] / grouped['total_users']
+    kpis['avg_orders_per_user'] = grouped['total_orders'] / grouped['total_users']
+    kpis['avg_order_value'] = grouped['total_revenue'] / grouped['qt_values']
+    kpis['revenue_per_user'] = grouped['total_revenue'] / grouped['total_users']
+    kpis['total_revenue'] = grouped['total_revenue']
+    return kpis[KPIS]
+
+
+
+#==============================
+# Statistical tests
+#==============================
+def ttest_arrays(per_user: pd.DataFrame, group_column: str = 'is_target', metrics: list = TEST_METRICS):
+    """
+    Per user arrays of each group for scipy.stats.ttest_ind, only with the active users (as the notebook groups the orders)
+
+    Returns:
+        dict: group -> {metric: np.ndarray}
+    """
+    active = per_user[per_user['qt_orders'] > 0]
+    return {
+        group: {metric: data[metric].dropna().to_numpy() for metric in metrics}
+        for group, data in active.groupby(group_column, observed=True)
+    }
+
+
+def welch_tests(per_user: pd.DataFrame, control: str = 'control', group_column: str = 'is_target', metrics: list = TEST_METRICS):
+    """
+    Welch t-test (different variances) of each variant against the control, for each per user metric
+
+    Returns:
+        pd.DataFrame: variant, metric, mean of the variant and the control, t_stat and p_value
+    """
+    arrays = ttest_arrays(per_user, group_column, metrics)
+    if control not in arrays:
+        raise ValueError(f"Control group '{control}' not found in {list(arrays)}")
+
+    rows = []
+    for variant, variant_arrays in arrays.items():
+        if variant == control:
+            continue
+        for metric in metrics:
+            a, b = variant_arrays[metric], arrays[control][metric]
+            t_stat, p_value = stats.ttest_ind(a, b, equal_var=False)
+            rows.append((variant, metric, a.mean(), b.mean(), t_stat, p_value))
+
+    return pd.DataFrame(rows, columns=['variant', 'metric', 'mean_variant', 'mean_control', 't_stat', 'p_value'])
+
+
+
+#==============================
+# Report
+#==============================
+def experiment_report(orders: pd.DataFrame, ab_test: pd.DataFrame, control: str = 'control', group_column: str = 'is_target'):
+    """
+    Full report of the experiment: KPIs per group, lift of each variant and Welch t-tests
+
+    Usage:
+        report = experiment_report(read_data('orders_processed', columns=['customer_id', 'order_total_amount']), read_data('ab_test'))
+        report['kpis']
+
+    Parameters:
+        orders (pd.DataFrame): processed orders with customer_id and order_total_amount
+        ab_test (pd.DataFrame): customer_id and group of each user
+        control (str): name of the control group
+        group_column (str): column of the group
+
+    Returns:
+        dict: 'kpis' (group x KPIS), 'lift' (% difference of each variant to the control), 'tests' (welch_tests)
+            and 'per_user' (user_metrics)
+    """
+    per_user = user_metrics(orders, ab_test, group_column)
+    kpis = group_kpis(per_user, group_column)
+
+    lift = (kpis.drop(index=control) - kpis.loc[control]) / kpis.loc[control] * 100
+
+    logger.info(f"A/B test report of {len(per_user)} users in {len(kpis)} groups")
+    return {
+        'kpis': kpis,
+        'lift': lift,
+        'tests': welch_tests(per_user, control, group_column),
+        'per_user': per_user
+    }
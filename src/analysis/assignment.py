@@ -0,0 +1,184 @@
+# Experiment Assignment
+# Deterministic assignment of customers to the variants of an experiment, stratified by segment
+#   Before, notebooks/03_segmentations.ipynb reseeded np.random for each segment and drew a mask over its customers, so a
+#   customer's group depended on the order and membership of its segment, and was built with python loops
+#   Here the group comes from a salted hash of (experiment id, customer_id): a position in [0, 1) that is compared with the
+#   cumulative weights of the stratum of the customer. It is vectorized, the same on every rerun, doesn't change when other
+#   customers join or leave a segment, and a single customer is assigned in O(1) without reading any table
+
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from src.data.data_load import load_data, LOAD_SPECS, processed_dir
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('assignment')
+
+DEFAULT_WEIGHTS = {'target': 0.8, 'control': 0.2}  # Same 80/20 split of the notebook
+DEFAULT_STRATUM = '*'  # Key of the weights used by the strata that are not listed
+
+
+
+#==============================
+# Hash positions
+#==============================
+def _salt(experiment_id: str):
+    # 16 characters key of the SipHash of pd.util.hash_array, one per experiment
+    return hashlib.sha256(str(experiment_id).encode()).hexdigest()[:16]
+
+
+def hash_positions(ids, experiment_id: str):
+    """
+    Position in [0, 1) of each id on an experiment, from a keyed hash (SipHash) of the id
+
+    Parameters:
+        ids (pd.Series | np.ndarray | list): customer ids
+        experiment_id (str): salt of the hash; each experiment has independent positions
+
+    Returns:
+        np.ndarray: float64 positions, uniform on [0, 1)
+    """
+    values = np.asarray(pd.Series(ids).astype(str).to_numpy(dtype=object))
+    hashes = pd.util.hash_array(values, hash_key=_salt(experiment_id), categorize=False)
+    # The 53 high bits fill the float64 mantissa
+    return (hashes >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+
+#==============================
+# Assignment
+#==============================
+class StratifiedAssignment:
+    """
+    Variants of an experiment for any amount of customers, with weights per stratum (ex.: hybrid segment)
+
+    The variants are ordered as they appear on the weights (the default first); keeping that order and the weights of a
+    stratum keeps the group of every customer of it, and changing a weight only moves the customers near the boundary
+
+    Usage:
+        experiment = StratifiedAssignment('segment_incentives_2019_02', weights={
+            '*': {'target': 0.8, 'control': 0.2},
+            'VIP Customers': {'target': 0.5, 'control': 0.5}
+        }, stratum_column='hybrid_segment')
+        assignments = experiment.assign(rfm[['customer_id', 'hybrid_segment']])
+        experiment.save(assignments)                           # same layout of ab_test.parquet
+        experiment.variant('abc...', stratum='VIP Customers')  # a single customer, O(1)
+
+    Parameters:
+        experiment_id (str): id of the experiment, salt of the hash
+        weights (dict): {variant: weight} for every stratum, or {stratum: {variant: weight}} with DEFAULT_STRATUM for the others
+        stratum_column (str, optional): column of the strata on the customers
+        user_column (str): customer id column
+        group_column (str): column of the variant, 'is_target' as on ab_test
+    """
+    def __init__(self, experiment_id: str, weights: dict = DEFAULT_WEIGHTS, stratum_column: str = None,
+                 user_column: str = 'customer_id', group_column: str = 'is_target'):
+        self.experiment_id = str(experiment_id)
+        self.stratum_column = stratum_column
+        self.user_column = user_column
+        self.group_column = group_column
+
+        if all(isinstance(value, dict) for value in weights.values()):
+            self.weights = dict(weights)
+        else:
+            self.weights = {DEFAULT_STRATUM: dict(weights)}
+
+        # Variants of the default weights first, then the ones only on some strata
+        ordered = ([self.weights[DEFAULT_STRATUM]] if DEFAULT_STRATUM in self.weights else []) + list(self.weights.values())
+        self.variants = []
+        for stratum_weights in ordered:
+            self.variants += [variant for variant in stratum_weights if variant not in self.variants]
+        self._bounds = {stratum: self._stratum_bounds(stratum_weights) for stratum, stratum_weights in self.weights.items()}
+
+    def _stratum_bounds(self, weights: dict):
+        # Upper bound of the position of each variant but the last, as a share of the total weight
+        values = np.array([weights.get(variant, 0) for variant in self.variants], dtype=np.float64)
+        if (values < 0).any() or values.sum() <= 0:
+            raise ValueError(f"Weights must be non negative with a positive total, got {weights}")
+        return np.cumsum(values)[:-1] / values.sum()
+
+    def _bounds_of(self, stratum):
+        if stratum in self._bounds:
+            return self._bounds[stratum]
+        if DEFAULT_STRATUM in self._bounds:
+            return self._bounds[DEFAULT_STRATUM]
+        raise ValueError(f"No weights for stratum '{stratum}' and no default ('{DEFAULT_STRATUM}')")
+
+    def assign(self, customers):
+        """
+        Variant of each customer
+
+        Parameters:
+            customers (pd.DataFrame | pd.Series): customer ids, with the stratum column if the weights are per stratum
+
+        Returns:
+            pd.DataFrame: user column, stratum column (if any) and group column (categorical, one category per variant)
+        """
+        if isinstance(customers, pd.Series):
+            customers = customers.to_frame(self.user_column)
+        columns = [self.user_column] + ([self.stratum_column] if self.stratum_column else [])
+        assignments = customers[columns].drop_duplicates(subset=self.user_column).reset_index(drop=True)
+
+        positions = hash_positions(assignments[self.user_column], self.experiment_id)
+
+        # Bounds of each row from the code of its stratum (missing strata use the default, only required when there are any)
+        if self.stratum_column:
+            strata = pd.Categorical(assignments[self.stratum_column]).remove_unused_categories()
+            missing = strata.codes < 0
+            table = [self._bounds_of(stratum) for stratum in strata.categories] + ([self._bounds_of(None)] if missing.any() else [])
+            codes = np.where(missing, len(strata.categories), strata.codes)
+            bounds = np.array(table).reshape(len(table), len(self.variants) - 1)[codes]
+        else:
+            bounds = self._bounds_of(None)[np.newaxis, :]
+
+        variant_codes = (positions[:, np.newaxis] >= bounds).sum(axis=1)
+        assignments[self.group_column] = pd.Categorical.from_codes(variant_codes, self.variants)
+
+        logger.info(f"Assigned {len(assignments)} customers to {self.experiment_id}: "
+                    f"{assignments[self.group_column].value_counts().to_dict()}")
+        return assignments
+
+    def variant(self, customer_id: str, stratum=None):
+        """
+        Variant of a single customer, from its hash (O(1), same result of assign)
+
+        Parameters:
+            customer_id (str): id of the customer
+            stratum (optional): stratum of the customer, if the weights are per stratum
+
+        Returns:
+            str: variant
+        """
+        position = hash_positions([customer_id], self.experiment_id)[0]
+        return self.variants[int((position >= self._bounds_of(stratum)).sum())]
+
+    def save(self, assignments: pd.DataFrame, file_name: str = None, folder: Path = processed_dir):
+        """
+        Write the assignments with the layout of ab_test.parquet (partitioned by the group, sorted by customer)
+
+        Parameters:
+            assignments (pd.DataFrame): output of assign
+            file_name (str, optional): name of the output, defaults to assignment_<experiment_id>
+            folder (Path): folder of the output
+
+        Returns:
+            Path: path of the dataset, readable with read_data(file_name) and ab_metrics.experiment_report
+        """
+        layout = LOAD_SPECS['ab_test']
+        return load_data(
+            assignments,
+            file_name or f"assignment_{self.experiment_id}",
+            partition_cols=[self.group_column],
+            sort_by=[self.user_column],
+            row_group_size=layout['row_group_size'],
+            folder=folder
+        )
+
+    def __repr__(self):
+        return f"StratifiedAssignment({self.experiment_id}, variants {self.variants}, {len(self.weights)} weight set(s))"
@@ -0,0 +1,250 @@
+# Cohorts and Retention
+# Cohort x period retention and revenue matrices, by A/B test group
+#   Before, retention was a single "customers with 2+ orders" ratio per group on notebooks/02_ab_test_analysis.ipynb, and a
+#   cohort view would need a groupby over all the orders for each cohort and period
+#   Here the orders are reduced once to the activity of each customer per day (fold_in_activity adds only the new days), and
+#   the matrices come from integer codes (customer, group, cohort, period offset) summed on a sparse matrix
+
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pathlib import Path
+from scipy import sparse
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('cohorts')
+
+activity_path = Path("data/processed/customer_activity.parquet")
+
+COHORT_BY = ('signup', 'first_order')  # consumers.created_at or the first order of the customer
+FREQUENCIES = {'D': 1, 'W': 7}  # Days of each bin; weeks start on monday
+ALL_GROUPS = 'all'  # Group of every customer when there's no ab_test
+
+
+
+#==============================
+# Day numbers
+#==============================
+def _dates(values):
+    # date32 array of dates or datetimes (the day in UTC)
+    array = pa.array(values, from_pandas=True)
+    return array if pa.types.is_date32(array.type) else pc.cast(array, pa.date32())
+
+
+def _day_numbers(values):
+    # Days since 1970-01-01 of dates or datetimes, as float64 so the nulls are NaN
+    return pc.cast(_dates(values), pa.int32()).to_numpy(zero_copy_only=False).astype(np.float64)
+
+
+def _bins(days: np.ndarray, freq: str):
+    # Index of the day / week (monday based, 1970-01-01 is a thursday) of each day number
+    if freq not in FREQUENCIES:
+        raise ValueError(f"Frequency must be one of {list(FREQUENCIES)}, got '{freq}'")
+    return (days + 3) // 7 if freq == 'W' else days
+
+
+def _first_day(bins: np.ndarray, freq: str):
+    # Day number of the first day of each bin
+    return bins * 7 - 3 if freq == 'W' else bins
+
+
+
+def _positions(values, lookup):
+    # Position of each value on lookup (-1 if missing), from an arrow hash table of the lookup
+    positions = pc.index_in(pa.array(values, from_pandas=True), value_set=pa.array(lookup, from_pandas=True))
+    return pc.fill_null(positions, -1).to_numpy(zero_copy_only=False).astype(np.int64)
+
+
+
+#==============================
+# Customer activity
+#==============================
+def customer_activity(orders: pd.DataFrame, date_column: str = 'order_created_date'):
+    """
+    Orders and revenue of each customer per day: the only input of the cohort matrices
+
+    Parameters:
+        orders (pd.DataFrame): orders with customer_id, order_id, order_total_amount and date_column
+        date_column (str): date (or datetime, taken as UTC) of the orders
+
+    Returns:
+        pd.DataFrame: customer_id, activity_date (date32), orders and revenue, one row per customer and day
+    """
+    activity = pd.DataFrame({
+        'customer_id': orders['customer_id'].to_numpy(),
+        'activity_date': pd.array(_dates(orders[date_column]), dtype=pd.ArrowDtype(pa.date32())),
+        'order_id': orders['order_id'].to_numpy(),
+        'order_total_amount': orders['order_total_amount'].to_numpy()
+    })
+    return activity.groupby(['customer_id', 'activity_date'], observed=True, sort=False, dropna=True).agg(
+        orders=('order_id', 'count'),
+        revenue=('order_total_amount', 'sum')
+    ).reset_index()
+
+
+def fold_in_activity(new_orders: pd.DataFrame, path: Path = activity_path, date_column: str = 'order_created_date'):
+    """
+    Add the activity of new orders to the stored activity, ignoring the dates that were already folded in
+
+    The dates already included are saved on the parquet metadata, so running again with the same day doesn't count it twice
+
+    Parameters:
+        new_orders (pd.DataFrame): orders of the new day(s), with date_column
+        path (Path): parquet file of the activity
+        date_column (str): date of the orders
+
+    Returns:
+        pd.DataFrame: updated activity
+    """
+    path = Path(path)
+    if path.exists():
+        table = pq.read_table(path)
+        folded_dates = set(json.loads((table.schema.metadata or {}).get(b'folded_dates', b'[]')))
+        activity = table.to_pandas()
+    else:
+        folded_dates = set()
+        activity = None
+
+    dates = new_orders[date_column].astype(str)
+    new_orders = new_orders[~dates.isin(folded_dates)]
+    new_dates = set(dates[~dates.isin(folded_dates)].unique())
+    if not new_dates:
+        logger.info("No new dates to fold in")
+        return activity
+
+    # The new dates are not on the stored activity, so its rows are only appended
+    new_activity = customer_activity(new_orders, date_column)
+    activity = new_activity if activity is None else pd.concat([activity, new_activity], ignore_index=True)
+
+    table = pa.Table.from_pandas(activity, preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), b'folded_dates': json.dumps(sorted(folded_dates | new_dates)).encode()}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+    tmp_path.replace(path)
+
+    logger.info(f"Folded {len(new_orders)} orders of {len(new_dates)} date(s) into {len(activity)} customer days")
+    return activity
+
+
+
+#==============================
+# Cohort matrices
+#==============================
+def cohort_matrices(activity: pd.DataFrame, consumers: pd.DataFrame = None, ab_test: pd.DataFrame = None,
+                    cohort_by: str = 'signup', cohort_freq: str = 'W', period_freq: str = 'W', max_periods: int = None,
+                    group_column: str = 'is_target'):
+    """
+    Retention and revenue of each cohort on each period since its start, by group
+
+    A cohort has the customers that signed up (or ordered for the first time) on the same day / week; the period of an
+    activity is the number of days / weeks between the start of its cohort and it. The customers of a cohort without orders
+    count on its size, so with cohort_by='signup' the retention of period 0 is the activation of the cohort
+
+    Usage:
+        activity = customer_activity(read_data('orders_processed', columns=['customer_id', 'order_id', 'order_total_amount', 'order_created_date']))
+        # or, incrementally: activity = fold_in_activity(new_day_orders)
+        cohorts = cohort_matrices(activity, consumers, ab_test, cohort_by='signup', cohort_freq='W', period_freq='W')
+        cohorts['retention'].loc['target']  # cohort x period of the target group
+
+    Parameters:
+        activity (pd.DataFrame): output of customer_activity / fold_in_activity
+        consumers (pd.DataFrame, optional): customer_id and created_at, required with cohort_by='signup'
+        ab_test (pd.DataFrame, optional): customer_id and group_column; only its customers are counted. Without it all the
+            customers are on the group 'all'
+        cohort_by (str): 'signup' (consumers.created_at) or 'first_order'
+        cohort_freq (str): 'D' or 'W', size of the cohorts
+        period_freq (str): 'D' or 'W', size of the periods
+        max_periods (int, optional): keep only the first periods
+        group_column (str): group column of ab_test
+
+    Returns:
+        dict: 'customers' (pd.Series, size of each group and cohort) and the DataFrames 'active' (customers with orders),
+            'retention' (active / customers), 'orders' and 'revenue', indexed by (group, cohort start) with a column per period
+    """
+    if cohort_by not in COHORT_BY:
+        raise ValueError(f"cohort_by must be one of {COHORT_BY}, got '{cohort_by}'")
+
+    # Integer code of each customer, and of the customer of each activity row (-1 if unknown)
+    activity_days = _day_numbers(activity['activity_date'])
+    if cohort_by == 'signup':
+        if consumers is None:
+            raise ValueError("cohort_by='signup' requires the consumers")
+        consumers = consumers.drop_duplicates(subset='customer_id')
+        customers = pd.Index(consumers['customer_id'])
+        cohort_days = _day_numbers(consumers['created_at'])
+        activity_codes = _positions(activity['customer_id'], customers)
+    else:
+        activity_codes, customers = pd.factorize(activity['customer_id'])
+        customers = pd.Index(customers)
+        cohort_days = pd.Series(activity_days).groupby(activity_codes).min().reindex(range(len(customers))).to_numpy()
+
+    # Group of each customer; the ones out of the A/B test are not counted
+    if ab_test is not None:
+        groups = pd.Categorical(ab_test[group_column])
+        positions = _positions(customers, ab_test['customer_id'])
+        group_codes = np.where(positions >= 0, groups.codes[positions], -1)
+        group_names = list(groups.categories)
+    else:
+        group_codes = np.zeros(len(customers), dtype=np.int8)
+        group_names = [ALL_GROUPS]
+
+    # Cohorts: only the bins with customers become rows
+    valid = (group_codes >= 0) & ~np.isnan(cohort_days)
+    cohort_bins = _bins(cohort_days, cohort_freq)
+    cohorts, cohort_codes = np.unique(cohort_bins[valid], return_inverse=True)
+    customer_rows = np.full(len(customers), -1, dtype=np.int64)
+    customer_rows[valid] = group_codes[valid].astype(np.int64) * len(cohorts) + cohort_codes
+    n_rows = len(group_names) * len(cohorts)
+
+    # Period of each activity row, from the start of the cohort of its customer
+    rows = np.where(activity_codes >= 0, customer_rows[activity_codes], -1)
+    cohort_starts = _first_day(cohorts, cohort_freq)
+    start_days = cohort_starts[np.maximum(rows, 0) % len(cohorts)] if len(cohorts) else np.zeros(len(rows))
+    offsets = _bins(activity_days, period_freq) - _bins(start_days, period_freq)
+    keep = (rows >= 0) & (offsets >= 0) & ~np.isnan(offsets)
+    if max_periods is not None:
+        keep &= offsets < max_periods
+    dropped = int(((rows >= 0) & ~keep & (offsets < 0)).sum())
+    if dropped:
+        logger.warning(f"Ignored {dropped} customer days before the start of their cohort")
+    rows, offsets, codes = rows[keep], offsets[keep].astype(np.int64), activity_codes[keep]
+    n_periods = int(offsets.max()) + 1 if len(offsets) else 0
+
+    # A customer is active once per period, even with orders on several days of it: the (customer x period) entries of a
+    #   sparse matrix, with the duplicates summed
+    per_customer = sparse.csr_matrix((np.ones(len(codes)), (codes, offsets)), shape=(len(customers), n_periods))
+    active_codes = np.repeat(np.arange(len(customers)), np.diff(per_customer.indptr))
+
+    # Sparse (row x period) sums
+    shape = (n_rows, n_periods)
+    matrices = {
+        'active': sparse.coo_matrix((np.ones(len(active_codes)), (customer_rows[active_codes], per_customer.indices)), shape=shape),
+        'orders': sparse.coo_matrix((activity['orders'].to_numpy(dtype=np.float64)[keep], (rows, offsets)), shape=shape),
+        'revenue': sparse.coo_matrix((activity['revenue'].to_numpy(dtype=np.float64)[keep], (rows, offsets)), shape=shape)
+    }
+    sizes = np.bincount(customer_rows[valid], minlength=n_rows)
+
+    # Only the (group, cohort) rows with customers
+    index = pd.MultiIndex.from_product(
+        [group_names, pd.to_datetime(cohort_starts.astype(np.int64), unit='D').date], names=[group_column, 'cohort']
+    )
+    present = sizes > 0
+    index, sizes = index[present], sizes[present]
+    columns = pd.RangeIndex(n_periods, name='period')
+
+    result = {'customers': pd.Series(sizes, index=index, name='customers')}
+    for name, matrix in matrices.items():
+        values = matrix.tocsr()[present].toarray()
+        result[name] = pd.DataFrame(values.astype(np.int64) if name != 'revenue' else values, index=index, columns=columns)
+    result['retention'] = result['active'].div(result['customers'], axis=0)
+
+    logger.info(f"Built {len(index)} cohorts x {n_periods} periods ({cohort_by}, cohorts '{cohort_freq}', periods '{period_freq}')")
+    return result
@@ -0,0 +1,426 @@
+# Experiment Statistics
+# Sufficient statistics of the A/B test, updated with only the new orders
+#   ab_metrics.experiment_report needs every order of the test in memory and recomputes everything on each refresh
+#   Here each user keeps its order count and revenue, and each variant the count, mean and M2 (Welford) of the per user
+#   metrics of the t-tests; a batch of orders only changes the users in it, so a daily refresh costs O(new orders).
+#   Accumulators of other chunks or worker processes are combined with merge, and the Welch t-test, p-value and
+#   confidence interval come straight from the moments
+
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from scipy import stats
+
+from src.analysis.ab_metrics import KPIS, TEST_METRICS
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('experiment_stats')
+
+state_path = Path("data/processed/experiment_state.parquet")
+
+CONFIDENCE = 0.95
+
+
+
+#==============================
+# Moments
+#==============================
+class Moments:
+    """
+    Count, mean and M2 (sum of squared differences to the mean) of one value per group, as arrays
+
+    Two sets of moments are merged with the parallel formula of Chan et al. (the same result of Welford over all the values),
+    and a subset can be removed with its inverse, so a user whose metric changed is removed and added again
+
+    Parameters:
+        n, mean, m2 (np.ndarray): one position per group
+    """
+    def __init__(self, n: np.ndarray, mean: np.ndarray, m2: np.ndarray):
+        self.n = np.asarray(n, dtype=np.int64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def empty(cls, n_groups: int):
+        return cls(np.zeros(n_groups), np.zeros(n_groups), np.zeros(n_groups))
+
+    @classmethod
+    def from_values(cls, values: np.ndarray, groups: np.ndarray, n_groups: int):
+        """
+        Moments of the values of each group (groups are codes 0 to n_groups - 1), in two passes with np.bincount
+        """
+        n = np.bincount(groups, minlength=n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, np.bincount(groups, weights=values, minlength=n_groups) / np.maximum(n, 1), 0.0)
+        m2 = np.bincount(groups, weights=(values - mean[groups]) ** 2, minlength=n_groups)
+        return cls(n, mean, m2)
+
+    def merge(self, other: 'Moments'):
+        """
+        Moments of the values of both
+        """
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, self.mean + delta * other.n / np.maximum(n, 1), 0.0)
+            m2 = np.where(n > 0, self.m2 + other.m2 + delta ** 2 * self.n * other.n / np.maximum(n, 1), 0.0)
+        return Moments(n, mean, m2)
+
+    def remove(self, other: 'Moments'):
+        """
+        Moments without the values of other (a subset of the values of self)
+        """
+        n = self.n - other.n
+        if (n < 0).any():
+            raise ValueError("Removing more values than the moments have")
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, (self.n * self.mean - other.n * other.mean) / np.maximum(n, 1), 0.0)
+            delta = other.mean - mean
+            m2 = np.where(n > 0, self.m2 - other.m2 - delta ** 2 * n * other.n / np.maximum(self.n, 1), 0.0)
+        # Rounding can leave a tiny negative M2 when the remaining values are all equal
+        return Moments(n, mean, np.maximum(m2, 0.0))
+
+    @property
+    def variance(self):
+        # Sample variance (ddof=1), as scipy.stats.ttest_ind
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 1, self.m2 / np.maximum(self.n - 1, 1), np.nan)
+
+    def to_dict(self):
+        return {'n': self.n.tolist(), 'mean': self.mean.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data['n'], data['mean'], data['m2'])
+
+    def __repr__(self):
+        return f"Moments(n={self.n.tolist()}, mean={self.mean.round(4).tolist()})"
+
+
+
+#==============================
+# Welch t-test from the moments
+#==============================
+def welch_from_moments(n_a, mean_a, var_a, n_b, mean_b, var_b, confidence: float = CONFIDENCE):
+    """
+    Welch t-test (different variances) of the difference of two means, from their count, mean and sample variance
+
+    Returns:
+        tuple: (t_stat, p_value, degrees of freedom, lower and upper bounds of the confidence interval of mean_a - mean_b)
+    """
+    se_a, se_b = var_a / n_a, var_b / n_b
+    se = np.sqrt(se_a + se_b)
+    diff = mean_a - mean_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_stat = diff / se
+        dof = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+    p_value = 2 * stats.t.sf(np.abs(t_stat), dof)
+    margin = stats.t.ppf((1 + confidence) / 2, dof) * se
+    return t_stat, p_value, dof, diff - margin, diff + margin
+
+
+
+#==============================
+# Accumulator
+#==============================
+class ExperimentAccumulator:
+    """
+    Per user order counts and revenue of the test users, and per variant moments of the per user metrics
+
+    The metrics are the ones of ab_metrics: qt_orders of the active users (1+ orders) and avg_value of the users
+    with an order value, so the tests and KPIs are the same of experiment_report over the same orders
+
+    Usage:
+        acc = ExperimentAccumulator(read_data('ab_test'))
+        for chunk in order_batches:
+            acc.update(chunk)
+        acc.welch_tests()
+
+    Parameters:
+        ab_test (pd.DataFrame): group of each user
+        group_column (str): column of the group on ab_test
+        user_column (str): user column on ab_test and on the orders
+        value_column (str): value of the orders
+    """
+    def __init__(self, ab_test: pd.DataFrame, group_column: str = 'is_target', user_column: str = 'customer_id',
+                 value_column: str = 'order_total_amount'):
+        self.group_column = group_column
+        self.user_column = user_column
+        self.value_column = value_column
+
+        users = ab_test[[user_column, group_column]].drop_duplicates(subset=user_column)
+        groups = pd.Categorical(users[group_column].astype(str))
+        self.groups = list(groups.categories)
+        self.users = pd.Index(users[user_column].to_numpy(), name=user_column)
+        self.user_group = groups.codes.astype(np.int64)
+
+        n_users, n_groups = len(self.users), len(self.groups)
+        self.qt_orders = np.zeros(n_users, dtype=np.int64)
+        self.total_value = np.zeros(n_users, dtype=np.float64)
+        self.qt_values = np.zeros(n_users, dtype=np.int64)
+        self.moments = {metric: Moments.empty(n_groups) for metric in TEST_METRICS}
+        self.total_users = np.bincount(self.user_group, minlength=n_groups)
+        self.active_users = np.zeros(n_groups, dtype=np.int64)
+        self.retained_users = np.zeros(n_groups, dtype=np.int64)
+        self.total_orders = np.zeros(n_groups, dtype=np.int64)
+        self.total_qt_values = np.zeros(n_groups, dtype=np.int64)
+        self.total_revenue = np.zeros(n_groups, dtype=np.float64)
+
+    #--------------
+    # Per user metrics
+    #--------------
+    def _metric_values(self, positions: np.ndarray):
+        # Values of the test metrics of these users, and which users have each one (as ttest_arrays)
+        qt_orders = self.qt_orders[positions]
+        qt_values = self.qt_values[positions]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg_value = self.total_value[positions] / np.maximum(qt_values, 1)
+        return {
+            'qt_orders': (qt_orders.astype(np.float64), qt_orders > 0),
+            'avg_value': (avg_value, qt_values > 0)
+        }
+
+    def _apply(self, positions: np.ndarray, qt_orders: np.ndarray, total_value: np.ndarray, qt_values: np.ndarray):
+        """
+        Add the orders of some users (unique positions) and update the moments of only those users
+        """
+        n_groups = len(self.groups)
+        groups = self.user_group[positions]
+
+        before = self._metric_values(positions)
+        old_orders = self.qt_orders[positions]
+        old_values = self.qt_values[positions]
+
+        self.qt_orders[positions] += qt_orders
+        self.total_value[positions] += total_value
+        self.qt_values[positions] += qt_values
+
+        after = self._metric_values(positions)
+        for metric in TEST_METRICS:
+            (old, had), (new, has) = before[metric], after[metric]
+            removed = Moments.from_values(old[had], groups[had], n_groups)
+            added = Moments.from_values(new[has], groups[has], n_groups)
+            self.moments[metric] = self.moments[metric].remove(removed).merge(added)
+
+        new_orders = self.qt_orders[positions]
+        count = lambda flags: np.bincount(groups, weights=flags, minlength=n_groups).astype(np.int64)
+        self.active_users += count((new_orders > 0).astype(np.int64) - (old_orders > 0))
+        self.retained_users += count((new_orders > 1).astype(np.int64) - (old_orders > 1))
+        self.total_orders += count(new_orders - old_orders)
+        self.total_qt_values += count(self.qt_values[positions] - old_values)
+        self.total_revenue += np.bincount(groups, weights=total_value, minlength=n_groups)
+
+    def update(self, orders: pd.DataFrame):
+        """
+        Add a batch of new orders; only the users of the batch are updated
+
+        Parameters:
+            orders (pd.DataFrame): orders with the user and value columns (orders of users out of the test are ignored)
+
+        Returns:
+            ExperimentAccumulator: self
+        """
+        position = self.users.get_indexer(orders[self.user_column])
+        in_test = position >= 0
+        position = position[in_test]
+        if not len(position):
+            return self
+        values = orders[self.value_column].to_numpy(dtype='float64', na_value=np.nan)[in_test]
+        has_value = ~np.isnan(values)
+
+        # Sums of the batch per user of the batch
+        touched, inverse = np.unique(position, return_inverse=True)
+        self._apply(
+            touched,
+            np.bincount(inverse, minlength=len(touched)),
+            np.bincount(inverse[has_value], weights=values[has_value], minlength=len(touched)),
+            np.bincount(inverse[has_value], minlength=len(touched))
+        )
+        logger.info(f"Added {len(position)} orders of {len(touched)} test users")
+        return self
+
+    def merge(self, other: 'ExperimentAccumulator'):
+        """
+        Combine with the accumulator of other orders (another chunk or worker) of the same test users
+
+        Only the users with orders on other are updated; with disjoint users, it is the same as merging the moments
+
+        Returns:
+            ExperimentAccumulator: self
+        """
+        if not self.users.equals(other.users) or self.groups != other.groups:
+            raise ValueError("Only accumulators of the same test users can be merged")
+        touched = np.flatnonzero(other.qt_orders > 0)
+        self._apply(touched, other.qt_orders[touched], other.total_value[touched], other.qt_values[touched])
+        return self
+
+    def recompute(self):
+        """
+        Moments and KPI sums again from the per user values, O(test users); removes the rounding of many updates
+        """
+        n_groups = len(self.groups)
+        positions = np.arange(len(self.users))
+        for metric, (values, has) in self._metric_values(positions).items():
+            self.moments[metric] = Moments.from_values(values[has], self.user_group[has], n_groups)
+        count = lambda values: np.bincount(self.user_group, weights=values, minlength=n_groups)
+        self.active_users = count(self.qt_orders > 0).astype(np.int64)
+        self.retained_users = count(self.qt_orders > 1).astype(np.int64)
+        self.total_orders = count(self.qt_orders).astype(np.int64)
+        self.total_qt_values = count(self.qt_values).astype(np.int64)
+        self.total_revenue = count(self.total_value)
+        return self
+
+    #--------------
+    # Results
+    #--------------
+    def kpis(self):
+        """
+        KPIs of each group, same of ab_metrics.group_kpis
+
+        Returns:
+            pd.DataFrame: one row per group (index) with the KPIS columns
+        """
+        kpis = pd.DataFrame(index=pd.Index(self.groups, name=self.group_column))
+        kpis['total_users'] = self.total_users
+        kpis['active_users'] = self.active_users
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kpis['activation_rate'] = self.active_users / self.total_users
+            kpis['retention_rate'] = self.retained_users / self.total_users
+            kpis['avg_orders_per_user'] = self.total_orders / self.total_users
+            kpis['avg_order_value'] = self.total_revenue / self.total_qt_values
+            kpis['revenue_per_user'] = self.total_revenue / self.total_users
+        kpis['total_revenue'] = self.total_revenue
+        return kpis[KPIS]
+
+    def welch_tests(self, control: str = 'control', confidence: float = CONFIDENCE):
+        """
+        Welch t-test of each variant against the control, for each per user metric, from the moments only
+
+        Returns:
+            pd.DataFrame: variant, metric, mean_variant, mean_control, t_stat, p_value (as ab_metrics.welch_tests),
+                dof and the confidence interval of mean_variant - mean_control (ci_low, ci_high)
+        """
+        if control not in self.groups:
+            raise ValueError(f"Control group '{control}' not found in {self.groups}")
+        c = self.groups.index(control)
+
+        rows = []
+        for v, variant in enumerate(self.groups):
+            if v == c:
+                continue
+            for metric in TEST_METRICS:
+                m = self.moments[metric]
+                t_stat, p_value, dof, ci_low, ci_high = welch_from_moments(
+                    m.n[v], m.mean[v], m.variance[v], m.n[c], m.mean[c], m.variance[c], confidence
+                )
+                rows.append((variant, metric, m.mean[v], m.mean[c], t_stat, p_value, dof, ci_low, ci_high))
+
+        return pd.DataFrame(rows, columns=['variant', 'metric', 'mean_variant', 'mean_control', 't_stat', 'p_value',
+                                           'dof', 'ci_low', 'ci_high'])
+
+    #--------------
+    # Storage
+    #--------------
+    def save(self, path: Path = state_path, metadata: dict = None):
+        """
+        Save the per user values (one row per test user) and the moments (parquet metadata)
+
+        Parameters:
+            path (Path): parquet file
+            metadata (dict, optional): other values to keep, ex.: the folded dates
+        """
+        table = pa.table({
+            self.user_column: self.users.to_numpy(),
+            self.group_column: pd.Categorical.from_codes(self.user_group, self.groups),
+            'qt_orders': self.qt_orders,
+            'total_value': self.total_value,
+            'qt_values': self.qt_values
+        })
+        state = {
+            'columns': [self.group_column, self.user_column, self.value_column],
+            'moments': {metric: moments.to_dict() for metric, moments in self.moments.items()},
+            **(metadata or {})
+        }
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        pq.write_table(table.replace_schema_metadata({b'experiment_state': json.dumps(state).encode()}), tmp_path)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path = state_path):
+        """
+        Accumulator saved by save
+
+        Returns:
+            tuple: (ExperimentAccumulator, dict of the saved metadata)
+        """
+        table = pq.read_table(path)
+        state = json.loads(table.schema.metadata[b'experiment_state'])
+        group_column, user_column, value_column = state.pop('columns')
+        df = table.to_pandas()
+
+        acc = cls(df[[user_column, group_column]], group_column, user_column, value_column)
+        acc.qt_orders = np.array(df['qt_orders'], dtype=np.int64)
+        acc.total_value = np.array(df['total_value'], dtype=np.float64)
+        acc.qt_values = np.array(df['qt_values'], dtype=np.int64)
+        acc.moments = {metric: Moments.from_dict(moments) for metric, moments in state.pop('moments').items()}
+        # The KPI sums are O(test users) from the per user values, the moments keep the saved ones
+        moments = acc.moments
+        acc.recompute()
+        acc.moments = moments
+        return acc, state
+
+    def __repr__(self):
+        return f"ExperimentAccumulator({len(self.users)} users, groups {self.groups}, {int(self.total_orders.sum())} orders)"
+
+
+
+#==============================
+# Daily refresh
+#==============================
+def refresh_experiment(new_orders: pd.DataFrame, ab_test: pd.DataFrame = None, path: Path = state_path,
+                       date_column: str = 'order_created_date'):
+    """
+    Add the orders of new dates to the stored accumulator, ignoring the dates that were already added
+
+    Usage:
+        acc = refresh_experiment(read_data('orders_processed', columns=[...], filters=[('order_created_date', '=', day)]),
+                                 ab_test=read_data('ab_test'))
+        acc.welch_tests()
+
+    Parameters:
+        new_orders (pd.DataFrame): orders of the new date(s), with date_column
+        ab_test (pd.DataFrame, optional): group of each user, only needed on the first run (no stored state)
+        path (Path): parquet file of the state
+        date_column (str): date of the orders
+
+    Returns:
+        ExperimentAccumulator: updated accumulator
+    """
+    path = Path(path)
+    if path.exists():
+        acc, metadata = ExperimentAccumulator.load(path)
+    elif ab_test is not None:
+        acc, metadata = ExperimentAccumulator(ab_test), {}
+    else:
+        raise ValueError(f"No experiment state on {path}, provide the ab_test to start one")
+
+    folded_dates = set(metadata.get('folded_dates', []))
+    dates = new_orders[date_column].astype(str)
+    new_dates = set(dates[~dates.isin(folded_dates)].unique())
+    if not new_dates:
+        logger.info("No new dates to add to the experiment")
+        return acc
+
+    acc.update(new_orders[~dates.isin(folded_dates)])
+    acc.save(path, {**metadata, 'folded_dates': sorted(folded_dates | new_dates)})
+    logger.info(f"Experiment updated with {len(new_dates)} date(s), saved on {path}")
+    return acc
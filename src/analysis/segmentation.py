@@ -0,0 +1,263 @@
+# Customer Segmentation
+# RFM features and hybrid segments of notebooks/03_segmentations.ipynb, computed with grouped aggregations and vectorized rules
+#   Before, the notebook used a python lambda per customer for the recency and a row by row apply for the segments
+#   The per customer aggregates can be stored and updated with only the new orders (fold_in_orders), without reading all the history
+
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('segmentation')
+
+aggregates_path = Path("data/processed/customer_aggregates.parquet")
+
+# Thresholds of the flags, as chosen on the notebook for this dataset
+THRESHOLDS = {
+    'recent_days': 7,         # Active if ordered in the last 7 days
+    'inactive_days': 15,      # Inactive if no orders in 15+ days
+    'high_quantile': 0.75,    # Top 25% of frequency, AOV and total spend
+    'low_quantile': 0.25,     # Bottom 25% of frequency and AOV
+    'new_max_frequency': 3,   # New customer: up to 3 orders...
+    'new_max_recency': 20     # ... and ordered in the last 20 days
+}
+
+# Hybrid segments, in order of priority: a customer gets the first segment whose rule matches
+#   Each rule receives the DataFrame of flags and returns a boolean Series
+SEGMENT_RULES = [
+    # Frequent users with small orders; encourage higher-value orders
+    ('Frequent Small Baskets', lambda f: f.is_high_frequency & f.is_low_aov & f.is_active),
+    # Infrequent users with high-value orders; encourage more frequent purchases
+    ('Big Spenders, Rare Visits', lambda f: f.is_low_frequency & f.is_high_aov & f.is_active),
+    # High-value users without orders in the last 7-15 days; target with backflow campaigns
+    ('At-Risk High Value', lambda f: f.is_high_value & ~f.is_active & ~f.is_inactive),
+    # High-value users inactive for longer; may require strong re-engagement
+    ('Churned High Value', lambda f: f.is_high_value & f.is_inactive),
+    # New customers exploring the platform
+    ('New Explorers', lambda f: f.is_new),
+    # Loyal high-value users; reinforce engagement with loyalty programs
+    ('VIP Customers', lambda f: f.is_high_frequency & f.is_high_aov & f.is_active),
+    # Regular users with stable engagement
+    ('Core Customers', lambda f: f.is_active & ~f.is_low_frequency & ~f.is_high_frequency),
+    # Low-value inactive users; lower priority for reactivation
+    ('Dormant Low Value', lambda f: f.is_inactive & ~f.is_high_value),
+    # Active, high frequency and neither high nor low AOV
+    ('Frequent Medium Spenders', lambda f: f.is_high_frequency & ~f.is_high_aov & ~f.is_low_aov & f.is_active),
+    # Active, moderate frequency and spending
+    ('Steady Customers', lambda f: ~f.is_high_frequency & ~f.is_low_frequency & ~f.is_high_aov & ~f.is_low_aov & f.is_active),
+    # Active with inconsistent patterns
+    ('Active Inconsistent', lambda f: f.is_active & ~f.is_new)
+]
+DEFAULT_SEGMENT = 'Other Customers'
+
+
+
+#==============================
+# Per customer aggregates
+#==============================
+def customer_aggregates(orders: pd.DataFrame):
+    """
+    Aggregates of each customer that can be combined with the aggregates of new orders
+
+    Parameters:
+        orders (pd.DataFrame): orders with customer_id, order_id, order_created_at and order_total_amount
+
+    Returns:
+        pd.DataFrame: customer_id (index), first_order_at, last_order_at, frequency, total_spend and qt_amounts
+            (orders with an amount, to compute the mean as the notebook, skipping NAs)
+    """
+    return orders.groupby('customer_id', observed=True, sort=True).agg(
+        first_order_at=('order_created_at', 'min'),
+        last_order_at=('order_created_at', 'max'),
+        frequency=('order_id', 'count'),
+        total_spend=('order_total_amount', 'sum'),
+        qt_amounts=('order_total_amount', 'count')
+    )
+
+
+def update_aggregates(aggregates: pd.DataFrame, new_orders: pd.DataFrame):
+    """
+    Combine stored aggregates with the orders of a new period, reading only the new orders
+
+    Parameters:
+        aggregates (pd.DataFrame): output of customer_aggregates (or of a previous update)
+        new_orders (pd.DataFrame): orders not yet included on the aggregates
+
+    Returns:
+        pd.DataFrame: updated aggregates
+    """
+    if new_orders.empty:
+        return aggregates
+    combined = pd.concat([aggregates, customer_aggregates(new_orders)])
+    return combined.groupby(level=0, observed=True, sort=True).agg({
+        'first_order_at': 'min',
+        'last_order_at': 'max',
+        'frequency': 'sum',
+        'total_spend': 'sum',
+        'qt_amounts': 'sum'
+    })
+
+
+def fold_in_orders(new_orders: pd.DataFrame, path: Path = aggregates_path, date_column: str = 'order_created_date'):
+    """
+    Update the stored aggregates with new orders, ignoring the dates that were already folded in
+
+    The dates already included are saved on the parquet metadata, so running again with the same day doesn't count it twice
+
+    Parameters:
+        new_orders (pd.DataFrame): orders of the new day(s), with date_column
+        path (Path): parquet file of the aggregates
+        date_column (str): date of the orders
+
+    Returns:
+        pd.DataFrame: updated aggregates
+    """
+    path = Path(path)
+    if path.exists():
+        table = pq.read_table(path)
+        folded_dates = set(json.loads((table.schema.metadata or {}).get(b'folded_dates', b'[]')))
+        aggregates = table.to_pandas()
+    else:
+        folded_dates = set()
+        aggregates = None
+
+    dates = new_orders[date_column].astype(str)
+    new_orders = new_orders[~dates.isin(folded_dates)]
+    new_dates = set(dates[~dates.isin(folded_dates)].unique())
+    if not new_dates:
+        logger.info("No new dates to fold in")
+        return aggregates
+
+    aggregates = customer_aggregates(new_orders) if aggregates is None else update_aggregates(aggregates, new_orders)
+
+    table = pa.Table.from_pandas(aggregates)
+    metadata = {**(table.schema.metadata or {}), b'folded_dates': json.dumps(sorted(folded_dates | new_dates)).encode()}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+    tmp_path.replace(path)
+
+    logger.info(f"Folded {len(new_orders)} orders of {len(new_dates)} date(s) into {len(aggregates)} customers")
+    return aggregates
+
+
+
+#==============================
+# RFM and segments
+#==============================
+def rfm_features(aggregates: pd.DataFrame, analysis_end_date=None):
+    """
+    Recency, frequency and monetary values of each customer
+
+    Parameters:
+        aggregates (pd.DataFrame): output of customer_aggregates / update_aggregates
+        analysis_end_date (Timestamp, optional): reference of the recency, defaults to the last order
+
+    Returns:
+        pd.DataFrame: customer_id, recency_days, frequency, avg_order_value and total_spend
+    """
+    if analysis_end_date is None:
+        analysis_end_date = aggregates['last_order_at'].max()
+
+    rfm = pd.DataFrame({
+        'customer_id': aggregates.index,
+        'recency_days': (analysis_end_date - aggregates['last_order_at']).dt.days.to_numpy(),
+        'frequency': aggregates['frequency'].to_numpy(),
+        'avg_order_value': (aggregates['total_spend'] / aggregates['qt_amounts'].where(aggregates['qt_amounts'] > 0)).to_numpy(),
+        'total_spend': aggregates['total_spend'].to_numpy()
+    })
+    return rfm
+
+
+def segment_flags(rfm: pd.DataFrame, thresholds: dict = THRESHOLDS):
+    """
+    Add the binary indicators used by the segment rules
+
+    Parameters:
+        rfm (pd.DataFrame): output of rfm_features
+        thresholds (dict): see THRESHOLDS
+
+    Returns:
+        pd.DataFrame: rfm with the is_* columns
+    """
+    high, low = thresholds['high_quantile'], thresholds['low_quantile']
+    quantiles = rfm[['frequency', 'avg_order_value', 'total_spend']].quantile([low, high])
+
+    rfm['is_active'] = rfm['recency_days'] <= thresholds['recent_days']
+    rfm['is_inactive'] = rfm['recency_days'] > thresholds['inactive_days']
+    rfm['is_high_frequency'] = rfm['frequency'] >= quantiles.loc[high, 'frequency']
+    rfm['is_low_frequency'] = rfm['frequency'] <= quantiles.loc[low, 'frequency']
+    rfm['is_high_aov'] = rfm['avg_order_value'] >= quantiles.loc[high, 'avg_order_value']
+    rfm['is_low_aov'] = rfm['avg_order_value'] <= quantiles.loc[low, 'avg_order_value']
+    rfm['is_high_value'] = rfm['total_spend'] >= quantiles.loc[high, 'total_spend']
+    rfm['is_new'] = (rfm['frequency'] <= thresholds['new_max_frequency']) & (rfm['recency_days'] <= thresholds['new_max_recency'])
+    return rfm
+
+
+def hybrid_segments(flags: pd.DataFrame, rules: list = SEGMENT_RULES, default: str = DEFAULT_SEGMENT):
+    """
+    Segment of each customer: the first rule that matches, evaluated for all the customers at once
+
+    Parameters:
+        flags (pd.DataFrame): output of segment_flags
+        rules (list): (segment, rule) in order of priority
+        default (str): segment of the customers that match no rule
+
+    Returns:
+        pd.Series: categorical segment of each row
+    """
+    names = [name for name, _ in rules]
+    segment = np.select([rule(flags).to_numpy(dtype=bool) for _, rule in rules], np.arange(len(rules)), default=len(rules))
+    return pd.Series(pd.Categorical.from_codes(segment, names + [default]), index=flags.index, name='hybrid_segment')
+
+
+def segment_customers(orders: pd.DataFrame = None, aggregates: pd.DataFrame = None, analysis_end_date=None, thresholds: dict = THRESHOLDS):
+    """
+    RFM features, flags and hybrid segment of each customer
+
+    Usage:
+        rfm = segment_customers(read_data('orders_processed', columns=['customer_id', 'order_id', 'order_created_at', 'order_total_amount']))
+        # or, incrementally: fold_in_orders(new_day_orders); rfm = segment_customers(aggregates=pd.read_parquet(aggregates_path))
+
+    Parameters:
+        orders (pd.DataFrame, optional): orders to aggregate
+        aggregates (pd.DataFrame, optional): stored aggregates, used instead of the orders
+        analysis_end_date (Timestamp, optional): reference of the recency
+        thresholds (dict): see THRESHOLDS
+
+    Returns:
+        pd.DataFrame: one row per customer with the RFM features, the is_* flags and hybrid_segment
+    """
+    if aggregates is None:
+        if orders is None:
+            raise ValueError("Provide the orders or the aggregates")
+        aggregates = customer_aggregates(orders)
+
+    rfm = segment_flags(rfm_features(aggregates, analysis_end_date), thresholds)
+    rfm['hybrid_segment'] = hybrid_segments(rfm)
+    return rfm
+
+
+def segment_profile(rfm: pd.DataFrame):
+    """
+    Size and mean RFM values of each segment, largest first
+
+    Returns:
+        pd.DataFrame: hybrid_segment, customer_id (count), recency_days, frequency, avg_order_value, avg_total_spend and pct_customers
+    """
+    profile = rfm.groupby('hybrid_segment', observed=True).agg({
+        'customer_id': 'count',
+        'recency_days': 'mean',
+        'frequency': 'mean',
+        'avg_order_value': 'mean',
+        'total_spend': 'mean'
+    }).reset_index().rename(columns={'total_spend': 'avg_total_spend'})
+    profile['pct_customers'] = profile['customer_id'] / profile['customer_id'].sum() * 100
+    return profile.sort_values('customer_id', ascending=False)
@@ -0,0 +1,275 @@
+# Dataset Catalog
+# Lazy handles to every extracted and processed dataset, for the notebooks and scripts
+#   Before, each notebook called pd.read_parquet on hard-coded relative paths, reading all the columns of every dataset up front
+#   A handle only opens the parquet metadata (memory-mapped); the columns are read when asked and kept decoded on an LRU cache,
+#   so a cell that runs again reuses them instead of reading the disk
+
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.fs as pa_fs
+import pyarrow.parquet as pq
+
+from src.data.data_load import open_dataset, encode_partitions
+from src.data.column_profile import read_profile
+from src.data.schemas import parquet_to_pandas
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('catalog')
+
+# Layers of the data folder, in order of precedence when a name exists on more than one (ex.: ab_test)
+LAYERS = {
+    'processed': Path("data/processed"),
+    'extracted': Path("data/extracted")
+}
+DEFAULT_MEMORY_BUDGET = 2 * 1024 ** 3  # Bytes of decoded columns kept on the cache
+
+
+
+#==============================
+# Column cache
+#==============================
+class ColumnCache:
+    """
+    Decoded columns (pa.ChunkedArray) kept up to a memory budget, evicting the least recently used
+
+    Parameters:
+        memory_budget (int): max bytes of the cached columns; a column larger than it is never cached
+    """
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._columns = OrderedDict()
+
+    def get(self, key):
+        column = self._columns.get(key)
+        if column is None:
+            self.misses += 1
+            return None
+        self._columns.move_to_end(key)
+        self.hits += 1
+        return column
+
+    def put(self, key, column: pa.ChunkedArray):
+        if column.nbytes > self.memory_budget:
+            return
+        if key in self._columns:
+            self.nbytes -= self._columns.pop(key).nbytes
+        self._columns[key] = column
+        self.nbytes += column.nbytes
+        while self.nbytes > self.memory_budget:
+            _, evicted = self._columns.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        self._columns.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return (f"ColumnCache({len(self)} columns, {self.nbytes / 1024 ** 2:.1f}MB of {self.memory_budget / 1024 ** 2:.0f}MB, "
+                f"{self.hits} hits, {self.misses} misses)")
+
+
+
+#==============================
+# Dataset handle
+#==============================
+def _filters_key(filters):
+    # Hashable form of pyarrow/pandas filters: [('col', 'op', value), ...] or [[...], [...]] (OR of ANDs)
+    if not filters:
+        return None
+    return repr(filters)
+
+
+def _version(path: Path):
+    # Changes when the ETL writes the file again (files and folders are replaced, not edited)
+    stat = path.stat()
+    return stat.st_ino, stat.st_mtime_ns
+
+
+class DatasetHandle:
+    """
+    Lazy handle to a parquet dataset of the catalog; nothing is read until read/read_table
+
+    Parameters:
+        name (str): name of the dataset (file name without .parquet)
+        layer (str): 'processed' or 'extracted'
+        folder (Path): folder of the file
+        cache (ColumnCache): cache shared by the catalog
+    """
+    def __init__(self, name: str, layer: str, folder: Path, cache: ColumnCache):
+        self.name = name
+        self.layer = layer
+        self.path = Path(folder) / f"{name}.parquet"
+        self.folder = Path(folder)
+        self._cache = cache
+        self._dataset = None
+        self._dictionary_partitions = []
+        self._opened_version = None
+
+    def _open(self):
+        version = _version(self.path)
+        if self._dataset is None or version != self._opened_version:
+            self._dataset, self._dictionary_partitions = open_dataset(
+                self.name, self.folder, filesystem=pa_fs.LocalFileSystem(use_mmap=True)
+            )
+            self._opened_version = version
+        return self._dataset
+
+    @property
+    def schema(self):
+        return self._open().schema
+
+    @property
+    def columns(self):
+        return self.schema.names
+
+    @property
+    def num_rows(self):
+        # From the parquet footers, no data is read
+        return self._open().count_rows()
+
+    def read_table(self, columns: list = None, filters: list = None):
+        """
+        Read the columns (and rows matching the filters) as an Arrow table, decoding only the columns not on the cache
+
+        Parameters:
+            columns (list, optional): columns to read, all if None
+            filters (list, optional): pyarrow/pandas filters, ex.: [('order_created_date', '=', date(2019, 1, 1))]
+
+        Returns:
+            pa.Table
+        """
+        dataset = self._open()
+        columns = list(columns) if columns is not None else dataset.schema.names
+        filters_key = _filters_key(filters)
+
+        keys = {column: (self.path.as_posix(), self._opened_version, filters_key, column) for column in columns}
+        cached = {column: self._cache.get(key) for column, key in keys.items()}
+        missing = [column for column in columns if cached[column] is None]
+
+        if missing:
+            filter_expression = pq.filters_to_expression(filters) if filters else None
+            table = encode_partitions(dataset.to_table(columns=missing, filter=filter_expression), self._dictionary_partitions)
+            for column in missing:
+                cached[column] = table[column]
+                self._cache.put(keys[column], table[column])
+            logger.info(f"Read {len(missing)} column(s) of {self.name} from disk, {len(columns) - len(missing)} from the cache")
+
+        # Keeping the schema metadata, so parquet_to_pandas restores the same types as read_data
+        schema = pa.schema([pa.field(column, cached[column].type) for column in columns], metadata=dataset.schema.metadata)
+        return pa.Table.from_arrays([cached[column] for column in columns], schema=schema)
+
+    def read(self, columns: list = None, filters: list = None):
+        """
+        Same as read_table, as a pandas DataFrame (as read_data)
+        """
+        return parquet_to_pandas(self.read_table(columns, filters))
+
+    def head(self, n: int = 5, columns: list = None):
+        """
+        First n rows, reading only the first batch (not cached)
+        """
+        return parquet_to_pandas(encode_partitions(self._open().head(n, columns=columns), self._dictionary_partitions))
+
+    def profile(self):
+        """
+        Profile of the columns written by the ETL next to the processed files (see column_profile.py), no data is read
+        """
+        return read_profile(self.name, self.folder)
+
+    def __repr__(self):
+        return f"DatasetHandle({self.layer}/{self.name})"
+
+
+
+#==============================
+# Catalog
+#==============================
+class Catalog:
+    """
+    Every dataset of the extracted and processed folders
+
+    Usage:
+        catalog = Catalog(root='..')  # from the notebooks folder
+        df_orders = catalog['orders_processed'].read(columns=['customer_id', 'order_total_amount'])
+        df_ab_raw = catalog['extracted/ab_test'].read()  # a name on both layers is the processed one by default
+        catalog['orders_processed'].profile().summary()  # nulls, distinct, min/max of every column, without reading it
+
+    Parameters:
+        root (Path): folder that has the data folder
+        memory_budget (int): bytes of decoded columns kept on the cache
+    """
+    def __init__(self, root: Path = Path("."), memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self.root = Path(root)
+        self.cache = ColumnCache(memory_budget)
+        self._handles = {}
+
+    def _folders(self):
+        return {layer: self.root / folder for layer, folder in LAYERS.items()}
+
+    def names(self):
+        """
+        Datasets found on each layer
+
+        Returns:
+            dict: layer -> sorted list of names
+        """
+        return {
+            layer: sorted(path.name[:-len('.parquet')] for path in folder.glob('*.parquet')) if folder.exists() else []
+            for layer, folder in self._folders().items()
+        }
+
+    def get(self, name: str, layer: str = None):
+        """
+        Handle of a dataset
+
+        Parameters:
+            name (str): name of the dataset, or 'layer/name'
+            layer (str, optional): 'processed' or 'extracted'; by default the first of LAYERS that has the name
+
+        Returns:
+            DatasetHandle
+        """
+        if '/' in name:
+            layer, name = name.split('/', 1)
+        folders = self._folders()
+        layers = [layer] if layer else list(folders)
+        for candidate in layers:
+            if candidate not in folders:
+                raise KeyError(f"Unknown layer '{candidate}', use one of {list(folders)}")
+            if (folders[candidate] / f"{name}.parquet").exists():
+                key = (candidate, name)
+                if key not in self._handles:
+                    self._handles[key] = DatasetHandle(name, candidate, folders[candidate], self.cache)
+                return self._handles[key]
+        raise KeyError(f"Dataset '{name}' not found on {layers}, available: {self.names()}")
+
+    def read(self, name: str, columns: list = None, filters: list = None):
+        """
+        Shortcut of get(name).read(columns, filters)
+        """
+        return self.get(name).read(columns, filters)
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        try:
+            self.get(name)
+            return True
+        except KeyError:
+            return False
+
+    def __repr__(self):
+        return f"Catalog({self.root}, {self.names()}, {self.cache})"
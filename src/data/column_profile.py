@@ -0,0 +1,531 @@
+# Column Profile
+# Profile of every column of the processed datasets, computed by load_data/ChunkWriter while the data is written
+#   Before, the exploratory notebook ran info(), isnull().sum(), describe(), value_counts() and nunique() over the full
+#   datasets on every session, each one a full scan
+#   Each column keeps small mergeable sketches, updated chunk by chunk from the unique values of the chunk (one Arrow
+#   hash pass per column): null count, min/max, distinct count (HyperLogLog), quantiles (t-digest) and the most frequent
+#   values (Misra-Gries). They are saved as a json sidecar next to the parquet output, read with read_profile
+#   Ids and personal data are profiled without their values (the sidecar is plain text), and raw JSON only by its nulls
+
+import base64
+import json
+import logging
+import zlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pathlib import Path
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('column_profile')
+
+PROFILE_SUFFIX = '.profile.json'
+
+HLL_PRECISION = 12        # 2^12 registers, ~1.6% standard error of the distinct count
+TDIGEST_DELTA = 200       # Compression of the t-digest: exact up to 2 * delta values, then ~delta/2 centroids
+TOP_K_CAPACITY = 1_000    # Counters of the Misra-Gries summary, exact while the column has fewer distinct values
+TOP_K_SAVED = 100         # Most frequent values kept on the sidecar
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# Columns profiled without min/max, quantiles and top values (only rows, nulls and the distinct count): personal data
+#   of the customers; the ids ('id' and '*_id') are redacted too
+REDACTED_COLUMNS = [
+    'cpf', 'customer_name', 'customer_phone_number', 'customer_note', 'delivery_address_latitude',
+    'delivery_address_longitude', 'delivery_address_zip_code'
+]
+# Raw JSON strings, profiled as the nested columns (only rows and nulls)
+JSON_COLUMNS = ['items']
+
+
+
+#==============================
+# Sketches
+#==============================
+class HyperLogLog:
+    """
+    Distinct count of a column in 2^precision bytes; two sketches merge with the max of the registers
+
+    The values are hashed with pd.util.hash_array (64 bits): the first bits choose the register and it keeps the
+    largest position of the first 1 bit on the others
+    """
+    def __init__(self, precision: int = HLL_PRECISION, registers: np.ndarray = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else np.zeros(2 ** precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes: np.ndarray):
+        hashes = hashes.astype(np.uint64, copy=False)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = (hashes << np.uint64(self.precision)) | np.uint64(1 << (self.precision - 1))
+        # Position of the first 1 bit of the remaining bits (1-based); the extra bit bounds it when all are 0
+        rank = (64 - np.floor(np.log2(rest.astype(np.float64)))).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other: 'HyperLogLog'):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if raw <= 2.5 * m and zeros:
+            # Linear counting on small cardinalities
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': base64.b64encode(zlib.compress(self.registers.tobytes())).decode()}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        registers = np.frombuffer(zlib.decompress(base64.b64decode(data['registers'])), dtype=np.uint8).copy()
+        return cls(data['precision'], registers)
+
+
+class TDigest:
+    """
+    Quantiles of a numeric column from weighted centroids, denser on the tails
+
+    The centroids are the exact values with their counts until there are more than 2 * delta (low cardinality columns keep
+    the same quantiles of pandas), then neighbours are merged while their cumulative weight is on the same unit of the
+    arcsine scale function (vectorized, one sort + np.bincount)
+    """
+    def __init__(self, delta: int = TDIGEST_DELTA, means: np.ndarray = None, weights: np.ndarray = None, compressed: bool = False):
+        self.delta = delta
+        self.means = means if means is not None else np.empty(0, dtype=np.float64)
+        self.weights = weights if weights is not None else np.empty(0, dtype=np.float64)
+        self.compressed = compressed
+
+    def add(self, values: np.ndarray, weights: np.ndarray):
+        self.means = np.concatenate([self.means, values.astype(np.float64)])
+        self.weights = np.concatenate([self.weights, weights.astype(np.float64)])
+        self._compress()
+
+    def merge(self, other: 'TDigest'):
+        self.compressed |= other.compressed
+        self.add(other.means, other.weights)
+        return self
+
+    def _compress(self):
+        order = np.argsort(self.means, kind='stable')
+        means, weights = self.means[order], self.weights[order]
+        if not self.compressed:
+            # Same value on different chunks is still one centroid
+            unique, start = np.unique(means, return_index=True)
+            means, weights = unique, np.add.reduceat(weights, start) if len(weights) else weights
+        if len(means) <= 2 * self.delta:
+            self.means, self.weights = means, weights
+            return
+
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.delta / (2 * np.pi) * np.arcsin(2 * q - 1)
+        cluster = np.floor(k - k[0]).astype(np.int64)
+        sums = np.bincount(cluster, weights=weights)
+        keep = sums > 0
+        self.means = (np.bincount(cluster, weights=weights * means)[keep] / sums[keep])
+        self.weights = sums[keep]
+        self.compressed = True
+
+    def quantile(self, q, minimum: float, maximum: float):
+        """
+        Values of the quantiles q (float or list)
+
+        Exact values: the linear interpolation of pd.Series.quantile; merged centroids: interpolated between their
+        cumulative midpoints and the min/max
+        """
+        if not len(self.means):
+            return np.full(np.shape(q), np.nan)
+        total = self.weights.sum()
+        cumulative = np.cumsum(self.weights)
+        if not self.compressed:
+            position = np.asarray(q) * (total - 1)
+            lower = self.means[np.searchsorted(cumulative, np.floor(position), side='right')]
+            upper = self.means[np.minimum(np.searchsorted(cumulative, np.ceil(position), side='right'), len(self.means) - 1)]
+            return lower + (upper - lower) * (position - np.floor(position))
+
+        mids = cumulative - self.weights / 2
+        xp = np.concatenate([[0], mids, [total]])
+        fp = np.concatenate([[minimum], self.means, [maximum]])
+        return np.interp(np.asarray(q) * total, xp, fp)
+
+    def to_dict(self):
+        return {'delta': self.delta, 'compressed': self.compressed, 'means': self.means.tolist(), 'weights': self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data['delta'], np.array(data['means'], dtype=np.float64), np.array(data['weights'], dtype=np.float64),
+                   data['compressed'])
+
+
+class TopK:
+    """
+    Most frequent values with the Misra-Gries summary: up to capacity counters, mergeable
+
+    When there are more values than counters, the count of the (capacity + 1)th is subtracted from all and the values
+    left at zero are dropped; a kept count is at most `error` below the true one (exact while error is 0)
+    """
+    def __init__(self, capacity: int = TOP_K_CAPACITY, counts: dict = None, error: int = 0):
+        self.capacity = capacity
+        self.counts = counts if counts is not None else {}
+        self.error = error
+
+    def _cut(self, counts: np.ndarray):
+        # Count of the (capacity + 1)th most frequent value
+        return int(np.partition(counts, len(counts) - self.capacity - 1)[len(counts) - self.capacity - 1])
+
+    def add(self, values: pa.Array, counts: np.ndarray):
+        """
+        Add the counts of the unique values of a chunk; only the top of the chunk is converted to python
+        """
+        if len(counts) > self.capacity:
+            cut = self._cut(counts)
+            keep = np.flatnonzero(counts > cut)
+            values, counts = values.take(pa.array(keep)), counts[keep] - cut
+            self.error += cut
+        self._merge_counts(values.to_pylist(), counts)
+
+    def merge(self, other: 'TopK'):
+        self.error += other.error
+        self._merge_counts(list(other.counts), np.array(list(other.counts.values()), dtype=np.int64))
+        return self
+
+    def _merge_counts(self, values: list, counts: np.ndarray):
+        merged = dict(self.counts)
+        for value, count in zip(values, counts.tolist()):
+            merged[value] = merged.get(value, 0) + count
+        if len(merged) > self.capacity:
+            cut = self._cut(np.fromiter(merged.values(), dtype=np.int64, count=len(merged)))
+            merged = {value: count - cut for value, count in merged.items() if count > cut}
+            self.error += cut
+        self.counts = merged
+
+    @property
+    def exact(self):
+        return self.error == 0
+
+    def top(self, k: int = TOP_K_SAVED):
+        # Ties by value, so the same data gives the same sidecar whatever the chunks
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+
+#==============================
+# Column profiler
+#==============================
+def _kind(dtype: pa.DataType):
+    # Sketches of each type: numbers and temporals get quantiles, everything with a hash kernel gets distinct/top values
+    if pa.types.is_dictionary(dtype):
+        return _kind(dtype.value_type)
+    if pa.types.is_nested(dtype):
+        return 'nested'
+    if pa.types.is_timestamp(dtype) or pa.types.is_date(dtype):
+        return 'temporal'
+    if pa.types.is_integer(dtype) or pa.types.is_floating(dtype):
+        return 'numeric'
+    return 'categorical'
+
+
+def _to_json(value):
+    # Min, max and top values on the sidecar: temporals as ISO strings, numpy/arrow scalars as python values
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class ColumnProfiler:
+    """
+    Sketches of one column, updated with each chunk
+
+    Parameters:
+        dtype (pa.DataType): type of the column
+        redacted (bool): keep only the counts (rows, nulls, distinct), no value of the column goes to the sidecar
+        nested (bool): profile as a nested column (only rows and nulls), ex.: raw JSON strings
+    """
+    def __init__(self, dtype: pa.DataType, redacted: bool = False, nested: bool = False):
+        self.dtype = dtype
+        self.kind = 'nested' if nested else _kind(dtype)
+        self.redacted = redacted
+        self.rows = 0
+        self.nulls = 0
+        self.minimum = None
+        self.maximum = None
+        self.hll = HyperLogLog()
+        self.tdigest = TDigest() if self.kind in ('numeric', 'temporal') and not redacted else None
+        self.top_k = TopK() if self.kind != 'nested' and not redacted else None
+
+    def update(self, column):
+        """
+        Add a chunk of the column (pa.Array or pa.ChunkedArray)
+        """
+        self.rows += len(column)
+        self.nulls += column.null_count
+        if self.kind == 'nested' or len(column) == column.null_count:
+            return
+
+        # One hash pass: unique values and their counts, the sketches only see the uniques
+        value_counts = pc.value_counts(column)
+        values, counts = value_counts.field('values'), value_counts.field('counts')
+        valid = pc.is_valid(values)
+        values, counts = values.filter(valid), counts.filter(valid).to_numpy()
+        if pa.types.is_dictionary(values.type):
+            values = values.cast(values.type.value_type)
+        if pa.types.is_floating(values.type):
+            not_nan = pc.invert(pc.is_nan(values))
+            values, counts = values.filter(not_nan), counts[not_nan.to_numpy(zero_copy_only=False)]
+        if not len(values):
+            return
+
+        if not self.redacted:
+            min_max = pc.min_max(values)
+            minimum, maximum = min_max['min'].as_py(), min_max['max'].as_py()
+            self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+            self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+        numbers = self._numbers(values)
+        # The values are already unique, no need of the factorize of hash_array
+        self.hll.add_hashes(pd.util.hash_array(numbers if numbers is not None else values.to_numpy(zero_copy_only=False), categorize=False))
+        if self.tdigest is not None:
+            self.tdigest.add(numbers, counts)
+        if self.top_k is not None:
+            self.top_k.add(values, counts)
+
+    def _numbers(self, values: pa.Array):
+        # Numeric view of the values: temporals as their integer (on the unit of the type), None for the others
+        if self.kind == 'temporal':
+            return values.cast(pa.int32() if pa.types.is_date32(values.type) else pa.int64()).to_numpy(zero_copy_only=False)
+        if self.kind == 'numeric':
+            return values.to_numpy(zero_copy_only=False)
+        return None
+
+    def to_dict(self):
+        data = {
+            'type': str(self.dtype),
+            'kind': self.kind,
+            'redacted': self.redacted,
+            'rows': self.rows,
+            'nulls': self.nulls,
+            'min': _to_json(self.minimum),
+            'max': _to_json(self.maximum),
+            'distinct': self.distinct,
+            'distinct_exact': self.top_k is not None and self.top_k.exact,
+            'hll': self.hll.to_dict()
+        }
+        if self.tdigest is not None:
+            data['tdigest'] = self.tdigest.to_dict()
+        if self.top_k is not None:
+            data['top_values'] = [[_to_json(value), count] for value, count in self.top_k.top()]
+            data['top_error'] = self.top_k.error
+        return data
+
+    @property
+    def distinct(self):
+        # The Misra-Gries counters are every value while they never overflowed: exact count, otherwise HyperLogLog
+        if self.top_k is not None and self.top_k.exact:
+            return len(self.top_k.counts)
+        return self.hll.estimate()
+
+
+def is_redacted(name: str, redacted_columns: list = REDACTED_COLUMNS):
+    """
+    If a column is profiled without its values: the ones of redacted_columns and the ids
+    """
+    return name in redacted_columns or name == 'id' or name.endswith('_id')
+
+
+class DatasetProfiler:
+    """
+    Profiles of every column of an output, updated with each chunk written
+
+    Usage:
+        profiler = DatasetProfiler()
+        for table in chunks:
+            profiler.update(table)
+        profiler.save(profile_path('orders_processed'))
+
+    Parameters:
+        redacted_columns (list): columns profiled without their values, besides the ids (see is_redacted)
+        json_columns (list): raw JSON columns, profiled only by their rows and nulls
+    """
+    def __init__(self, redacted_columns: list = REDACTED_COLUMNS, json_columns: list = JSON_COLUMNS):
+        self.redacted_columns = list(redacted_columns)
+        self.json_columns = list(json_columns)
+        self.columns = {}
+
+    def update(self, table: pa.Table):
+        for name in table.column_names:
+            if name not in self.columns:
+                self.columns[name] = ColumnProfiler(
+                    table.schema.field(name).type, redacted=is_redacted(name, self.redacted_columns), nested=name in self.json_columns
+                )
+            self.columns[name].update(table[name])
+
+    def to_dict(self):
+        return {name: column.to_dict() for name, column in self.columns.items()}
+
+    def save(self, path: Path):
+        """
+        Write the sidecar, replacing the previous one only after the write
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(json.dumps({'columns': self.to_dict()}))
+        tmp_path.replace(path)
+        return path
+
+
+
+#==============================
+# Reading the profiles
+#==============================
+def profile_path(file_name: str, folder: Path):
+    """
+    Path of the sidecar of an output (ex.: data/processed/orders_processed.profile.json)
+    """
+    return Path(folder) / f"{file_name}{PROFILE_SUFFIX}"
+
+
+class DatasetProfile:
+    """
+    Profile of a dataset read from its sidecar; answers the exploratory checks without reading the data
+
+    Usage:
+        profile = read_profile('orders_processed')
+        profile.summary()                   # info() + isnull().sum() + nunique() + min/max
+        profile.describe()                  # describe() of the numeric and temporal columns
+        profile.value_counts('origin_platform')
+        profile.quantiles('order_total_amount', [0.9, 0.99])
+
+    Parameters:
+        columns (dict): profile of each column, as saved by DatasetProfiler
+    """
+    def __init__(self, columns: dict):
+        self.columns = columns
+
+    def _unit(self, column: str):
+        # Unit of the integers of a temporal column, and if it is a timestamp with time zone
+        dtype = self.columns[column]['type']
+        if dtype.startswith('date'):
+            return ('D' if dtype.startswith('date32') else 'ms'), False
+        return dtype.split('[')[1].split(',')[0].rstrip(']'), 'tz=' in dtype
+
+    def _to_number(self, column: str, value: str):
+        # Integer of an ISO temporal (min/max of the sidecar) on the unit of the column
+        unit, _ = self._unit(column)
+        if unit == 'D':
+            return (pd.Timestamp(value) - pd.Timestamp('1970-01-01')).days
+        return int(pd.Timestamp(value).as_unit(unit).value)
+
+    def summary(self):
+        """
+        One row per column: type, rows, nulls, null rate, distinct count (exact or estimated), min and max
+
+        Returns:
+            pd.DataFrame
+        """
+        rows = []
+        for column, info in self.columns.items():
+            rows.append({
+                'column': column,
+                'type': info['type'],
+                'rows': info['rows'],
+                'nulls': info['nulls'],
+                'null_rate': info['nulls'] / info['rows'] if info['rows'] else np.nan,
+                'distinct': info['distinct'] if info['kind'] != 'nested' else np.nan,
+                'distinct_exact': info['distinct_exact'],
+                'min': info['min'],
+                'max': info['max']
+            })
+        return pd.DataFrame(rows).set_index('column')
+
+    def nulls(self):
+        """
+        Null count of each column, as df.isnull().sum()
+        """
+        return pd.Series({column: info['nulls'] for column, info in self.columns.items()}, name='nulls')
+
+    def quantiles(self, column: str, q=QUANTILES):
+        """
+        Approximate quantiles (t-digest) of a numeric or temporal column
+
+        Returns:
+            pd.Series: value of each quantile
+        """
+        info = self.columns[column]
+        if 'tdigest' not in info:
+            raise ValueError(f"Column '{column}' has no quantiles, it is {'redacted' if info.get('redacted') else info['kind']}")
+        minimum, maximum = info['min'], info['max']
+        if info['kind'] == 'temporal' and minimum is not None:
+            minimum, maximum = self._to_number(column, minimum), self._to_number(column, maximum)
+        values = TDigest.from_dict(info['tdigest']).quantile(np.atleast_1d(q), minimum, maximum)
+        if info['kind'] == 'temporal':
+            unit, utc = self._unit(column)
+            values = pd.to_datetime(values.round().astype(np.int64), unit=unit, utc=utc)
+        return pd.Series(values, index=np.atleast_1d(q), name=column)
+
+    def describe(self):
+        """
+        describe() of the numeric and temporal columns, without mean and std: count, min, quartiles and max
+
+        Returns:
+            pd.DataFrame: one column per profiled column
+        """
+        described = {}
+        for column, info in self.columns.items():
+            if 'tdigest' not in info:
+                continue
+            quantiles = self.quantiles(column, [0.25, 0.5, 0.75])
+            minimum, maximum = info['min'], info['max']
+            if info['kind'] == 'temporal' and minimum is not None:
+                minimum, maximum = pd.Timestamp(minimum), pd.Timestamp(maximum)
+            described[column] = pd.Series(
+                [info['rows'] - info['nulls'], minimum, *quantiles.tolist(), maximum],
+                index=['count', 'min', '25%', '50%', '75%', 'max']
+            )
+        return pd.DataFrame(described)
+
+    def value_counts(self, column: str, k: int = 20):
+        """
+        Most frequent values of a column, as value_counts().head(k)
+
+        The counts are exact when the column has up to TOP_K_CAPACITY distinct values; otherwise each one may be
+        up to `top_error` (on the profile) below the true count
+
+        Returns:
+            pd.Series: count of each value, descending
+        """
+        info = self.columns[column]
+        if 'top_values' not in info:
+            raise ValueError(f"Column '{column}' has no top values, it is {'redacted' if info.get('redacted') else info['kind']}")
+        top = info['top_values'][:k]
+        return pd.Series([count for _, count in top], index=pd.Index([value for value, _ in top], name=column), name='count')
+
+    def __repr__(self):
+        return f"DatasetProfile({len(self.columns)} columns)"
+
+
+def read_profile(file_name: str, folder: Path = Path("data/processed")):
+    """
+    Read the profile sidecar of an output
+
+    Parameters:
+        file_name (str): name of the output, without extension (ex.: 'orders_processed')
+        folder (Path): folder of the output
+
+    Returns:
+        DatasetProfile
+    """
+    path = profile_path(file_name, folder)
+    if not path.exists():
+        raise FileNotFoundError(f"No profile for {file_name} on {folder}, run the ETL (main.py) to create it")
+    return DatasetProfile(json.loads(path.read_text())['columns'])
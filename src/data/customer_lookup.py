@@ -0,0 +1,361 @@
+# Customer Lookup
+# Experiment group, hybrid segment and RFM metrics of a customer, served from a compact index of the processed outputs
+#   Before, answering "what does customer X have" meant loading ab_test, the orders and the RFM of notebooks/03_segmentations.ipynb
+#   into pandas and filtering them
+#   Here build_customer_index writes one record per customer, sorted by customer_id (data/processed/customer_index.parquet);
+#   CustomerIndex keeps the ids as a sorted fixed width array and the columns as numpy arrays, so a lookup is a binary search
+#   (np.searchsorted) plus one position on each column. The index is replaced in place after each ETL run and picked up by
+#   the running readers; serve() exposes it on a local HTTP endpoint, with batched lookups
+
+import argparse
+import json
+import logging
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote
+
+from src.data.data_load import read_data, processed_dir
+from src.analysis.segmentation import customer_aggregates, segment_customers
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('customer_lookup')
+
+INDEX_NAME = 'customer_index'
+RECORD_COLUMNS = ['is_target', 'hybrid_segment', 'recency_days', 'frequency', 'avg_order_value', 'total_spend',
+                  'first_order_at', 'last_order_at']
+ORDER_COLUMNS = ['customer_id', 'order_id', 'order_created_at', 'order_total_amount']
+
+RELOAD_INTERVAL = 1.0   # Seconds between the checks of a new index on disk
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_BATCH = 10000       # Ids per request of the HTTP endpoint
+
+
+
+#==============================
+# Build the index
+#==============================
+def customer_records(orders: pd.DataFrame, ab_test: pd.DataFrame, analysis_end_date=None):
+    """
+    One record per customer of the A/B test or of the orders: group, hybrid segment and RFM metrics
+
+    Parameters:
+        orders (pd.DataFrame): orders with ORDER_COLUMNS
+        ab_test (pd.DataFrame): customer_id and is_target
+        analysis_end_date (Timestamp, optional): reference of the recency, defaults to the last order
+
+    Returns:
+        pd.DataFrame: customer_id and RECORD_COLUMNS, sorted by customer_id (missing values where a customer has no orders
+            or is out of the A/B test)
+    """
+    aggregates = customer_aggregates(orders)
+    rfm = segment_customers(aggregates=aggregates, analysis_end_date=analysis_end_date).set_index('customer_id')
+    rfm[['first_order_at', 'last_order_at']] = aggregates[['first_order_at', 'last_order_at']]
+
+    groups = ab_test.drop_duplicates(subset='customer_id').set_index('customer_id')['is_target']
+    records = rfm.join(groups, how='outer')
+    records.index.name = 'customer_id'
+    records[['recency_days', 'frequency']] = records[['recency_days', 'frequency']].astype('Int64')  # NA out of the orders
+    return records[RECORD_COLUMNS].sort_index().reset_index()
+
+
+def build_customer_index(folder: Path = processed_dir, path: Path = None, analysis_end_date=None):
+    """
+    Write the index of the customers from the processed outputs, replacing the previous one in place
+
+    The new index is written on a temporary file and renamed over the old one, so a reader never sees a partial file
+
+    Parameters:
+        folder (Path): folder of the processed orders_processed and ab_test
+        path (Path, optional): index file, defaults to <folder>/customer_index.parquet
+        analysis_end_date (Timestamp, optional): reference of the recency
+
+    Returns:
+        Path: path of the index
+    """
+    path = Path(path or Path(folder) / f"{INDEX_NAME}.parquet")
+    orders = read_data('orders_processed', columns=ORDER_COLUMNS, folder=folder)
+    ab_test = read_data('ab_test', columns=['customer_id', 'is_target'], folder=folder)
+    records = customer_records(orders, ab_test, analysis_end_date)
+
+    table = pa.Table.from_pandas(records, preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), b'built_at': pd.Timestamp.now(tz='UTC').isoformat().encode()}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+    tmp_path.replace(path)
+
+    logger.info(f"Built the index of {len(records)} customers on {path}")
+    return path
+
+
+
+#==============================
+# Lookups
+#==============================
+def _version(path: Path):
+    # Changes when the index is replaced (see build_customer_index)
+    stat = path.stat()
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _column_reader(column: pa.ChunkedArray):
+    # Function of a position -> python value of the column (None if null), from compact numpy arrays
+    column = column.combine_chunks()
+    if pa.types.is_dictionary(column.type):
+        codes = column.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+        categories = column.dictionary.to_pylist()
+        return lambda i: categories[codes[i]] if codes[i] >= 0 else None
+
+    valid = column.is_valid().to_numpy(zero_copy_only=False)
+    if pa.types.is_timestamp(column.type):
+        values = column.cast(pa.int64()).fill_null(0).to_numpy()
+        tz = column.type.tz
+        return lambda i: pd.Timestamp(int(values[i]), unit=column.type.unit, tz=tz) if valid[i] else None
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        values = column.to_numpy(zero_copy_only=False)
+        return lambda i: values[i] if valid[i] else None
+
+    if pa.types.is_integer(column.type):
+        column = column.fill_null(0)  # Keeps the ints (a column with nulls would become float)
+    elif pa.types.is_boolean(column.type):
+        column = column.fill_null(False)
+    values = column.to_numpy(zero_copy_only=False)
+    return lambda i: values[i].item() if valid[i] else None
+
+
+class CustomerIndex:
+    """
+    Read only lookups of customer records by customer_id, from the file of build_customer_index
+
+    The ids are kept as a sorted numpy array of fixed width bytes, searched with np.searchsorted; the columns as numpy
+    arrays (codes + categories for the categorical ones). Every RELOAD_INTERVAL seconds at most, a lookup checks if the file
+    was replaced and loads the new index, so a long running reader follows the ETL runs
+
+    Usage:
+        index = CustomerIndex()
+        index.get('abc...')                   # {'customer_id': 'abc...', 'is_target': 'target', 'hybrid_segment': ..., ...} or None
+        index.get_many(['abc...', 'def...'])  # list of records, None where the id is unknown
+
+    Parameters:
+        path (Path): index file
+        reload_interval (float): seconds between the checks of a new file, None to never reload
+    """
+    def __init__(self, path: Path = processed_dir / f"{INDEX_NAME}.parquet", reload_interval: float = RELOAD_INTERVAL):
+        self.path = Path(path)
+        self.reload_interval = reload_interval
+        self._state = None
+        self._version = None
+        self._checked = 0.0
+        self._load()
+
+    def _load(self):
+        version = _version(self.path)
+        table = pq.read_table(self.path)
+        ids = table['customer_id'].to_numpy(zero_copy_only=False)
+        try:
+            keys = ids.astype('S')   # 1 byte per character (the ids are hex hashes)
+        except UnicodeEncodeError:
+            keys = ids.astype('U')
+        order = np.argsort(keys, kind='stable')
+        if (order != np.arange(len(order))).any():  # Sorted by the build; other files are sorted here
+            keys, table = keys[order], table.take(order)
+
+        columns = {name: _column_reader(table[name]) for name in table.column_names if name != 'customer_id'}
+        built_at = (table.schema.metadata or {}).get(b'built_at', b'').decode() or None
+        # Swapped at once, so the lookups of other threads see the old or the new index, never a mix
+        self._state = (keys, columns, built_at)
+        self._version = version
+        logger.info(f"Loaded the index of {len(keys)} customers from {self.path}")
+
+    def _maybe_reload(self):
+        if self.reload_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            if _version(self.path) != self._version:
+                self._load()
+        except FileNotFoundError:
+            logger.warning(f"{self.path} not found, keeping the loaded index")
+
+    def _keys(self, customer_ids, dtype):
+        # Ids as the dtype of the index, and if each one fits it: numpy would truncate an id longer than the width of the
+        #   index (and drop trailing NULs) into another id, and a bytes index can't encode non ASCII ids, so they are never found
+        width = dtype.itemsize if dtype.kind == 'S' else dtype.itemsize // 4
+        customer_ids = [str(customer_id) for customer_id in customer_ids]
+        fits = np.array([
+            len(customer_id) <= width and not customer_id.endswith('\x00') and (dtype.kind != 'S' or customer_id.isascii())
+            for customer_id in customer_ids
+        ], dtype=bool)
+        keys = np.asarray([customer_id if ok else '' for customer_id, ok in zip(customer_ids, fits)], dtype=dtype)
+        return keys, fits
+
+    def _positions(self, customer_ids: list):
+        keys, columns, _ = state = self._state
+        searched, fits = self._keys(customer_ids, keys.dtype)
+        positions = np.searchsorted(keys, searched)
+        found = fits & (positions < len(keys))
+        found[found] = keys[positions[found]] == searched[found]
+        return state, positions, found
+
+    def _record(self, customer_id: str, columns: dict, position: int):
+        record = {'customer_id': customer_id}
+        for name, read in columns.items():
+            record[name] = read(position)
+        return record
+
+    def get(self, customer_id: str):
+        """
+        Record of a customer
+
+        Parameters:
+            customer_id (str): id of the customer
+
+        Returns:
+            dict | None: customer_id and the columns of the index (None where missing), None if the id is unknown
+        """
+        self._maybe_reload()
+        (_, columns, _), positions, found = self._positions([customer_id])
+        return self._record(customer_id, columns, positions[0]) if found[0] else None
+
+    def get_many(self, customer_ids: list):
+        """
+        Records of many customers, with one vectorized search
+
+        Parameters:
+            customer_ids (list): ids of the customers
+
+        Returns:
+            list: a record (see get) or None for each id, in the same order
+        """
+        self._maybe_reload()
+        customer_ids = [str(customer_id) for customer_id in customer_ids]
+        if not customer_ids:
+            return []
+        (_, columns, _), positions, found = self._positions(customer_ids)
+        return [self._record(customer_id, columns, position) if is_found else None
+                for customer_id, position, is_found in zip(customer_ids, positions, found)]
+
+    def info(self):
+        """
+        Returns:
+            dict: path, amount of customers and build time of the loaded index
+        """
+        keys, _, built_at = self._state
+        return {'path': str(self.path), 'customers': len(keys), 'built_at': built_at}
+
+    def __len__(self):
+        return len(self._state[0])
+
+    def __contains__(self, customer_id):
+        return self.get(customer_id) is not None
+
+    def __repr__(self):
+        return f"CustomerIndex({self.path}, {len(self)} customers)"
+
+
+
+#==============================
+# HTTP endpoint
+#==============================
+class _LookupHandler(BaseHTTPRequestHandler):
+    # GET /health, GET /customers/<customer_id> and POST /customers {"customer_ids": [...]}
+    index: CustomerIndex = None
+
+    def _send(self, status: int, body: dict):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            return self._send(200, self.index.info())
+        if self.path.startswith('/customers/'):
+            customer_id = unquote(self.path[len('/customers/'):])
+            record = self.index.get(customer_id)
+            return self._send(200, record) if record else self._send(404, {'error': f"Unknown customer {customer_id}"})
+        return self._send(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/customers':
+            return self._send(404, {'error': f"Unknown path {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            customer_ids = body['customer_ids']
+            if not isinstance(customer_ids, list):
+                raise TypeError("customer_ids must be a list")
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, {'error': f"Expected {{\"customer_ids\": [...]}}: {e}"})
+        if len(customer_ids) > MAX_BATCH:
+            return self._send(400, {'error': f"At most {MAX_BATCH} ids per request, got {len(customer_ids)}"})
+        return self._send(200, {'records': self.index.get_many(customer_ids)})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_server(index: CustomerIndex = None, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    """
+    HTTP server of the lookups (one thread per request); serve_forever() starts it
+
+    Parameters:
+        index (CustomerIndex, optional): index to serve, defaults to the one of data/processed
+        host (str): interface to listen on, local only by default
+        port (int): port to listen on
+
+    Returns:
+        ThreadingHTTPServer: server, with the index on server.index
+    """
+    index = index or CustomerIndex()
+    handler = type('LookupHandler', (_LookupHandler,), {'index': index})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.index = index
+    return server
+
+
+def serve(index: CustomerIndex = None, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    """
+    Serve the lookups on http://<host>:<port> until interrupted (see _LookupHandler for the routes)
+    """
+    server = make_server(index, host, port)
+    logger.info(f"Serving {server.index} on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Customer lookups over the processed outputs")
+    parser.add_argument('command', choices=['build', 'serve'], help="build the index, or serve it on a local HTTP endpoint")
+    parser.add_argument('--folder', default=str(processed_dir), help="Folder of the processed outputs and of the index")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    index_file = Path(args.folder) / f"{INDEX_NAME}.parquet"
+    if args.command == 'build':
+        build_customer_index(Path(args.folder), index_file)
+    else:
+        serve(CustomerIndex(index_file), args.host, args.port)
@@ -5,10 +5,20 @@ import gzip
 import tarfile
 import json
 import pandas as pd
-import requests
 import logging
 from pathlib import Path
 import io
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+
+from src.data.data_load import write_options, write_parquet, parquet_writer
+from src.data.downloader import download
+from src.data.instrumentation import stage
+from src.data.schemas import SCHEMAS, pandas_dtypes, parse_schema, enforce_schema, schema_report, to_pandas, unify_dictionaries, cast_chunk
 
 #==============================
 # Define constants
@@ -22,6 +32,16 @@ URLS = {
     'ab_test.tar.gz': "https://data-architect-test-source.s3-sa-east-1.amazonaws.com/ab_test_ref.tar.gz"
 }
 
+# Declared schema of the order fields, used by the arrow json decoder (see src/data/schemas.py)
+#   Fields not declared there (ex.: items) are still inferred by pyarrow
+ORDERS_SCHEMA = SCHEMAS['orders']
+
+JSON_BLOCK_SIZE = 64 * 1024 * 1024  # Bytes of uncompressed json handled by each parsing task
+JSON_WORKERS = os.cpu_count() or 4
+
+CSV_BLOCK_SIZE = 16 * 1024 * 1024   # Bytes of csv held per record batch when streaming the tar members
+CSV_CHUNK_ROWS = 500_000            # Rows per chunk of the pandas fallback of the tar members
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -38,43 +58,478 @@ def download_file(url: str, filename:str, dir:Path=raw_dir):
     """
     Download files from web
 
+    The download is resumable and verified before being renamed to its final path, see src/data/downloader.py
+
     Parameters:
         url: the link for the file
         filename: name of the file
         dir: directory to save
     
     returns:
-        It downloads the file and return the path that was saved
+        Path: path of the file (downloaded now or before), or None if the download failed
     """
-    filepath = dir / filename
-
     try:
-        if os.path.exists(filepath):
-            logger.info(f"File already exists: {filepath}")
-            return True
-    
-        else:
-            # GET request to get data from S3
-            response = requests.get(url, stream=True)
-            # Raise an exception if the HTTP request returned an unsuccessful status code
-            response.raise_for_status()    
-
-            with open(filepath, 'wb') as f:
-                # Open the file with "write - binary" mode and write each 8192 bytes
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            return filepath
+        return download(url, Path(dir) / filename)
 
     except Exception as e:
         logger.error(f"Error downloading file {url}: {e}")
-        return False
+        return None
+
+
+
+#==============================
+# Decode json lines
+#==============================
+def _iter_json_blocks(path_read: Path, block_size: int = JSON_BLOCK_SIZE):
+    """
+    Read a gzip json lines file in large blocks, always cutting at the end of a line
+
+    Parameters:
+        path_read: path of the .json.gz file
+        block_size: amount of uncompressed bytes per block
+
+    Returns:
+        Generator of bytes, each one holding only complete lines
+    """
+    remainder = b''
+    with gzip.open(path_read, 'rb') as f:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            last_break = chunk.rfind(b'\n')
+            if last_break == -1:
+                remainder = chunk
+                continue
+            remainder = chunk[last_break + 1:]
+            yield chunk[:last_break + 1]
+
+    if remainder.strip():
+        yield remainder
+
+
+def _encode_dictionaries(table: pa.Table, schema: pa.Schema):
+    """
+    Dictionary encode the columns declared as dictionaries on the schema (parsers only produce their values)
+    """
+    for field in schema:
+        if pa.types.is_dictionary(field.type) and field.name in table.column_names:
+            index = table.column_names.index(field.name)
+            table = table.set_column(index, field.name, pc.dictionary_encode(table[field.name]).cast(field.type))
+    return table
+
+
+def _parse_json_block(block: bytes, schema: pa.Schema):
+    """
+    Parse one block of json lines into an Arrow table
+
+    Parameters:
+        block: bytes with complete json lines
+        schema: declared schema (registry types), undeclared fields are inferred
+
+    Returns:
+        tuple: (pa.Table, amount of bad lines skipped)
+    """
+    # The json parser doesn't build dictionaries, parsing the strings and encoding them after
+    parse_options = pa_json.ParseOptions(explicit_schema=parse_schema(schema), unexpected_field_behavior='infer')
+    # Each task is already running in its own thread, so pyarrow doesn't need to open more threads
+    read_options = pa_json.ReadOptions(use_threads=False, block_size=max(len(block), 1))
+
+    try:
+        table = pa_json.read_json(io.BytesIO(block), read_options=read_options, parse_options=parse_options)
+        return _encode_dictionaries(table, schema), 0
+
+    except pa.ArrowInvalid:
+        # Only fall to python in the blocks that have bad lines, keeping the good lines of the block
+        good_lines = []
+        bad_lines = 0
+        for line in block.splitlines():
+            if not line.strip():
+                continue
+            try:
+                json.loads(line)
+                good_lines.append(line)
+            except json.JSONDecodeError:
+                bad_lines += 1
+
+        table = pa_json.read_json(io.BytesIO(b'\n'.join(good_lines) + b'\n'), read_options=read_options, parse_options=parse_options)
+        return _encode_dictionaries(table, schema), bad_lines
+
+
+def read_json_lines(path_read: Path, schema: pa.Schema = ORDERS_SCHEMA, block_size: int = JSON_BLOCK_SIZE, max_workers: int = JSON_WORKERS):
+    """
+    Decode a gzip json lines file into a DataFrame using multiple threads
+
+    The gzip stream is read in large blocks (the decompression itself is sequential), 
+    and each block is parsed into an Arrow record batch by a pool of threads; pyarrow releases the GIL while parsing
+
+    Parameters:
+        path_read: path of the .json.gz file
+        schema: declared schema of the fields
+        block_size: amount of uncompressed bytes per block
+        max_workers: amount of threads parsing blocks
+
+    Returns:
+        pd.DataFrame: same frame of the python decoder (pd.DataFrame of the records with the registry types)
+
+    Raises:
+        pa.ArrowInvalid: if a block has values that doesn't match the schema
+    """
+    tables = []
+    bad_lines = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = []
+        for block in _iter_json_blocks(path_read, block_size):
+            pending.append(executor.submit(_parse_json_block, block, schema))
+
+            # Bounding the amount of blocks in memory waiting to be parsed
+            if len(pending) >= max_workers * 2:
+                table, bad = pending.pop(0).result()
+                tables.append(table)
+                bad_lines += bad
+
+        for future in pending:
+            table, bad = future.result()
+            tables.append(table)
+            bad_lines += bad
+
+    if bad_lines:
+        logger.warning(f"Skipped {bad_lines} invalid json lines in {path_read}")
+
+    if not tables:
+        return pd.DataFrame()
+
+    # Fields that were all null in a block are inferred as null type, promoting them to the type of the other blocks
+    table = pa.concat_tables(tables, promote_options='default')
+
+    return to_pandas(table.select(_file_column_order(path_read, table.column_names)))
+
+
+def _file_column_order(path_read: Path, columns: list):
+    """
+    Column order of the json lines file (as pd.DataFrame(records) does), the declared fields come first on arrow
+    """
+    first_record = {}
+    with gzip.open(path_read, 'rt', encoding='utf-8') as f:
+        for line in f:
+            try:
+                first_record = json.loads(line)
+                break
+            except json.JSONDecodeError:
+                continue
+    ordered = [col for col in first_record if col in columns]
+    return ordered + [col for col in columns if col not in ordered]
+
+
+
+#==============================
+# Read with the schema registry
+#==============================
+def read_csv_with_schema(source, dataset: str, **kwargs):
+    """
+    Read a csv applying the registry types at read time
+
+    Parameters:
+        source: path or buffer of the csv
+        dataset: name of the dataset on the schema registry
+        **kwargs: other arguments of pd.read_csv (ex.: compression)
+
+    Returns:
+        pd.DataFrame
+    """
+    try:
+        return pd.read_csv(source, dtype=pandas_dtypes(dataset), **kwargs)
+
+    except (ValueError, TypeError) as e:
+        # A value that doesn't fit the declared type: reading with the default inference and converting after
+        logger.warning(f"Could not read {dataset} with the registry types, converting after the read: {e}")
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return enforce_schema(pd.read_csv(source, **kwargs), dataset)
+
+
+def log_schema_report(df: pd.DataFrame, dataset: str):
+    """
+    Log the bytes saved per column by the registry types
+
+    Parameters:
+        df: DataFrame read with the registry types
+        dataset: name of the dataset
+    """
+    report = schema_report(df)
+    for row in report.itertuples():
+        logger.info(f"{dataset}.{row.column} ({row.dtype}): {row.bytes:,} bytes, {row.bytes_saved:,} bytes saved")
+    logger.info(f"{dataset}: {report['bytes'].sum():,} bytes, {report['bytes_saved'].sum():,} bytes saved in total")
+
+
+
+#==============================
+# Stream tar members
+#==============================
+class _ForwardReader(io.RawIOBase):
+    # Forward-only view of a tar member: the members of a streamed archive can't seek, and pd.read_csv asks for it
+    def __init__(self, file):
+        self.file = file
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.file.readinto(buffer)
+
+
+def _iter_csv_batches(file, dataset: str, engine: str = 'arrow'):
+    """
+    Read a csv file object in record batches, without holding the whole file in memory
+
+    Parameters:
+        file: file object of the csv (ex.: a tar member)
+        dataset: name of the dataset on the schema registry
+        engine: 'arrow' (streaming reader) or 'pandas' (chunked pd.read_csv, converting each chunk with enforce_schema)
+
+    Returns:
+        Generator of pa.Table with the registry types
+    """
+    schema = SCHEMAS.get(dataset, pa.schema([]))
+
+    if engine == 'arrow':
+        convert_options = pa_csv.ConvertOptions(column_types=parse_schema(schema))
+        reader = pa_csv.open_csv(file, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE), convert_options=convert_options)
+        for batch in reader:
+            yield _encode_dictionaries(pa.Table.from_batches([batch]), schema)
+
+    elif engine == 'pandas':
+        for chunk in pd.read_csv(io.BufferedReader(_ForwardReader(file)), chunksize=CSV_CHUNK_ROWS):
+            yield pa.Table.from_pandas(enforce_schema(chunk, dataset), preserve_index=False)
+
+    else:
+        raise ValueError("Invalid engine. Use 'arrow' or 'pandas'.")
+
+
+def _iter_tar_csv(path_read: Path, dataset: str, members: list, prefix: str = 'ab', member_column: str = None, engine: str = 'arrow'):
+    """
+    Read the matching csv members of a tar (or tar.gz) archive in record batches
+
+    The archive is read sequentially (tarfile stream mode, no random access by getmembers), so the memory stays
+    the same regardless of the archive size
+
+    Parameters:
+        path_read: path of the archive
+        dataset: name of the dataset on the schema registry
+        members: list that gets the name, size and rows of each member read
+        prefix, member_column, engine: as stream_tar_csv
+
+    Returns:
+        Generator of pa.Table with the registry types
+    """
+    with tarfile.open(path_read, 'r|*') as tar:
+        for member in tar:
+            name = Path(member.name).name
+            if not (member.isfile() and name.endswith('.csv') and name.startswith(prefix)):
+                continue
+
+            rows = 0
+            file = tar.extractfile(member)
+            for table in _iter_csv_batches(file, dataset, engine):
+                if member_column:
+                    table = table.append_column(member_column, pa.array([member.name] * table.num_rows).dictionary_encode())
+                rows += table.num_rows
+                yield table
+
+            members.append({'name': member.name, 'size': member.size, 'rows': rows})
+            logger.info(f"Read {rows} rows of the member {member.name}")
+
+    if not members:
+        raise ValueError(f"No csv member starting with '{prefix}' found in {path_read}")
+
+
+def stream_tar_csv(path_read: Path, output_path: Path, dataset: str, prefix: str = 'ab', member_column: str = None, engine: str = 'arrow'):
+    """
+    Stream the matching csv members of a tar (or tar.gz) archive into a single parquet file
+
+    Each member is read in record batches written right away, so the memory stays the same regardless of the archive size.
+    All the matching members are concatenated; the name and rows of each one are saved on the parquet metadata
+    ('source_members'), and optionally on a column
+
+    Parameters:
+        path_read: path of the archive
+        output_path: path of the parquet file to write
+        dataset: name of the dataset on the schema registry
+        prefix: start of the name of the members to read
+        member_column: name of a column to add with the member of each row, None to not add it
+        engine: csv reader, 'arrow' or 'pandas' (see _iter_csv_batches)
+
+    Returns:
+        list: dicts with name, size and rows of each member read
+    """
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    options = write_options(dataset, 'extracted')
+    members = []
+    writer = None
+
+    try:
+        for table in _iter_tar_csv(path_read, dataset, members, prefix, member_column, engine):
+            if writer is None:
+                writer = parquet_writer(tmp_path, table.schema, options)
+            writer.write_table(table.cast(writer.schema), row_group_size=options['row_group_size'])
+
+        if writer is None:
+            raise ValueError(f"No rows on the csv members of {path_read}")
+        writer.add_key_value_metadata({'source_members': json.dumps(members)})
+        writer.close()
+        writer = None
+        tmp_path.replace(output_path)
+        return members
+
+    finally:
+        if writer is not None:
+            writer.close()
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def read_tar_csv(path_read: Path, dataset: str, prefix: str = 'ab', member_column: str = None, engine: str = 'arrow'):
+    """
+    Read the matching csv members of a tar archive into a single table, without writing the extracted parquet
+
+    Parameters:
+        as stream_tar_csv, without output_path
+
+    Returns:
+        tuple: (pa.Table, list of the members read)
+    """
+    members = []
+    tables = list(_iter_tar_csv(path_read, dataset, members, prefix, member_column, engine))
+    if not tables:
+        raise ValueError(f"No rows on the csv members of {path_read}")
+    schema = tables[0].schema
+    return pa.concat_tables([table.cast(schema) for table in tables]), members
+
+
+
+#==============================
+# Extract in chunks
+#==============================
+def _csv_chunk_rows(path_read: Path, chunk_bytes: int, sample_bytes: int = 1024 * 1024):
+    # Rows of csv text that fit in chunk_bytes, from the line size of the start of the file
+    with gzip.open(path_read, 'rb') as f:
+        sample = f.read(sample_bytes)
+    return max(1_000, chunk_bytes * max(sample.count(b'\n'), 1) // max(len(sample), 1))
+
+
+def iter_extract_chunks(file_name: str, file_type: str, chunk_bytes: int, read_path: Path = raw_dir, csv_dtypes: bool = True):
+    """
+    Read a gzip csv or json lines file in chunks, each with the same types extract_files gives to the whole file
+
+    Parameters:
+        file_name: name of the file to be extracted
+        file_type: 'gzip_csv' or 'gzip_json'
+        chunk_bytes: uncompressed bytes per chunk (about the memory of each chunk)
+        read_path: folder of the file
+        csv_dtypes: read the csv with the registry types (False: default inference, converted by enforce_schema)
+
+    Returns:
+        Generator of pd.DataFrame
+    """
+    path_read = read_path / file_name
+    dataset = file_name.split('.')[0]
+
+    if file_type == 'gzip_csv':
+        rows = _csv_chunk_rows(path_read, chunk_bytes)
+        dtype = pandas_dtypes(dataset) if csv_dtypes else None
+        for chunk in pd.read_csv(path_read, dtype=dtype, compression='gzip', chunksize=rows):
+            yield chunk if csv_dtypes else enforce_schema(chunk, dataset)
+
+    elif file_type == 'gzip_json':
+        schema = SCHEMAS[dataset]
+        columns = None
+        bad_lines = 0
+        for block in _iter_json_blocks(path_read, chunk_bytes):
+            try:
+                table, bad = _parse_json_block(block, schema)
+            except pa.ArrowInvalid as e:
+                # Values that don't match the schema: the python decoder on this block only
+                logger.warning(f"Arrow json decoder failed on a block of {file_name}, using the python decoder: {e}")
+                records = [json.loads(line) for line in block.splitlines() if line.strip()]
+                yield enforce_schema(pd.DataFrame(records), dataset)
+                continue
+            bad_lines += bad
+            columns = columns or _file_column_order(path_read, table.column_names)
+            yield to_pandas(table.select([col for col in columns if col in table.column_names]))
+
+        if bad_lines:
+            logger.warning(f"Skipped {bad_lines} invalid json lines in {path_read}")
+
+    else:
+        raise ValueError("Invalid file type. Use 'gzip_csv' or 'gzip_json', tar_csv files are streamed by stream_tar_csv.")
+
+
+def extract_chunked(file_name: str, file_type: str, chunk_bytes: int, read_path: Path = raw_dir, extract_path: Path = extract_dir):
+    """
+    Extract a raw file to the extracted parquet holding only one chunk in memory (out-of-core mode of main.py)
+
+    Parameters:
+        file_name: name of the file to be extracted
+        file_type: file format, as extract_files
+        chunk_bytes: uncompressed bytes per chunk
+        read_path: folder of the file
+        extract_path: folder of the extracted parquet
+
+    Returns:
+        int: rows extracted
+    """
+    dataset = file_name.split('.')[0]
+    output_path = Path(extract_path) / f"{dataset}.parquet"
+
+    if file_type == 'tar_csv':
+        try:
+            members = stream_tar_csv(read_path / file_name, output_path, dataset)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            logger.warning(f"Could not stream {file_name} with the registry types, converting each chunk: {e}")
+            members = stream_tar_csv(read_path / file_name, output_path, dataset, engine='pandas')
+        return sum(member['rows'] for member in members)
+
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    options = write_options(dataset, 'extracted')
+    try:
+        for csv_dtypes in [True, False]:
+            rows = 0
+            writer = None
+            try:
+                for chunk in iter_extract_chunks(file_name, file_type, chunk_bytes, read_path, csv_dtypes):
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = parquet_writer(tmp_path, unify_dictionaries(table).schema, options)
+                    writer.write_table(cast_chunk(table, writer.schema), row_group_size=options['row_group_size'])
+                    rows += len(chunk)
+                break
+            except (ValueError, TypeError) as e:
+                # A csv value that doesn't fit the declared type (same fallback of read_csv_with_schema)
+                if file_type != 'gzip_csv' or not csv_dtypes:
+                    raise
+                logger.warning(f"Could not read {dataset} with the registry types, converting each chunk: {e}")
+            finally:
+                if writer is not None:
+                    writer.close()
+    except Exception:
+        # The writer is closed here, the partial file can be removed (also on Windows)
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    tmp_path.replace(output_path)
+    logger.info(f"Extraction completed: {output_path}, {rows} rows in chunks of {chunk_bytes / 1024 ** 2:.0f}MB")
+    return rows
 
 
 
 #==============================
 # Extract compressed files
 #==============================
-def extract_files(file_name:str, file_type:str, read_path:Path=raw_dir, extract_path:Path=extract_dir):
+def extract_files(file_name:str, file_type:str, read_path:Path=raw_dir, extract_path:Path=extract_dir, json_decoder:str='arrow', report_schema:bool=False,
+                  write_extracted:bool=True):
     """
     Process gzipped files
 
@@ -83,30 +538,37 @@ def extract_files(file_name:str, file_type:str, read_path:Path=raw_dir, extract_
         file_type: file format 
         read_path: path - path of the file to be read
         extract_path: path - path of the extraction folder -> send to "extracted folder" 
+        json_decoder: decoder used on 'gzip_json' files, 'arrow' (multi-threaded) or 'python' (line by line)
+        report_schema: log the bytes saved per column by the registry types (src/data/schemas.py)
+        write_extracted: write the extracted parquet; False only returns the DataFrame (nothing reads the extracted copy)
 
     Returns:
         Extract file in the "data/extracted/" folder as parquet to standardize, optimize space and performance
-        Also, return a pd.DataFrame
+        (written once, with the encoding of write_options(dataset, 'extracted'))
+        Also, return a pd.DataFrame; errors are logged and raised
 
     """
     # "Universal" variables
     path_read = read_path / file_name
-    path_extract = str(extract_path / file_name[:-7])
+    dataset = file_name.split('.')[0]  # Name of the dataset on the schema registry
+    path_extract = Path(extract_path) / f"{dataset}.parquet"
+    options = write_options(dataset, 'extracted')
 
     try:
-        if os.path.exists(path_extract):
-            logger.info(f"Extracted file already exists: {path_extract}")
-            return True
-    
+        # Skipping an extraction already done is decided by the run manifest (src/data/manifest.py) on main.py
         #=================================
         # Extract if the compacted file is a gzip csv
         #=================================
-        elif file_type == 'gzip_csv':
+        if file_type == 'gzip_csv':
             logger.info(f"Extracting {file_name} to {path_extract}")
-            df = pd.read_csv(path_read, compression='gzip')
+            df = read_csv_with_schema(path_read, dataset, compression='gzip')
             
-            df.to_parquet(path_extract + ".parquet", index=False, compression="gzip")
-            logger.info(f"Extraction completed: {path_extract} + '.parquet'")           
+            if report_schema:
+                log_schema_report(df, dataset)
+
+            if write_extracted:
+                write_parquet(df, path_extract, options)
+                logger.info(f"Extraction completed: {path_extract}")
             
             return df
 
@@ -116,22 +578,40 @@ def extract_files(file_name:str, file_type:str, read_path:Path=raw_dir, extract_
         #=================================
         elif file_type == 'gzip_json':
             logger.info(f"Extracting {file_name} to {path_extract}")
-            # Read file .gz and process json line by lineLer o arquivo .gz e processar JSON linha por linha            
-            records = []
-            with gzip.open(path_read, 'rt', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        # Parsear cada linha como um objeto JSON
-                        record = json.loads(line.strip())
-                        records.append(record)
-                    except json.JSONDecodeError as e:
-                        print(f"Erro ao processar linha: {e}")
-
-            # Convert to DF
-            df = pd.DataFrame(records)
-
-            logger.info(f"Extraction completed: {path_extract}" + 'parquet')
-            df.to_parquet(path_extract + 'parquet', index=False, compression="gzip")
+            df = None
+            if json_decoder == 'arrow':
+                try:
+                    with stage('parse_json') as record:
+                        df = read_json_lines(path_read, SCHEMAS[dataset])
+                        record.set(rows_out=len(df))
+                except pa.ArrowInvalid as e:
+                    logger.warning(f"Arrow json decoder failed for {file_name}, falling back to the python decoder: {e}")
+
+            if df is None:
+                # Read file .gz and process json line by line
+                records = []
+                bad_lines = 0
+                with gzip.open(path_read, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            # Parse each line as a json object
+                            record = json.loads(line.strip())
+                            records.append(record)
+                        except json.JSONDecodeError:
+                            bad_lines += 1
+
+                if bad_lines:
+                    logger.warning(f"Skipped {bad_lines} invalid json lines in {path_read}")
+
+                # Convert to DF
+                df = enforce_schema(pd.DataFrame(records), dataset)
+
+            if report_schema:
+                log_schema_report(df, dataset)
+
+            if write_extracted:
+                write_parquet(df, path_extract, options)
+                logger.info(f"Extraction completed: {path_extract}")
             return df
 
 
@@ -140,23 +620,35 @@ def extract_files(file_name:str, file_type:str, read_path:Path=raw_dir, extract_
         #=================================
         elif file_type == 'tar_csv':
             logger.info(f"Extracting {file_name} to {path_extract}")
-            with tarfile.open(path_read, "r") as tar:
-                #tar.extractall(path_extract,filter=None)
-                for member in tar.getmembers():  
-                    if member.isfile() and member.name.endswith(".csv") and member.name.startswith("ab"):  # Filtra arquivos CSV
-                        file = tar.extractfile(member)  # Lê o conteúdo do arquivo dentro do .tar
-                        if file:
-                            df = pd.read_csv(io.BytesIO(file.read()))  # Converte para DataFrame
-            
-            df.to_parquet(path_extract + '.parquet', index=False, compression="gzip")
-            logger.info(f"Extraction completed: {path_extract}" + '.parquet')
-            
+            # The members are streamed to the parquet file, only the parquet is read back to memory
+            #   Without the extracted copy, the batches are concatenated in memory instead
+            engines = ['arrow', 'pandas']
+            for engine in engines:
+                try:
+                    if write_extracted:
+                        members = stream_tar_csv(path_read, path_extract, dataset, engine=engine)
+                        table = pq.read_table(path_extract)
+                    else:
+                        table, members = read_tar_csv(path_read, dataset, engine=engine)
+                    break
+                except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                    if engine == engines[-1]:
+                        raise
+                    # A value that doesn't fit the declared type: converting each chunk after the read
+                    logger.warning(f"Could not stream {file_name} with the registry types, converting each chunk: {e}")
+            logger.info(f"Extraction completed: {path_extract if write_extracted else file_name}, from {len(members)} member(s)")
+
+            df = to_pandas(table)
+            if report_schema:
+                log_schema_report(df, dataset)
+
             return df
 
     
     except Exception as e:
+        # Raised again so the stage fails on the scheduler (a partial extraction must not be used or recorded)
         logger.error(f"Error extracting file {path_extract}: {e}")
-        return False
+        raise
 
 
 
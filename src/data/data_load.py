@@ -1,26 +1,213 @@
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import logging
+import shutil
 from pathlib import Path
 
+from src.data.column_profile import DatasetProfiler, profile_path
+from src.data.instrumentation import stage
+from src.data.schemas import unify_dictionaries, cast_chunk, parquet_to_pandas
+
 logger = logging.getLogger('data_extraction')
 
 
+#==============================
+# Define constants
+#==============================
+processed_dir = Path("data/processed")
+
+# Layout of the processed files; the ones not listed are written as a single parquet file
+#   partition_cols: hive partitions (one folder per value), so reads of a day/group only open its folder
+#   sort_by: order of the rows inside each partition, making the row group statistics (min/max) selective
+#   row_group_size: rows per row group, the unit that can be skipped by the statistics
+LOAD_SPECS = {
+    'orders_processed': {
+        'partition_cols': ['order_created_date'],
+        'sort_by': ['customer_id', 'order_created_at'],
+        'row_group_size': 128_000
+    },
+    'order_items': {
+        'partition_cols': ['order_created_date'],  # Same partitions of the orders, joined on order_id
+        'sort_by': ['order_id', 'item_index'],
+        'row_group_size': 128_000
+    },
+    'orders_star': {
+        'partition_cols': [],  # One file sorted by key: the row group statistics of customer_key skip the other customers
+        'sort_by': ['customer_key', 'order_created_at'],
+        'row_group_size': 128_000
+    },
+    'merchant_locations': {
+        'partition_cols': [],
+        'sort_by': ['geo_cell'],  # Merchants of the same grid cell on the same row groups, as MerchantIndex reads them
+        'row_group_size': 128_000
+    },
+    'ab_test': {
+        'partition_cols': ['is_target'],
+        'sort_by': ['customer_id'],
+        'row_group_size': 128_000
+    }
+}
+
+# Parquet encoding of every file written by the pipeline, see write_options
+#   compression: 'zstd', 'lz4', 'snappy', 'gzip' or 'none'; compression_level: None for the default of the codec
+#   use_dictionary: dictionary encoding of the columns, True/False or a list of columns
+#   row_group_size: rows per row group (the processed files take theirs from LOAD_SPECS)
+# Keys are a layer ('extracted', 'processed') or '<layer>/<name>' to change a single output, ex.: 'processed/orders_star'
+WRITE_SPECS = {
+    'default': {
+        'compression': 'zstd',  # Smaller than snappy and much faster to write than gzip, the previous codec of the extracted files
+        'compression_level': None,
+        'use_dictionary': True,
+        'row_group_size': 128_000
+    },
+    'extracted': {
+        'compression_level': 1  # Written on every raw file change and read once by the transform: write speed first
+    },
+    'processed': {
+        'compression_level': 3  # Read many times by the notebooks
+    }
+}
+
+
+
+#==============================
+# Parquet writer
+#==============================
+def write_options(name: str, layer: str = 'processed'):
+    """
+    Parquet encoding of an output: the 'default' of WRITE_SPECS, updated by its layer and by its own entry
+
+    Parameters:
+        name (str): name of the output, without extension (ex.: 'orders' on extracted, 'orders_processed' on processed)
+        layer (str): 'extracted' or 'processed'
+
+    Returns:
+        dict: compression, compression_level, use_dictionary and row_group_size
+    """
+    options = {**WRITE_SPECS['default'], **WRITE_SPECS.get(layer, {}), **WRITE_SPECS.get(f"{layer}/{name}", {})}
+    if layer == 'processed' and LOAD_SPECS.get(name, {}).get('row_group_size'):
+        options['row_group_size'] = LOAD_SPECS[name]['row_group_size']
+    if str(options['compression']).lower() == 'none':
+        options['compression'] = None
+    return options
+
+
+def _encoding(options: dict):
+    # Arguments of pq.write_table / pq.ParquetWriter / make_write_options, without the row group size
+    return {
+        'compression': options['compression'],
+        'compression_level': options['compression_level'],
+        'use_dictionary': options['use_dictionary'],
+        'write_statistics': True
+    }
+
+
+def parquet_writer(path: Path, schema: pa.Schema, options: dict):
+    """
+    Open a ParquetWriter with the encoding of write_options (the row group size is given to each write_table)
+    """
+    return pq.ParquetWriter(Path(path).as_posix(), schema, **_encoding(options))
+
+
+def write_parquet(data, path: Path, options: dict):
+    """
+    Write a table or DataFrame as a single parquet file, replacing the previous one (file or folder) only after the write
+
+    Every extracted and processed single file goes through here, so each one is encoded once, with its write_options
+
+    Parameters:
+        data (pa.Table | pd.DataFrame): data to write; a DataFrame keeps its dtypes on the schema metadata
+        path (Path): path of the file
+        options (dict): encoding, see write_options
+
+    Returns:
+        Path: path of the file
+    """
+    path = Path(path)
+    table = pa.Table.from_pandas(data, preserve_index=False) if isinstance(data, pd.DataFrame) else data
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        pq.write_table(table, tmp_path.as_posix(), row_group_size=options['row_group_size'], **_encoding(options))
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    if path.is_dir():
+        shutil.rmtree(path)
+    tmp_path.replace(path)
+    return path
+
+
+def _dataset_write_options(options: dict):
+    # Same encoding for the files of a partitioned dataset
+    return ds.ParquetFileFormat().make_write_options(**_encoding(options))
+
+
 
 #==============================
 # Data Loading
 #==============================
-def load_data(df: pd.DataFrame, file_name:str):
+def _write_partitioned(table: pa.Table, path: Path, partition_cols: list, options: dict):
+    """
+    Write a hive partitioned dataset, replacing the previous one only after the write succeeded
+
+    Parameters:
+        table (pa.Table): data to write
+        path (Path): folder of the dataset
+        partition_cols (list): columns used as partitions
+        options (dict): encoding and row group size, see write_options
+    """
+    row_group_size = options['row_group_size']
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+
+    partitioning = ds.partitioning(pa.schema([table.schema.field(col) for col in partition_cols]), flavor='hive')
+    ds.write_dataset(
+        table,
+        tmp_path,
+        format='parquet',
+        partitioning=partitioning,
+        basename_template='part-{i}.parquet',
+        max_rows_per_group=row_group_size,
+        min_rows_per_group=min(row_group_size, 16_384),
+        max_partitions=10_000,
+        file_options=_dataset_write_options(options)
+    )
+    # Schema of the whole dataset (including the partition types), read by read_data
+    pq.write_metadata(table.schema, tmp_path / '_common_metadata')
+
+    # Removing the previous output (a folder or an old single file) only now, so a failed write keeps it
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+    tmp_path.rename(path)
+
+
+def load_data(df: pd.DataFrame, file_name:str, partition_cols:list=None, sort_by:list=None, row_group_size:int=None,
+              folder: Path = processed_dir, profile: bool = True):
     """
     Load the transformed DataFrame into a Parquet file.
 
     Parameters:
         df (pd.DataFrame): Transformed DataFrame
+        file_name (str): Name of the output, without extension
+        partition_cols (list, optional): Columns to write a hive partitioned dataset; defaults to LOAD_SPECS
+        sort_by (list, optional): Columns to sort the rows before writing; defaults to LOAD_SPECS
+        row_group_size (int, optional): Rows per row group; defaults to LOAD_SPECS
+        folder (Path): Folder of the output
+        profile (bool): Write the profile of the columns next to the output (see column_profile.py)
 
     Returns:
-        None, it loads the data into a new parquet file
+        Path: path of the parquet file (a folder if partitioned), or None if the DataFrame is empty; errors are logged and raised
     """
-    
+
     #================================
     # Verify if is a dataframe
     #================================
@@ -41,19 +228,290 @@ def load_data(df: pd.DataFrame, file_name:str):
         logger.info("Loading data into Parquet file")
 
         # Create the processed data folder if it doesn't exist
-        processed_data_folder = Path("data/processed")
+        processed_data_folder = Path(folder)
         processed_data_folder.mkdir(parents=True, exist_ok=True)
 
         filename_format = f"{file_name}.parquet"
-
-        # Save the DataFrame to a Parquet file
         parquet_file_path = processed_data_folder.joinpath(filename_format)
-        df.to_parquet(parquet_file_path.as_posix(), index=False)
+
+        load_spec = LOAD_SPECS.get(file_name, {})
+        partition_cols = partition_cols if partition_cols is not None else load_spec.get('partition_cols')
+        sort_by = sort_by if sort_by is not None else load_spec.get('sort_by')
+        options = write_options(file_name, 'processed')
+        options['row_group_size'] = row_group_size or options['row_group_size']
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if sort_by:
+            with stage('sort', rows_in=table.num_rows):
+                table = table.sort_by([(col, 'ascending') for col in sort_by])
+
+        with stage('write_parquet', rows_in=table.num_rows):
+            if partition_cols:
+                # Save as a partitioned dataset, keeping the .parquet name so pd.read_parquet on the path still works
+                _write_partitioned(table, parquet_file_path, partition_cols, options)
+            else:
+                # Save the DataFrame to a Parquet file
+                write_parquet(table, parquet_file_path, options)
+
+        if profile:
+            with stage('profile', rows_in=table.num_rows):
+                profiler = DatasetProfiler()
+                profiler.update(table)
+                profiler.save(profile_path(file_name, processed_data_folder))
+        else:
+            # A previous profile would describe other data
+            profile_path(file_name, processed_data_folder).unlink(missing_ok=True)
 
         logger.info(f"Data loaded into {parquet_file_path}")
+        return parquet_file_path
 
     except Exception as e:
+        # Raised again so the stage fails on the scheduler and the manifest doesn't record the output as fresh
         logger.error(f"Error loading data: {str(e)}")
+        raise
 
 
 
+class ChunkWriter:
+    """
+    Write a processed file from chunks, with the same layout of load_data (out-of-core mode of main.py)
+
+    Without partitions and sort, the chunks are appended to the file as they come. With partitions, each chunk is split
+    and spilled to one file per partition value; on close each partition is sorted (stable, as load_data) and written
+    to its folder, so only the largest partition is held in memory. A sort without partitions sorts the whole file on close
+
+    Usage:
+        with ChunkWriter('orders_processed') as writer:
+            for df in chunks:
+                writer.write(df)
+        path = writer.path  # None if no rows were written
+
+    Parameters:
+        file_name (str): Name of the output, without extension
+        folder (Path): Folder of the output
+        partition_cols, sort_by, row_group_size, profile: as load_data, defaults to LOAD_SPECS
+    """
+    def __init__(self, file_name: str, folder: Path = processed_dir, partition_cols: list = None, sort_by: list = None,
+                 row_group_size: int = None, profile: bool = True):
+        load_spec = LOAD_SPECS.get(file_name, {})
+        self.file_name = file_name
+        self.partition_cols = partition_cols if partition_cols is not None else load_spec.get('partition_cols') or []
+        self.sort_by = sort_by if sort_by is not None else load_spec.get('sort_by') or []
+        self.options = write_options(file_name, 'processed')
+        self.options['row_group_size'] = row_group_size or self.options['row_group_size']
+        self.row_group_size = self.options['row_group_size']
+
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.path = None
+        self.rows = 0
+        self._final_path = self.folder / f"{file_name}.parquet"
+        self._tmp_path = self._final_path.with_name(self._final_path.name + '.tmp')
+        self._spill_dir = self._final_path.with_name(self._final_path.name + '.spill')
+        self._schema = None
+        self._writers = {}  # partition values (tuple) -> ParquetWriter; () for the file without partitions
+        self._profiler = DatasetProfiler() if profile else None  # Updated with each chunk, the rows don't need the final order
+
+    def _writer(self, key: tuple):
+        if key not in self._writers:
+            if self.partition_cols or self.sort_by:
+                # Spill files are read back on close, only the final files get the encoding of write_options
+                self._spill_dir.mkdir(exist_ok=True)
+                path = self._spill_dir / f"part-{len(self._writers)}.parquet"
+                self._writers[key] = (pq.ParquetWriter(path, self._schema, write_statistics=True), path)
+            else:
+                self._writers[key] = (parquet_writer(self._tmp_path, self._schema, self.options), self._tmp_path)
+        return self._writers[key][0]
+
+    def write(self, df: pd.DataFrame):
+        """
+        Write a chunk (rows in the same order of the DataFrame given to load_data)
+        """
+        if df.empty:
+            return
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._schema is None:
+            self._schema = unify_dictionaries(table).schema
+        table = cast_chunk(table, self._schema)
+        self.rows += table.num_rows
+        if self._profiler is not None:
+            self._profiler.update(table)
+
+        if not self.partition_cols:
+            self._writer(()).write_table(table, row_group_size=None if self.sort_by else self.row_group_size)
+            return
+
+        # Rows of each partition value, keeping their order
+        codes = [
+            pc.dictionary_encode(table[col].cast(table[col].type.value_type) if pa.types.is_dictionary(table[col].type) else table[col],
+                                 null_encoding='encode').combine_chunks()
+            for col in self.partition_cols
+        ]
+        group = np.ravel_multi_index([c.indices.to_numpy(zero_copy_only=False) for c in codes], [max(len(c.dictionary), 1) for c in codes])
+        order = np.argsort(group, kind='stable')
+        starts = np.flatnonzero(np.diff(group[order], prepend=-1))
+        for start, end in zip(starts, list(starts[1:]) + [len(order)]):
+            first = order[start]
+            key = tuple(c.dictionary[c.indices[first].as_py()].as_py() for c in codes)
+            self._writer(key).write_table(table.take(order[start:end]))
+
+    def close(self):
+        """
+        Finish the file, replacing the previous output only now
+
+        Returns:
+            Path: path of the parquet file (a folder if partitioned), or None if no rows were written
+        """
+        writers, self._writers = self._writers, {}
+        for writer, _ in writers.values():
+            writer.close()
+
+        try:
+            if not writers:
+                logger.warning("No chunks with data, no data to load")
+                return None
+
+            if self.partition_cols:
+                if self._tmp_path.exists():
+                    shutil.rmtree(self._tmp_path)
+                partitioning = ds.partitioning(pa.schema([self._schema.field(col) for col in self.partition_cols]), flavor='hive')
+                for _, path in writers.values():
+                    table = pq.read_table(path)
+                    if self.sort_by:
+                        table = table.sort_by([(col, 'ascending') for col in self.sort_by])
+                    ds.write_dataset(
+                        table,
+                        self._tmp_path,
+                        format='parquet',
+                        partitioning=partitioning,
+                        basename_template='part-{i}.parquet',
+                        max_rows_per_group=self.row_group_size,
+                        min_rows_per_group=min(self.row_group_size, 16_384),
+                        existing_data_behavior='overwrite_or_ignore',
+                        use_threads=False,
+                        file_options=_dataset_write_options(self.options)
+                    )
+                    del table
+                    path.unlink()
+                pq.write_metadata(self._schema, self._tmp_path / '_common_metadata')
+
+            elif self.sort_by:
+                logger.warning(f"{self.file_name} is sorted without partitions, sorting the whole file in memory")
+                _, path = writers[()]
+                table = pq.read_table(path).sort_by([(col, 'ascending') for col in self.sort_by])
+                write_parquet(table, self._tmp_path, self.options)
+
+            if self._final_path.is_dir():
+                shutil.rmtree(self._final_path)
+            elif self._final_path.exists():
+                self._final_path.unlink()
+            self._tmp_path.rename(self._final_path)
+            self.path = self._final_path
+            if self._profiler is not None:
+                self._profiler.save(profile_path(self.file_name, self.folder))
+            else:
+                profile_path(self.file_name, self.folder).unlink(missing_ok=True)
+            logger.info(f"Data loaded into {self.path}, {self.rows} rows written in chunks")
+            return self.path
+
+        finally:
+            self._cleanup()
+
+    def _cleanup(self):
+        for writer, _ in self._writers.values():
+            writer.close()
+        self._writers = {}
+        if self._spill_dir.exists():
+            shutil.rmtree(self._spill_dir)
+        if self._tmp_path.is_dir():
+            shutil.rmtree(self._tmp_path)
+        elif self._tmp_path.exists():
+            self._tmp_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._cleanup()
+
+
+
+#==============================
+# Data Reading
+#==============================
+def open_dataset(file_name: str, folder: Path = processed_dir, filesystem=None):
+    """
+    Open a processed file as a pyarrow dataset, without reading any data
+
+    Parameters:
+        file_name (str): Name of the output, without extension (ex.: 'orders_processed')
+        folder (Path): Folder of the file
+        filesystem (pyarrow.fs.FileSystem, optional): ex.: LocalFileSystem(use_mmap=True) to memory-map the files
+
+    Returns:
+        tuple: (ds.Dataset, list of the dictionary partitions, read as their values; see encode_partitions)
+    """
+    path = Path(folder) / f"{file_name}.parquet"
+
+    if path.is_dir():
+        schema = pq.read_schema(path / '_common_metadata')
+        # Partition columns are the "column=value" folder names
+        partition_cols = []
+        first_dir = path
+        while True:
+            sub_dirs = [p for p in first_dir.iterdir() if p.is_dir() and '=' in p.name]
+            if not sub_dirs:
+                break
+            first_dir = sub_dirs[0]
+            partition_cols.append(first_dir.name.split('=')[0])
+
+        # Dictionary (category) partitions are read as their values and encoded again after the read
+        dictionary_partitions = [col for col in partition_cols if pa.types.is_dictionary(schema.field(col).type)]
+        for col in dictionary_partitions:
+            index = schema.get_field_index(col)
+            schema = schema.set(index, schema.field(col).with_type(schema.field(col).type.value_type))
+
+        partitioning = ds.partitioning(pa.schema([schema.field(col) for col in partition_cols]), flavor='hive')
+        dataset = ds.dataset(path.resolve().as_posix(), format='parquet', partitioning=partitioning, schema=schema, filesystem=filesystem)
+    else:
+        dataset = ds.dataset(path.resolve().as_posix(), format='parquet', filesystem=filesystem)
+        dictionary_partitions = []
+
+    return dataset, dictionary_partitions
+
+
+def encode_partitions(table: pa.Table, dictionary_partitions: list):
+    """
+    Encode again the dictionary partitions read as their values by open_dataset
+    """
+    for col in dictionary_partitions:
+        if col in table.column_names:
+            table = table.set_column(table.schema.get_field_index(col), col, pc.dictionary_encode(table[col]))
+    return table
+
+
+def read_data(file_name: str, columns: list = None, filters: list = None, folder: Path = processed_dir):
+    """
+    Read a processed file reading only the columns, partitions and row groups needed
+
+    Parameters:
+        file_name (str): Name of the output, without extension (ex.: 'orders_processed')
+        columns (list, optional): Columns to read, all if None
+        filters (list, optional): Predicates as pyarrow/pandas filters, ex.: [('order_created_date', '>=', date(2019, 1, 1))];
+            partitions and row groups that can't match are skipped
+        folder (Path): Folder of the file
+
+    Returns:
+        pd.DataFrame: data read
+    """
+    dataset, dictionary_partitions = open_dataset(file_name, folder)
+
+    filter_expression = pq.filters_to_expression(filters) if filters else None
+    table = encode_partitions(dataset.to_table(columns=columns, filter=filter_expression), dictionary_partitions)
+
+    logger.info(f"Read {table.num_rows} rows of {file_name}")
+    # Same dtypes of the ETL (parquet_to_pandas), whatever wrote the file
+    return parquet_to_pandas(table)
@@ -7,8 +7,16 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import logging
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from src.data.instrumentation import stage
+
 
 #==============================
 # Define constants
@@ -16,6 +24,7 @@ from pathlib import Path
 raw_dir = Path("data/raw")
 extract_dir = Path("data/extracted")
 logger = logging.getLogger('data_transformation')
+MISSING_KEY = '\x00<NA>'  # Key of the rows without a key on the on-disk dedup index
 
 
 
@@ -42,7 +51,12 @@ def handle_na_data(df:pd.DataFrame, columns, action, add_params=None):
             raise ValueError("Please, provide what will be used to fill na on 'add_param', it must be provided for the 'fill' action.")        
         
         for col in columns:
-            df[col].fillna(add_params, inplace=True)
+            # Categorical columns (see src/data/schemas.py) only accept values that are on their categories
+            if isinstance(df[col].dtype, pd.CategoricalDtype) and add_params not in df[col].cat.categories:
+                df[col] = df[col].cat.add_categories([add_params])
+
+            # Assigning back instead of the chained inplace fillna, which doesn't update df with copy-on-write
+            df[col] = df[col].fillna(add_params)
 
     
     elif action == 'drop':
@@ -58,13 +72,150 @@ def handle_na_data(df:pd.DataFrame, columns, action, add_params=None):
 #==============================
 # Convert Column Data Type
 #==============================
-def convert_column(df:pd.DataFrame, conversions:tuple):
+# Datetime formats tried, in order, on a sample of a column without an explicit format
+#   'ISO8601': native Arrow parser (ex.: 2019-01-01T10:00:00.000Z, the format of the sources), with or without zone offset
+#   strptime formats: native Arrow strptime; None: pandas inference, the last resort for any other format
+DATETIME_FORMATS = ['ISO8601', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y', '%m/%d/%Y', None]
+FORMAT_SAMPLE = 1_000  # Non null values used to detect (or check the cached) format of a column
+_detected_formats = {}  # column -> format detected on the first call, reused by the next chunks while it parses their sample
+
+
+def _arrow_values(values):
+    # Arrow values of a Series (Arrow backed columns are not copied) or of an Arrow array, as a ChunkedArray
+    if not isinstance(values, (pa.Array, pa.ChunkedArray)):
+        values = pa.array(values, from_pandas=True)
+    return pa.chunked_array([values]) if isinstance(values, pa.Array) else values
+
+
+def _parse_datetime(values: pa.ChunkedArray, fmt):
+    """
+    Parse strings with one format; values that don't match become null
+    """
+    if fmt == 'ISO8601':
+        for arrow_type in [pa.timestamp('ns', tz='UTC'), pa.timestamp('ns')]:
+            try:
+                return pc.cast(values, arrow_type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                continue
+        # Some invalid or mixed values: pandas' ISO8601 parser (also vectorized) coerces them
+        parsed = pd.to_datetime(values.to_pandas(), format='ISO8601', errors='coerce', utc=True)
+        return pa.chunked_array([pa.Array.from_pandas(parsed.astype('datetime64[ns, UTC]'))])
+
+    if fmt is None:
+        parsed = pd.to_datetime(values.to_pandas(), errors='coerce')
+        unit = 'datetime64[ns, UTC]' if getattr(parsed.dtype, 'tz', None) is not None else 'datetime64[ns]'
+        return pa.chunked_array([pa.Array.from_pandas(parsed.astype(unit))])
+
+    return pc.strptime(values, format=fmt, unit='ns', error_is_null=True)
+
+
+def datetime_format(values: pa.ChunkedArray, column: str = None):
+    """
+    Detect the datetime format of string values from a sample, caching it by column
+
+    The cached format is checked again on the sample of each call, so another column with the same name (or a change of
+    the source) detects its own format instead of turning every value into null
+
+    Parameters:
+        values (pa.ChunkedArray): strings to parse
+        column (str, optional): name used to cache the format
+
+    Returns:
+        str | None: a format of DATETIME_FORMATS
+    """
+    sample = values.drop_null().slice(0, FORMAT_SAMPLE)
+    if not len(sample):
+        return 'ISO8601'
+
+    cached = _detected_formats.get(column, 'not cached')
+    candidates = [cached] + [fmt for fmt in DATETIME_FORMATS if fmt != cached] if cached != 'not cached' else DATETIME_FORMATS
+    best, best_nulls = None, None
+    for fmt in candidates:
+        nulls = _parse_datetime(sample, fmt).null_count
+        if nulls == 0:
+            best = fmt
+            break
+        if best_nulls is None or nulls < best_nulls:
+            best, best_nulls = fmt, nulls
+
+    if column is not None and _detected_formats.get(column, 'not cached') != best:
+        logger.info(f"Datetime format of '{column}': {best if best is not None else 'inferred by pandas'}")
+        _detected_formats[column] = best
+    return best
+
+
+def parse_datetime(values, column: str = None, fmt='detect'):
+    """
+    Convert values to timestamps with a native vectorized parser (Arrow), in ns
+
+    Parameters:
+        values (pd.Series | pa.Array | pa.ChunkedArray): strings, timestamps or dates
+        column (str, optional): name of the column, used to cache its detected format
+        fmt (str, optional): format of DATETIME_FORMATS or a strptime format; 'detect' to detect it (see datetime_format)
+
+    Returns:
+        pa.ChunkedArray: timestamp[ns, tz=UTC] for values with zone offset, timestamp[ns] otherwise; invalid values are null
+    """
+    values = _arrow_values(values)
+    if pa.types.is_dictionary(values.type):
+        values = values.cast(values.type.value_type)
+
+    if pa.types.is_timestamp(values.type):
+        return values.cast(pa.timestamp('ns', tz=values.type.tz))
+    if pa.types.is_date(values.type):
+        return values.cast(pa.timestamp('ns'))
+    if not (pa.types.is_string(values.type) or pa.types.is_large_string(values.type)):
+        values = values.cast(pa.string())
+
+    return _parse_datetime(values, datetime_format(values, column) if fmt == 'detect' else fmt)
+
+
+def _convert(series: pd.Series, column: str, dtype: str, fmt):
+    """
+    Convert one column, returning the new values (without assigning them) and how many were coerced to null
+    """
+    nulls_before = int(series.isna().sum())
+
+    if dtype in ('datetime', 'date'):
+        parsed = parse_datetime(series, column, fmt)
+        if dtype == 'datetime':
+            values = parsed.to_pandas().array
+        else:
+            # date32 (pd.ArrowDtype) instead of python date objects
+            values = pd.arrays.ArrowExtensionArray(parsed.cast(pa.date32()))
+        return values, parsed.null_count - nulls_before
+
+    if dtype == 'int':
+        if pd.api.types.is_integer_dtype(series.dtype):
+            values = series.astype('Int64', copy=False)
+        else:
+            values = pd.to_numeric(series, errors='coerce').astype('Int64', copy=False)
+    elif dtype == 'float':
+        if series.dtype == np.float64:
+            values = series
+        else:
+            values = pd.to_numeric(series, errors='coerce').astype(float, copy=False)
+    elif dtype == 'str':
+        values = series.astype(str)
+    else:
+        raise ValueError(f"Unsupported dtype: {dtype}")
+
+    return values.array, int(values.isna().sum()) - nulls_before
+
+
+def convert_column(df:pd.DataFrame, conversions:tuple, formats: dict = None, max_workers: int = None):
     """
     Convert multiple columns in a DataFrame to specified data types with error handling.
 
+    The columns are converted in parallel (threads: the Arrow parsers release the GIL) and assigned at the end. Datetimes
+    use the format of `formats` or the one detected on a sample of the column (see parse_datetime); 'date' is a date32
+    column. Values that can't be converted become null, the amount of each column is logged and recorded on the stage
+
     Parameters:
         df (pd.DataFrame): The DataFrame to modify.
         conversions (list of tuples): List of (column, dtype) pairs.
+        formats (dict, optional): column -> datetime format (ex.: 'ISO8601', '%Y-%m-%d %H:%M:%S'); detected if not given
+        max_workers (int, optional): threads converting the columns; defaults to one per column, up to the cpus
 
     Returns:
         pd.DataFrame: The modified DataFrame.
@@ -84,46 +235,43 @@ def convert_column(df:pd.DataFrame, conversions:tuple):
             raise ValueError("Each item in `conversions` must be a tuple of (column, dtype).")
             
     logger.info(f"Start of the conversion of columns data type")
+    formats = formats or {}
+
+    for column, _ in conversions:
+        if column not in df.columns:
+            logger.warning(f"Column '{column}' not found in DataFrame. Skipping.")
+    conversions = [(column, dtype) for column, dtype in conversions if column in df.columns]
+    if not conversions:
+        return df
 
 
     #================================
-    # For each column + data type
+    # Convert the columns in parallel
     #================================
-    for column, dtype in conversions:
-        if column not in df.columns:
-            logging.warning(f"Column '{column}' not found in DataFrame. Skipping.")
-            continue
-
+    def convert(item):
+        column, dtype = item
         try:
-            if dtype == 'datetime':
-                df[column] = pd.to_datetime(df[column])
-                logging.info(f"Converted the column '{column}' to datetime")
-            
-            elif dtype == 'date':
-                df[column] = pd.to_datetime(df[column]).dt.date
-                logging.info(f"Converted the column '{column}' to date")
-            
-            elif dtype == 'int':
-                df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int64')
-                logging.info(f"Converted the column '{column}' to int")
-            
-            elif dtype == 'float':
-                df[column] = pd.to_numeric(df[column], errors='coerce').astype(float)
-                logging.info(f"Converted the column '{column}' to float")
-            
-            elif dtype == 'str':
-                df[column] = df[column].astype(str)
-                logging.info(f"Converted the column '{column}' to str")
-            
-            else:
-                logging.error(f"Unsupported dtype: {dtype} for column '{column}'")
-                raise ValueError(f"Unsupported dtype: {dtype}")
-        
+            return _convert(df[column], column, dtype, formats.get(column, 'detect'))
         except Exception as e:
-            logging.error(f"Failed to convert column '{column}' to {dtype}. Error: {e}")
+            logger.error(f"Failed to convert column '{column}' to {dtype}. Error: {e}")
             raise ValueError(f"Failed to convert column '{column}' to {dtype}. Error: {e}")
-    
-        logger.info(f"Column {column} converted to {dtype} data type")
+
+    with stage('convert_column', rows_in=len(df)) as record:
+        max_workers = max_workers or min(len(conversions), os.cpu_count() or 1)
+        if max_workers > 1 and len(conversions) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(convert, conversions))
+        else:
+            results = [convert(item) for item in conversions]
+
+        coerced = {}
+        for (column, dtype), (values, coerced_nulls) in zip(conversions, results):
+            df[column] = values
+            coerced[column] = coerced_nulls
+            if coerced_nulls:
+                logger.warning(f"{coerced_nulls} values of '{column}' could not be converted to {dtype}, now null")
+            logger.info(f"Column {column} converted to {dtype} data type")
+        record.set(coerced_nulls=coerced)
 
     return df
 
@@ -132,12 +280,90 @@ def convert_column(df:pd.DataFrame, conversions:tuple):
 #==============================
 # Remove Duplicates
 #==============================
+def dedup_order_values(values):
+    """
+    Map the values used to pick the latest row to int64, keeping their order; missing values become the lowest
+
+    Parameters:
+        values (pd.Series | np.ndarray): datetime, numeric or any sortable values
+
+    Returns:
+        np.ndarray: int64 or float64 array with the same order of the values
+    """
+    values = pd.Series(values)
+
+    if pd.api.types.is_datetime64_any_dtype(values):
+        # NaT is the lowest int64, so it never wins against a valid date (as NaT goes last on the descending sort)
+        return values.array.asi8
+
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.astype('float64').fillna(-np.inf).to_numpy()
+
+    # Other types: position on the sorted unique values
+    codes, _ = pd.factorize(values, sort=True)
+    return codes.astype('int64')
+
+
+def dedup_index_values(values):
+    """
+    Values of the dedup order for the on-disk index of remove_duplicates_chunked, comparable between chunks
+
+    The codes of dedup_order_values for other types are positions on the values of one chunk, so they can't be compared
+    with the ones of another chunk; strings are stored as they are (SQLite compares them as text)
+
+    Parameters:
+        values (pd.Series | np.ndarray): datetime, numeric, boolean or string values
+
+    Returns:
+        np.ndarray: int64 / float64 (missing values are the lowest), or object array of str (None if missing)
+    """
+    values = pd.Series(values)
+
+    if pd.api.types.is_bool_dtype(values):
+        return values.astype('float64').fillna(-np.inf).to_numpy()
+
+    if pd.api.types.is_datetime64_any_dtype(values) or pd.api.types.is_numeric_dtype(values):
+        return dedup_order_values(values)
+
+    if pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+        return values.astype(object).where(values.notna(), None).to_numpy()
+
+    raise TypeError(f"Can't keep the latest row by a {values.dtype} column in chunks, use a datetime, numeric or string column")
+
+
+def latest_per_key(keys, order_values):
+    """
+    Find the row with the highest order value of each key, with a hash group instead of a sort
+
+    Ties on the order value keep the first row (on the input order), so the result is deterministic
+
+    Parameters:
+        keys (pd.Series | np.ndarray): key of each row
+        order_values (np.ndarray): output of dedup_order_values
+
+    Returns:
+        np.ndarray: sorted positions of the rows to keep
+    """
+    # Hash the keys into dense group codes (missing keys are a group, as on drop_duplicates)
+    codes, _ = pd.factorize(pd.Series(keys), use_na_sentinel=False)
+
+    # Arg-max per group: rows that have the max of their group, then the first of them per group
+    group_max = pd.Series(order_values).groupby(codes, sort=False).transform('max').to_numpy()
+    candidates = np.flatnonzero(order_values == group_max)
+    first_candidate = ~pd.Series(codes[candidates]).duplicated().to_numpy()
+
+    return candidates[first_candidate]
+
+
 def remove_duplicates(df: pd.DataFrame, column: str, column_deduplicate: str):
     """
     Remove duplicates from a DataFrame based on another column
 
+    Keeps the latest row of each key (highest column_deduplicate) without sorting the DataFrame,
+    only the surviving rows are gathered; the rows keep the input order
+
     Parameters:
-        df (pd.DataFrame): DataFrame to remove duplicates frsom
+        df (pd.DataFrame): DataFrame to remove duplicates from
         column (str): Column to remove duplicates from
         column_deduplicate (str): Column to use for deduplication
 
@@ -146,13 +372,81 @@ def remove_duplicates(df: pd.DataFrame, column: str, column_deduplicate: str):
     """
     logger.info(f"Removing duplicates from column {column} based on {column_deduplicate}")
 
-    # Sort the DataFrame by the column_deduplicate in descending order
-    df = df.sort_values(by=column_deduplicate, ascending=False)
-
-    # Remove duplicates from the column, keeping the first occurrence (which is the most recent, with dates)
-    df = df.drop_duplicates(subset=column, keep='first')
+    keep = latest_per_key(df[column], dedup_order_values(df[column_deduplicate]))
+    df = df.take(keep)
 
     logger.info(f"Duplicates removed from column {column}")
     return df
 
 
+def remove_duplicates_chunked(read_chunks, column: str, column_deduplicate: str, index_path: Path = None):
+    """
+    Remove duplicates from data larger than memory, reading it in chunks twice
+
+    The first pass keeps a compact on-disk index (SQLite) of key -> latest order value and row position,
+    the second pass yields only the rows found on the index. Same result of remove_duplicates
+
+    Parameters:
+        read_chunks (Callable): function without arguments that returns an iterable of DataFrames (called twice)
+        column (str): Column to remove duplicates from
+        column_deduplicate (str): Column to use for deduplication
+        index_path (Path, optional): file of the index, a temporary file if None
+
+    Returns:
+        Generator of pd.DataFrame: deduplicated chunks
+    """
+    logger.info(f"Removing duplicates from column {column} based on {column_deduplicate}, in chunks")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        connection = sqlite3.connect(index_path or Path(tmp_dir) / 'dedup_index.sqlite')
+        # Closed also when the consumer stops early (the generator is closed) or a chunk fails
+        try:
+            connection.execute("DROP TABLE IF EXISTS latest")
+            # value without a declared type: keeps int64 timestamps as INTEGER (exact), numbers as REAL and strings as TEXT
+            connection.execute("CREATE TABLE latest (key TEXT PRIMARY KEY, value, position INTEGER)")
+
+            #--------------
+            # Pass 1: latest value and position of each key
+            #--------------
+            offset = 0
+            for chunk in read_chunks():
+                order_values = dedup_order_values(chunk[column_deduplicate])
+                keep = latest_per_key(chunk[column], order_values)  # Reducing the chunk before touching the index
+                # The codes of dedup_order_values are only comparable within the chunk, the index keeps comparable values
+                index_values = dedup_index_values(chunk[column_deduplicate].iloc[keep])
+
+                # Missing keys are a single group, SQLite would treat each NULL as a different key
+                keys = chunk[column].iloc[keep]
+                keys = keys.astype(str).where(keys.notna(), MISSING_KEY)
+
+                rows = zip(keys.tolist(), index_values.tolist(), (keep + offset).tolist())
+                # Replacing only by a strictly higher value keeps the first row on ties, as remove_duplicates;
+                #   a missing (NULL) value is the lowest
+                connection.executemany(
+                    """
+                    INSERT INTO latest (key, value, position) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value, position = excluded.position
+                    WHERE excluded.value > latest.value OR (latest.value IS NULL AND excluded.value IS NOT NULL)
+                    """,
+                    rows
+                )
+                offset += len(chunk)
+            connection.execute("CREATE INDEX latest_position ON latest (position)")
+            connection.commit()
+
+            #--------------
+            # Pass 2: yield the rows that are on the index
+            #--------------
+            offset = 0
+            for chunk in read_chunks():
+                positions = connection.execute(
+                    "SELECT position FROM latest WHERE position >= ? AND position < ? ORDER BY position",
+                    (offset, offset + len(chunk))
+                ).fetchall()
+                offset += len(chunk)
+                if positions:
+                    yield chunk.iloc[np.array([p for (p,) in positions]) - (offset - len(chunk))]
+        finally:
+            connection.close()
+
+    logger.info(f"Duplicates removed from column {column}")
@@ -0,0 +1,304 @@
+# Downloader
+# Concurrent, resumable and verified downloads of the raw files
+#   Before, each file was fetched with a new requests.get and written in 8KB chunks directly on its final path,
+#   so an interrupted download left a partial file that the next run treated as complete
+#   Now the data goes to <file>.part (resumed with an HTTP Range request), is checked (size, ETag/MD5, optional SHA-256)
+#   and only then renamed to the final path; <file>.download.json keeps what was verified, to skip it on the next runs
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('downloader')
+
+CHUNK_BYTES = 1024 * 1024                 # Bytes per read of the response
+WRITE_BUFFER_BYTES = 16 * 1024 * 1024     # Buffer of the file writes
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+POOL_SIZE = 8                             # Connections kept open per host, and downloads at the same time
+RETRIES = 3                               # Retries of a failed request (connection errors and 5xx), by urllib3
+RESUME_ATTEMPTS = 5                       # Resumes of a download interrupted in the middle of the body
+TIMEOUT = (10, 60)                        # Seconds to connect / between bytes
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    """
+    Download that finished but didn't pass the verification (size or checksum)
+    """
+
+
+
+#==============================
+# Session
+#==============================
+def make_session(pool_size: int = POOL_SIZE, retries: int = RETRIES):
+    """
+    Session with a pool of keep-alive connections and retries with backoff
+
+    Parameters:
+        pool_size (int): connections kept per host
+        retries (int): retries of connection errors and 5xx responses
+
+    Returns:
+        requests.Session
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504], allowed_methods=['HEAD', 'GET'])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Session shared by the downloads of this process
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+
+#==============================
+# Helpers
+#==============================
+def _part_path(path: Path):
+    return path.with_name(path.name + '.part')
+
+
+def _state_path(path: Path):
+    return path.with_name(path.name + '.download.json')
+
+
+def _read_state(path: Path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(path: Path, state: dict):
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_text(json.dumps(state, indent=2))
+    tmp_path.replace(path)
+
+
+def _md5_etag(etag: str):
+    # S3 ETag of a single part upload is the MD5 of the content; multipart ("<md5>-<parts>") and weak ETags aren't
+    etag = (etag or '').strip('"')
+    return etag.lower() if re.fullmatch(r'[0-9a-fA-F]{32}', etag) else None
+
+
+def _file_digest(path: Path, algorithm: str):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _remote_info(session: requests.Session, url: str):
+    """
+    Size, ETag and Range support of the remote file (HEAD request)
+
+    Returns:
+        dict: size (int | None), etag (str | None) and ranges (bool)
+    """
+    response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    if response.status_code in (403, 405):
+        # Servers/presigned URLs that don't allow HEAD: everything is taken from the GET
+        return {'size': None, 'etag': None, 'ranges': False}
+    response.raise_for_status()
+    size = response.headers.get('Content-Length')
+    return {
+        'size': int(size) if size is not None else None,
+        'etag': response.headers.get('ETag'),
+        'ranges': response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    }
+
+
+def _is_current(path: Path, state: dict, remote: dict):
+    # The final file is the one verified before and the remote didn't change since
+    return (
+        path.exists()
+        and state.get('size') == path.stat().st_size
+        and (remote['size'] is None or remote['size'] == state['size'])
+        and (remote['etag'] is None or remote['etag'] == state.get('etag'))
+    )
+
+
+
+#==============================
+# Download
+#==============================
+def _fetch(session: requests.Session, url: str, part: Path, remote: dict):
+    """
+    Append the missing bytes of the remote file to the part file, resuming from its size when the server allows
+
+    Returns:
+        tuple: (expected total size or None, ETag of the response)
+    """
+    part_state_path = _state_path(part)
+    offset = part.stat().st_size if part.exists() else 0
+
+    # Resume only if the part is of the same remote version
+    if offset and not (remote['ranges'] and remote['etag'] and _read_state(part_state_path).get('etag') == remote['etag']):
+        offset = 0
+    if offset and remote['size'] is not None and offset >= remote['size']:
+        return remote['size'], remote['etag']
+
+    headers = {'Range': f"bytes={offset}-", 'If-Range': remote['etag']} if offset else {}
+    with session.get(url, stream=True, headers=headers, timeout=TIMEOUT) as response:
+        if response.status_code == 416:
+            # The part doesn't fit the remote file anymore: start again
+            part.unlink(missing_ok=True)
+            return _fetch(session, url, part, {**remote, 'ranges': False})
+        response.raise_for_status()
+
+        if offset and response.status_code != 206:
+            offset = 0  # Range ignored (or If-Range didn't match): the whole file is coming
+        etag = response.headers.get('ETag', remote['etag'])
+        length = response.headers.get('Content-Length')
+        total = offset + int(length) if length is not None else remote['size']
+
+        _write_state(part_state_path, {'url': url, 'etag': etag})
+        if offset:
+            logger.info(f"Resuming {part.name} from {offset} bytes")
+        with open(part, 'ab' if offset else 'wb', buffering=WRITE_BUFFER_BYTES) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_BYTES):
+                f.write(chunk)
+
+    return total, etag
+
+
+def download(url: str, path: Path, session: requests.Session = None, sha256: str = None):
+    """
+    Download a file through <path>.part, resuming a previous partial download, and rename it when verified
+
+    A file already downloaded (and verified) is not downloaded again while the remote size/ETag don't change.
+    A file without the .download.json (ex.: from an older version of this code) is verified against the remote,
+    and resumed if it is only a part of it
+
+    Parameters:
+        url (str): link of the file
+        path (Path): final path of the file
+        session (requests.Session, optional): defaults to the shared session of the process
+        sha256 (str, optional): expected SHA-256 of the file
+
+    Returns:
+        Path: path of the verified file
+
+    Raises:
+        DownloadError: size or checksum don't match (a larger or corrupted part is deleted, a shorter one is kept to resume)
+        requests.RequestException: request errors after the retries
+    """
+    session = session or get_session()
+    path = Path(path)
+    part, state_path = _part_path(path), _state_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        remote = _remote_info(session, url)
+    except requests.RequestException as e:
+        # Offline (or a file made locally, ex.: tests/synthetic_data.py): the existing file is used as it is
+        if path.exists():
+            verified = 'verified' if _read_state(state_path) else 'not verified'
+            logger.warning(f"Can't reach {url} ({type(e).__name__}), using the existing {path} ({verified})")
+            return path
+        raise
+
+    state = _read_state(state_path)
+    if _is_current(path, state, remote):
+        logger.info(f"File already exists: {path}")
+        return path
+
+    if path.exists() and not state and not part.exists():
+        # Not verified by this downloader: continue a copy of it as a part (a complete file is only verified)
+        #   The file stays on its path until the part is verified, so a failed fetch still leaves it for the offline runs,
+        #   as a verified file of an older remote version
+        logger.info(f"Verifying {path} downloaded without a .download.json")
+        shutil.copyfile(path, part)
+        _write_state(_state_path(part), {'url': url, 'etag': remote['etag']})
+
+    #--------------
+    # Fetch, resuming when the connection drops in the middle of the body
+    #--------------
+    for attempt in range(1, RESUME_ATTEMPTS + 1):
+        try:
+            total, etag = _fetch(session, url, part, remote)
+            break
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == RESUME_ATTEMPTS:
+                raise
+            logger.warning(f"Download of {url} interrupted ({e}), resuming ({attempt}/{RESUME_ATTEMPTS - 1})")
+
+    #--------------
+    # Verify
+    #--------------
+    size = part.stat().st_size
+    if total is not None and size != total:
+        if size > total:
+            part.unlink()
+        raise DownloadError(f"{path.name}: {size} bytes downloaded, expected {total}")
+
+    checks = {'size': size, 'etag': etag}
+    md5 = _md5_etag(etag)
+    if md5 or sha256:
+        digests = {algorithm: _file_digest(part, algorithm) for algorithm, expected in [('md5', md5), ('sha256', sha256)] if expected}
+        for algorithm, expected in [('md5', md5), ('sha256', sha256)]:
+            if expected and digests[algorithm] != expected.lower():
+                part.unlink()
+                raise DownloadError(f"{path.name}: {algorithm} {digests[algorithm]} doesn't match the expected {expected}")
+        checks.update(digests)
+
+    os.replace(part, path)
+    _write_state(state_path, {'url': url, **checks})
+    _state_path(part).unlink(missing_ok=True)
+
+    logger.info(f"Downloaded {path} ({size} bytes)")
+    return path
+
+
+def download_all(urls: dict, dir: Path, max_workers: int = POOL_SIZE, session: requests.Session = None):
+    """
+    Download all the files at the same time, over the same connection pool
+
+    Parameters:
+        urls (dict): file name -> URL
+        dir (Path): folder of the files
+        max_workers (int): downloads at the same time
+        session (requests.Session, optional): defaults to the shared session of the process
+
+    Returns:
+        dict: file name -> Path, or the exception of the downloads that failed
+    """
+    session = session or get_session()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {filename: executor.submit(download, url, Path(dir) / filename, session) for filename, url in urls.items()}
+        for filename, future in futures.items():
+            try:
+                results[filename] = future.result()
+            except Exception as e:
+                logger.error(f"Error downloading {filename}: {e}")
+                results[filename] = e
+    return results
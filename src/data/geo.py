@@ -0,0 +1,283 @@
+# Geo Enrichment
+# State of the customers from their phone area code (DDD), and a spatial index of the merchants
+#   Before, notebooks/01 mapped customer_phone_area with a dict (Series.map, one python lookup per row), and the merchant
+#   coordinates were only strings on the orders, so a "restaurants near this point" question scanned every order
+#   The DDD -> state lookup is a precomputed array indexed by the codes; the merchant locations are stored on
+#   data/processed/merchant_locations.parquet with their grid cell, and MerchantIndex answers radius and nearest
+#   queries reading only the cells around the point
+
+import logging
+import math
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.data.data_load import read_data, processed_dir
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('geo')
+
+# Brazilian phone area codes (DDD) of each state
+STATE_DDD = {
+    11: "SP", 12: "SP", 13: "SP", 14: "SP", 15: "SP", 16: "SP", 17: "SP", 18: "SP", 19: "SP",
+    21: "RJ", 22: "RJ", 24: "RJ",
+    27: "ES", 28: "ES",
+    31: "MG", 32: "MG", 33: "MG", 34: "MG", 35: "MG", 37: "MG", 38: "MG",
+    41: "PR", 42: "PR", 43: "PR", 44: "PR", 45: "PR", 46: "PR",
+    47: "SC", 48: "SC", 49: "SC",
+    51: "RS", 53: "RS", 54: "RS", 55: "RS",
+    61: "DF",
+    62: "GO", 64: "GO",
+    63: "TO",
+    65: "MT", 66: "MT",
+    67: "MS",
+    68: "AC",
+    69: "RO",
+    71: "BA", 73: "BA", 74: "BA", 75: "BA", 77: "BA", 79: "SE",
+    81: "PE", 87: "PE",
+    82: "AL",
+    83: "PB",
+    84: "RN",
+    85: "CE", 88: "CE",
+    86: "PI", 89: "PI",
+    91: "PA", 93: "PA", 94: "PA",
+    92: "AM", 97: "AM",
+    95: "RR",
+    96: "AP",
+    98: "MA", 99: "MA"
+}
+STATES = sorted(set(STATE_DDD.values()))
+
+# Position on STATES of the state of each DDD (0 to 99), -1 for the codes without a state
+DDD_STATE_CODES = np.full(100, -1, dtype=np.int8)
+for _ddd, _state in STATE_DDD.items():
+    DDD_STATE_CODES[_ddd] = STATES.index(_state)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+CELL_DEGREES = 0.05  # Side of the grid cells, ~5.5km on the latitude
+
+
+
+#==============================
+# Phone area -> state
+#==============================
+def _state_codes(areas: np.ndarray):
+    # Array lookup of the state codes; NA, out of range and unassigned areas get -1
+    values = np.asarray(areas, dtype=np.float64)
+    valid = np.isfinite(values) & (values >= 0) & (values < len(DDD_STATE_CODES))
+    codes = np.full(len(values), -1, dtype=np.int8)
+    codes[valid] = DDD_STATE_CODES[values[valid].astype(np.int64)]
+    return codes
+
+
+def phone_area_state(areas: pd.Series):
+    """
+    State of each phone area code (DDD), same values of areas.map(STATE_DDD) without a python lookup per row
+
+    Parameters:
+        areas (pd.Series): area codes (ints, nullable)
+
+    Returns:
+        pd.Series: category with the states of STATES (NA for the codes without a state)
+    """
+    codes = _state_codes(areas.astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan))
+    return pd.Series(pd.Categorical.from_codes(codes, categories=STATES), index=areas.index, name=areas.name)
+
+
+def phone_area_state_arrow(areas: pa.ChunkedArray):
+    """
+    Same of phone_area_state on an Arrow column
+
+    Returns:
+        pa.ChunkedArray: dictionary (category) with the states of STATES
+    """
+    codes = _state_codes(areas.to_numpy(zero_copy_only=False) if areas.null_count == 0 else
+                         areas.cast(pa.float64()).fill_null(np.nan).to_numpy())
+    indices = pa.array(codes.astype(np.int32), mask=codes < 0)
+    return pa.chunked_array([pa.DictionaryArray.from_arrays(indices, pa.array(STATES, type=pa.string()))])
+
+
+# Lookups of the 'enrich' step of the transform specs: name -> (pandas function, arrow function)
+LOOKUPS = {
+    'phone_area_state': (phone_area_state, phone_area_state_arrow)
+}
+
+
+
+#==============================
+# Merchant locations
+#==============================
+def grid_cells(latitude: np.ndarray, longitude: np.ndarray, cell_degrees: float = CELL_DEGREES):
+    """
+    Grid cell of each point: row (latitude) * cells per row + column (longitude), so the cells of a row are consecutive
+    """
+    columns = math.ceil(360 / cell_degrees)
+    rows = np.floor((np.asarray(latitude) + 90) / cell_degrees).astype(np.int64)
+    cols = np.clip(np.floor((np.asarray(longitude) + 180) / cell_degrees).astype(np.int64), 0, columns - 1)
+    return rows * columns + cols
+
+
+def merchant_locations(orders: pd.DataFrame, cell_degrees: float = CELL_DEGREES):
+    """
+    Coordinates of each merchant from its latest order with valid coordinates
+
+    Also combines outputs of this same function (ex.: one per chunk of the orders): the latest location of each merchant wins
+
+    Parameters:
+        orders (pd.DataFrame): merchant_id, merchant_latitude, merchant_longitude and order_created_at (or located_at)
+        cell_degrees (float): side of the grid cells
+
+    Returns:
+        pd.DataFrame: merchant_id, merchant_latitude, merchant_longitude (float64), located_at and geo_cell
+    """
+    located_at = 'located_at' if 'located_at' in orders.columns else 'order_created_at'
+    df = pd.DataFrame({
+        'merchant_id': orders['merchant_id'],
+        'merchant_latitude': pd.to_numeric(orders['merchant_latitude'], errors='coerce').astype('float64'),
+        'merchant_longitude': pd.to_numeric(orders['merchant_longitude'], errors='coerce').astype('float64'),
+        'located_at': orders[located_at]
+    })
+    valid = (
+        df['merchant_id'].notna() & df['located_at'].notna()
+        & df['merchant_latitude'].between(-90, 90) & df['merchant_longitude'].between(-180, 180)
+    )
+    # Ties on the time keep the larger coordinates, so the result doesn't depend on the order of the rows
+    df = (df[valid]
+          .sort_values(['merchant_id', 'located_at', 'merchant_latitude', 'merchant_longitude'], kind='stable')
+          .drop_duplicates('merchant_id', keep='last')
+          .reset_index(drop=True))
+    df['geo_cell'] = grid_cells(df['merchant_latitude'].to_numpy(), df['merchant_longitude'].to_numpy(), cell_degrees)
+    return df
+
+
+def haversine_km(latitude: float, longitude: float, latitudes: np.ndarray, longitudes: np.ndarray):
+    """
+    Great circle distance in km from one point to many
+    """
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+
+#==============================
+# Spatial index
+#==============================
+class MerchantIndex:
+    """
+    Grid index of the merchant locations for radius and nearest queries
+
+    The merchants are sorted by grid cell; a query reads only the cells of the bounding box of its radius
+    (a binary search per row of cells) and computes the distance of those candidates, not of every merchant
+
+    Usage:
+        index = MerchantIndex.load()  # data/processed/merchant_locations.parquet
+        index.within(-23.55, -46.63, radius_km=2)
+        index.nearest(-23.55, -46.63, k=5)
+
+    Parameters:
+        locations (pd.DataFrame): merchant_id, merchant_latitude and merchant_longitude (as merchant_locations)
+        cell_degrees (float): side of the grid cells
+    """
+    def __init__(self, locations: pd.DataFrame, cell_degrees: float = CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._columns = math.ceil(360 / cell_degrees)
+        latitude = locations['merchant_latitude'].to_numpy(dtype=np.float64)
+        longitude = locations['merchant_longitude'].to_numpy(dtype=np.float64)
+        cells = grid_cells(latitude, longitude, cell_degrees)
+
+        order = np.argsort(cells, kind='stable')
+        self.cells = cells[order]
+        self.latitude = latitude[order]
+        self.longitude = longitude[order]
+        self.merchant_id = locations['merchant_id'].to_numpy()[order]
+
+    @classmethod
+    def load(cls, folder=processed_dir, cell_degrees: float = CELL_DEGREES):
+        """
+        Index of the merchant locations written by the ETL
+        """
+        return cls(read_data('merchant_locations', columns=['merchant_id', 'merchant_latitude', 'merchant_longitude'], folder=folder),
+                   cell_degrees)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def _candidates(self, latitude: float, longitude: float, radius_km: float):
+        # Positions of the merchants on the cells of the bounding box of the radius
+        delta_lat = radius_km / KM_PER_DEGREE
+        cos_lat = math.cos(math.radians(min(abs(latitude) + delta_lat, 90)))
+        delta_lon = 180 if cos_lat < 1e-9 else min(radius_km / (KM_PER_DEGREE * cos_lat), 180)
+
+        row_start = math.floor((max(latitude - delta_lat, -90) + 90) / self.cell_degrees)
+        row_end = math.floor((min(latitude + delta_lat, 90) + 90) / self.cell_degrees)
+        if delta_lon >= 180:
+            col_ranges = [(0, self._columns - 1)]
+        else:
+            col_start = math.floor((longitude - delta_lon + 180) / self.cell_degrees)
+            col_end = math.floor((longitude + delta_lon + 180) / self.cell_degrees)
+            # A box crossing the antimeridian is two ranges of columns
+            col_ranges = [(max(col_start, 0), min(col_end, self._columns - 1))]
+            if col_start < 0:
+                col_ranges.append((col_start + self._columns, self._columns - 1))
+            if col_end >= self._columns:
+                col_ranges.append((0, col_end - self._columns))
+
+        rows = np.arange(row_start, row_end + 1, dtype=np.int64)
+        lows = np.concatenate([rows * self._columns + start for start, _ in col_ranges])
+        highs = np.concatenate([rows * self._columns + end for _, end in col_ranges])
+        starts = np.searchsorted(self.cells, lows, side='left')
+        ends = np.searchsorted(self.cells, highs, side='right')
+        sizes = ends - starts
+        if not sizes.sum():
+            return np.empty(0, dtype=np.int64)
+        # Concatenated ranges starts[i]:ends[i] without a python loop per range
+        offsets = np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+        return offsets + np.arange(sizes.sum())
+
+    def within(self, latitude: float, longitude: float, radius_km: float):
+        """
+        Merchants within a radius of a point
+
+        Parameters:
+            latitude, longitude (float): point, ex.: a delivery address
+            radius_km (float): radius in km
+
+        Returns:
+            pd.DataFrame: merchant_id, merchant_latitude, merchant_longitude and distance_km, nearest first
+        """
+        candidates = self._candidates(latitude, longitude, radius_km)
+        distance = haversine_km(latitude, longitude, self.latitude[candidates], self.longitude[candidates])
+        keep = distance <= radius_km
+        candidates, distance = candidates[keep], distance[keep]
+        order = np.argsort(distance, kind='stable')
+        return pd.DataFrame({
+            'merchant_id': self.merchant_id[candidates[order]],
+            'merchant_latitude': self.latitude[candidates[order]],
+            'merchant_longitude': self.longitude[candidates[order]],
+            'distance_km': distance[order]
+        })
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1):
+        """
+        k nearest merchants of a point, searching radius that double until k merchants are inside
+
+        Returns:
+            pd.DataFrame: as within, with up to k rows
+        """
+        radius_km = self.cell_degrees * KM_PER_DEGREE
+        while True:
+            result = self.within(latitude, longitude, radius_km)
+            # Every merchant inside the radius was checked, so the k nearest of them are the k nearest overall
+            if len(result) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+                return result.head(k).reset_index(drop=True)
+            radius_km *= 2
+
+    def __repr__(self):
+        return f"MerchantIndex({len(self)} merchants, cells of {self.cell_degrees} degrees)"
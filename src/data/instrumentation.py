@@ -0,0 +1,327 @@
+# Stage Instrumentation
+# Records wall time, CPU time, peak RSS delta, rows in/out and bytes read/written of each ETL stage
+#   The records of a run are appended as json lines to data/metrics/<run_id>.jsonl, one file per run
+#   Disabled by default: stage() then only yields a shared no-op record
+
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+
+import psutil
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('instrumentation')
+
+metrics_dir = Path("data/metrics")
+SAMPLE_INTERVAL = 0.05  # Seconds between RSS samples while a stage is running
+
+# The configuration goes through environment variables so the stages on the process pool (scheduler.py) see it
+ENV_RUN_ID = 'ETL_METRICS_RUN_ID'
+ENV_DIR = 'ETL_METRICS_DIR'
+ENV_PROFILE = 'ETL_PROFILE_STAGE'
+
+_parent_stage = ContextVar('parent_stage', default=None)
+
+
+
+#==============================
+# Configuration
+#==============================
+def configure(enabled: bool = True, run_id: str = None, folder: Path = metrics_dir, profile_stage: str = None):
+    """
+    Turn the instrumentation on (or off) for this process and the processes it starts
+
+    Parameters:
+        enabled (bool): record the stages
+        run_id (str): name of the metrics file, defaults to the current timestamp
+        folder (Path): folder of the metrics files
+        profile_stage (str): full name of a stage (ex.: 'process_orders/transform') to run under cProfile,
+            the stats are saved next to the metrics file as <run_id>.<stage>.prof
+
+    Returns:
+        Path: metrics file of the run, or None if disabled
+    """
+    if not enabled:
+        for name in [ENV_RUN_ID, ENV_DIR, ENV_PROFILE]:
+            os.environ.pop(name, None)
+        return None
+
+    run_id = run_id or datetime.now().strftime('%Y%m%d_%H%M%S')
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    os.environ[ENV_RUN_ID] = run_id
+    os.environ[ENV_DIR] = str(folder)
+    if profile_stage:
+        os.environ[ENV_PROFILE] = profile_stage
+    else:
+        os.environ.pop(ENV_PROFILE, None)
+    return metrics_path()
+
+
+def enabled():
+    return ENV_RUN_ID in os.environ
+
+
+def metrics_path():
+    """
+    Path of the metrics file of the current run, or None if disabled
+    """
+    if not enabled():
+        return None
+    return Path(os.environ[ENV_DIR]) / f"{os.environ[ENV_RUN_ID]}.jsonl"
+
+
+def read_metrics(path: Path):
+    """
+    Read a metrics file as a list of records
+    """
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+
+#==============================
+# Records
+#==============================
+class StageRecord:
+    """
+    Metrics of one stage; the rows and the bytes are filled by the code of the stage
+
+    Attributes:
+        name (str): full name of the stage, nested stages are joined by '/'
+        dataset (str): dataset being processed
+        rows_in / rows_out (int): rows received and produced
+        bytes_read / bytes_written (int): size of the files read and written
+        extra (dict): any other value to record
+    """
+    def __init__(self, name: str, dataset: str = None):
+        self.name = name
+        self.dataset = dataset
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.extra = {}
+        self.peak_rss = 0
+
+    def set(self, **values):
+        """
+        Set rows_in, rows_out, bytes_read, bytes_written, or extra values
+        """
+        for key, value in values.items():
+            if hasattr(self, key) and key != 'extra':
+                setattr(self, key, value)
+            else:
+                self.extra[key] = value
+        return self
+
+
+class _NullRecord:
+    # Shared record of the disabled instrumentation, ignores everything
+    name = None
+
+    def set(self, **values):
+        return self
+
+
+NULL_RECORD = _NullRecord()
+
+
+class _RssSampler:
+    """
+    Background thread keeping the peak RSS of the running stages of this process
+    """
+    def __init__(self):
+        self.process = psutil.Process()
+        self.active = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def rss(self):
+        return self.process.memory_info().rss
+
+    def add(self, record: StageRecord):
+        record.peak_rss = self.rss()
+        with self.lock:
+            self.active.add(record)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._sample, daemon=True)
+                self.thread.start()
+
+    def remove(self, record: StageRecord):
+        rss = self.rss()
+        with self.lock:
+            self.active.discard(record)
+        record.peak_rss = max(record.peak_rss, rss)
+
+    def _sample(self):
+        while True:
+            with self.lock:
+                if not self.active:
+                    return
+                records = list(self.active)
+            rss = self.rss()
+            for record in records:
+                record.peak_rss = max(record.peak_rss, rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+
+_sampler = None
+
+
+def _io_counters(process):
+    try:
+        counters = process.io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (AttributeError, psutil.Error):
+        return None, None
+
+
+
+#==============================
+# Stage context
+#==============================
+@contextmanager
+def stage(name: str, dataset: str = None, **values):
+    """
+    Measure a block of code as a stage
+
+    Usage:
+        with stage('load', dataset='orders', rows_in=len(df)) as record:
+            path = load_data(df, 'orders_processed')
+            record.set(bytes_written=path_size(path))
+
+    A stage inside another one is recorded as '<parent>/<name>'. Exceptions are recorded (status 'failed') and raised again
+
+    Parameters:
+        name (str): name of the stage
+        dataset (str): dataset being processed
+        values: initial values of the record (rows_in, bytes_read...)
+
+    Returns:
+        StageRecord (or a no-op record if the instrumentation is disabled)
+    """
+    if not enabled():
+        yield NULL_RECORD
+        return
+
+    global _sampler
+    if _sampler is None or _sampler.process.pid != os.getpid():
+        _sampler = _RssSampler()
+
+    parent = _parent_stage.get()
+    full_name = f"{parent.name}/{name}" if parent else name
+    record = StageRecord(full_name, dataset or (parent.dataset if parent else None)).set(**values)
+    token = _parent_stage.set(record)
+
+    profiler = cProfile.Profile() if os.environ.get(ENV_PROFILE) == full_name else None
+    io_start = _io_counters(_sampler.process)
+    start_rss = _sampler.rss()
+    _sampler.add(record)
+    started_at = datetime.now()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    status = 'success'
+
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        _sampler.remove(record)
+        _parent_stage.reset(token)
+        io_end = _io_counters(_sampler.process)
+
+        entry = {
+            'run_id': os.environ.get(ENV_RUN_ID),
+            'stage': record.name,
+            'dataset': record.dataset,
+            'status': status,
+            'started_at': started_at.isoformat(),
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(cpu, 4),
+            'peak_rss_delta_mb': round((record.peak_rss - start_rss) / 1024**2, 2),
+            'rows_in': record.rows_in,
+            'rows_out': record.rows_out,
+            'bytes_read': record.bytes_read,
+            'bytes_written': record.bytes_written,
+            'io_read_bytes': io_end[0] - io_start[0] if io_start[0] is not None else None,
+            'io_write_bytes': io_end[1] - io_start[1] if io_start[1] is not None else None,
+            'pid': os.getpid(),
+            **record.extra
+        }
+        _write(entry)
+
+        if profiler:
+            profile_path = metrics_path().with_suffix(f".{record.name.replace('/', '.')}.prof")
+            profiler.dump_stats(profile_path)
+            logger.info(f"Profile of {record.name} saved on {profile_path}")
+
+
+def _write(entry: dict):
+    # One write per line on a file opened with append, so the lines of parallel stages don't mix
+    line = json.dumps(entry, default=str) + '\n'
+    with open(metrics_path(), 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+def current():
+    """
+    Record of the stage running on this context (ex.: to set the dataset of the scheduler stage), or a no-op record
+    """
+    return _parent_stage.get() or NULL_RECORD
+
+
+def path_size(path):
+    """
+    Size of a file, or of all the files of a folder (ex.: partitioned parquet); None if it doesn't exist
+    """
+    if path is None:
+        return None
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    return path.stat().st_size if path.exists() else None
+
+
+
+#==============================
+# Summary
+#==============================
+def summarize(path: Path = None):
+    """
+    Log the stages of a run, slowest first
+
+    Parameters:
+        path (Path): metrics file, defaults to the current run
+
+    Returns:
+        list: records of the run
+    """
+    path = path or metrics_path()
+    if path is None or not Path(path).exists():
+        return []
+
+    records = read_metrics(path)
+    for entry in sorted(records, key=lambda r: r['wall_seconds'], reverse=True):
+        logger.info(
+            f"{entry['stage']:<40} {entry['status']:<8} wall {entry['wall_seconds']:>8.2f}s  cpu {entry['cpu_seconds']:>8.2f}s  "
+            f"peak +{entry['peak_rss_delta_mb']:>8.1f}MB  rows {entry['rows_in']} -> {entry['rows_out']}"
+        )
+    return records
@@ -0,0 +1,161 @@
+# Run Manifest
+# Records what produced each output (hash of the inputs, transform spec and code version),
+#   so the ETL can skip the stages whose inputs didn't change since the last run
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('manifest')
+
+manifest_dir = Path("data/manifest")  # One entry file per output, so parallel stages never write the same file
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+
+#==============================
+# Hashes
+#==============================
+def file_hash(path, cache_dir: Path = manifest_dir):
+    """
+    Hash (sha256) the content of a file
+
+    The hash is cached by size and modification time, so a warm run doesn't read the raw files again
+
+    Parameters:
+        path: file to hash
+        cache_dir: directory of the manifest, where the hash cache is kept
+
+    Returns:
+        str: hex digest of the file
+    """
+    path = Path(path)
+    stat = path.stat()
+    cache_file = cache_dir / 'hashes' / (path.name + '.json')
+
+    if cache_file.exists():
+        cached = json.loads(cache_file.read_text())
+        if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+
+    _write_json(cache_file, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()})
+    return digest.hexdigest()
+
+
+def code_version(files: list):
+    """
+    Hash the source code files that produce an output, any change on them makes the output stale
+
+    Parameters:
+        files (list): paths of the source files
+
+    Returns:
+        str: hex digest of the files content
+    """
+    digest = hashlib.sha256()
+    for file in sorted(str(f) for f in files):
+        digest.update(file.encode())
+        digest.update(Path(file).read_bytes())
+    return digest.hexdigest()
+
+
+def fingerprint(**parts):
+    """
+    Combine everything that determines an output into a single hash
+
+    Parameters:
+        **parts: json serializable values (ex.: raw=file_hash(...), spec=TRANSFORM_SPECS['orders'], code=code_version([...]))
+
+    Returns:
+        str: hex digest of the parts
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+
+#==============================
+# Manifest entries
+#==============================
+def _write_json(path: Path, content: dict):
+    # Write through a temp file and rename, so an interrupted run never leaves a half written entry
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    tmp_path.write_text(json.dumps(content, indent=2))
+    os.replace(tmp_path, path)
+
+
+def _entry_path(output, manifest_path: Path):
+    # Folder + file name, as the extracted and processed outputs may share the file name (ex.: ab_test.parquet)
+    output = Path(output)
+    return manifest_path / f"{output.parent.name}__{output.name}.json"
+
+
+def _output_stat(output: Path):
+    # Size and modification time of an output, summing the files of partitioned (folder) outputs
+    if output.is_dir():
+        stats = [f.stat() for f in output.rglob('*') if f.is_file()]
+        return sum(st.st_size for st in stats), max((st.st_mtime_ns for st in stats), default=0)
+    stat = output.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def is_fresh(output, output_fingerprint: str, manifest_path: Path = manifest_dir):
+    """
+    Verify if an output was produced with the same fingerprint and wasn't changed after
+
+    Parameters:
+        output: path of the output file (or folder, for partitioned outputs)
+        output_fingerprint (str): fingerprint of the inputs of the stage
+        manifest_path (Path): manifest directory
+
+    Returns:
+        bool: True if the stage can be skipped
+    """
+    output = Path(output)
+    entry_path = _entry_path(output, manifest_path)
+    if not output.exists() or not entry_path.exists():
+        return False
+
+    entry = json.loads(entry_path.read_text())
+    size, mtime_ns = _output_stat(output)
+    return (
+        entry['fingerprint'] == output_fingerprint
+        and entry['size'] == size
+        and entry['mtime_ns'] == mtime_ns
+    )
+
+
+def record(output, output_fingerprint: str, manifest_path: Path = manifest_dir):
+    """
+    Record that an output was produced with a fingerprint
+
+    Parameters:
+        output: path of the output file
+        output_fingerprint (str): fingerprint of the inputs of the stage
+        manifest_path (Path): manifest directory
+
+    Returns:
+        None, it writes the entry of the output on the manifest directory
+    """
+    output = Path(output)
+    size, mtime_ns = _output_stat(output)
+    _write_json(_entry_path(output, manifest_path), {
+        'output': output.as_posix(),
+        'fingerprint': output_fingerprint,
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'created_at': datetime.now().isoformat()
+    })
+    logger.info(f"Manifest updated for {output}")
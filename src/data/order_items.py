@@ -0,0 +1,191 @@
+# Order Items
+# Normalizes the nested items of the orders (a json array per order) into one row per item
+#   The json of all the orders is parsed at once by the multi-threaded Arrow json reader, instead of a json.loads per row
+
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
+
+from src.data import schemas
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('order_items')
+
+ITEMS_BLOCK_SIZE = 16 * 1024 * 1024  # Bytes of json per parsing task of the Arrow reader
+ITEMS_FALLBACK_ROWS = 10_000         # Orders per block when the items have invalid values (see _parse_items_by_block)
+
+# Fields of the items read from the json; the other fields are ignored by the parser
+#   The money fields are {"value": "12.90", "currency": "BRL"}
+MONEY_FIELDS = ['unitPrice', 'addition', 'discount', 'totalValue']
+
+
+def _items_schema(value_type: pa.DataType):
+    money = pa.struct([('value', value_type)])
+    garnish = pa.struct([('name', pa.string()), ('quantity', pa.float64()), ('totalValue', money)])
+    item = pa.struct(
+        [('name', pa.string()), ('externalId', pa.string()), ('sequence', pa.int64()), ('quantity', pa.float64()),
+         ('customerNote', pa.string()), ('garnishItems', pa.list_(garnish))]
+        + [(field, money) for field in MONEY_FIELDS]
+    )
+    return pa.schema([('items', pa.list_(item))])
+
+
+
+#==============================
+# Parse items
+#==============================
+def _document(lines: pa.LargeStringArray):
+    # Values buffer of the json lines, read without copying it
+    offsets = np.frombuffer(lines.buffers()[1], dtype=np.int64)[lines.offset:lines.offset + len(lines) + 1]
+    return lines.buffers()[2][offsets[0]:offsets[-1]] if len(lines) else pa.py_buffer(b'')
+
+
+def _read_items(document, rows: int):
+    """
+    Read a json lines document of {"items": [...]}, one line per order
+
+    Parameters:
+        document: pa.Buffer or bytes of the json lines
+        rows (int): amount of orders of the document
+
+    Returns:
+        pa.ChunkedArray: list<struct> with the items of each order
+
+    Raises:
+        pa.ArrowInvalid: error of the first type of the money values, if no type reads the document
+    """
+    read_options = pa_json.ReadOptions(use_threads=True, block_size=ITEMS_BLOCK_SIZE)
+    error = None
+
+    # Money values are strings on the source, numbers are accepted too
+    for value_type in [pa.string(), pa.float64()]:
+        parse_options = pa_json.ParseOptions(explicit_schema=_items_schema(value_type), unexpected_field_behavior='ignore')
+        try:
+            items = pa_json.read_json(pa.BufferReader(document), read_options=read_options, parse_options=parse_options)['items']
+        except pa.ArrowInvalid as e:
+            error = error or e
+            continue
+        # A line break inside a value splits its order in two lines
+        if len(items) != rows:
+            error = error or pa.ArrowInvalid(f"{len(items)} json lines read for {rows} orders, a value has a line break")
+            continue
+        return items
+    raise error
+
+
+def _parse_items_by_block(lines: pa.LargeStringArray):
+    """
+    Parse the items of each block of orders, and the orders of a block that fails one by one
+
+    A value with a line break inside (ex.: a pretty printed array) is read again as a compact json; a value that is
+    not json, or doesn't match the items schema, gets null items (no items)
+
+    Parameters:
+        lines (pa.LargeStringArray): json lines {"items": [...]} of each order
+
+    Returns:
+        pa.ChunkedArray: list<struct> with the items of each order, money values as strings
+    """
+    items_type = _items_schema(pa.string()).field('items').type
+    chunks, bad_rows = [], 0
+    for start in range(0, len(lines), ITEMS_FALLBACK_ROWS):
+        block = lines.slice(start, ITEMS_FALLBACK_ROWS)
+        try:
+            chunks.extend(_read_items(_document(block), len(block)).chunks)
+            continue
+        except pa.ArrowInvalid:
+            pass
+
+        for line in block.to_pylist():
+            try:
+                chunks.extend(_read_items(json.dumps(json.loads(line)).encode() + b'\n', 1).chunks)
+            except (json.JSONDecodeError, pa.ArrowInvalid):
+                chunks.append(pa.nulls(1, items_type))
+                bad_rows += 1
+
+    if bad_rows:
+        logger.warning(f"Nulled the items of {bad_rows} orders with invalid json")
+    return pa.chunked_array([chunk.cast(items_type) for chunk in chunks], type=items_type)
+
+
+def _parse_items(items: pa.ChunkedArray):
+    """
+    Parse the json arrays of the items in one multi-threaded pass
+
+    Each value is wrapped as a json line {"items": [...]}, the values buffer of the wrapped array is then already a
+    json lines document (one order per line, in the same order), read without copying it
+    If the document can't be read (a value that is not json, has a line break or doesn't match the schema), the
+    orders are parsed by blocks instead (see _parse_items_by_block) and the invalid values get null items
+
+    Parameters:
+        items (pa.ChunkedArray): json strings of the items of each order; nulls are treated as no items
+
+    Returns:
+        pa.ChunkedArray: list<struct> with the items of each order
+    """
+    # large_string: the json of all the orders can pass the 2GB limit of the string offsets
+    items = pc.fill_null(items.cast(pa.large_string()), '[]')
+    prefix, suffix, separator = [pa.scalar(value, pa.large_string()) for value in ['{"items":', '}\n', '']]
+    lines = pc.binary_join_element_wise(prefix, items, suffix, separator).combine_chunks()
+
+    try:
+        return _read_items(_document(lines), len(lines))
+    except pa.ArrowInvalid as e:
+        logger.warning(f"Arrow json reader failed on the items ({e}), parsing them by blocks of {ITEMS_FALLBACK_ROWS} orders")
+    return _parse_items_by_block(lines)
+
+
+def explode_items(orders, keys: list = ['order_id', 'order_created_date']):
+    """
+    Build the order_items table: one row per item of each order
+
+    Parameters:
+        orders (pd.DataFrame | pa.Table): processed orders, with the items column and the keys
+        keys (list): columns of the orders repeated on each item (order_id joins back to the orders)
+
+    Returns:
+        pa.Table: keys, item_index, sequence, name, external_id, quantity, unit_price, addition, discount, total_value,
+            customer_note, garnish_count, garnish_names and garnish_total
+    """
+    table = pa.Table.from_pandas(orders[keys + ['items']], preserve_index=False) if isinstance(orders, pd.DataFrame) else orders
+    items = _parse_items(table['items']).combine_chunks()
+
+    # Order of each item, used to repeat the keys, and the position of the item inside its order
+    flat = pc.list_flatten(items)
+    order_index = pc.list_parent_indices(items).to_numpy()
+    item_index = np.arange(len(flat)) - items.offsets.to_numpy()[order_index]
+
+    columns = {key: table[key].take(order_index) for key in keys}
+    columns['item_index'] = pa.array(item_index, pa.int16())
+    columns['sequence'] = pc.struct_field(flat, 'sequence').cast(pa.int16())
+    columns['name'] = pc.dictionary_encode(pc.struct_field(flat, 'name')).cast(schemas.category)
+    columns['external_id'] = pc.struct_field(flat, 'externalId')
+    columns['quantity'] = pc.struct_field(flat, 'quantity')
+    for field, column in zip(MONEY_FIELDS, ['unit_price', 'addition', 'discount', 'total_value']):
+        columns[column] = pc.struct_field(pc.struct_field(flat, field), 'value').cast(pa.float64())
+    columns['customer_note'] = pc.struct_field(flat, 'customerNote')
+
+    # Garnishes (additions chosen for the item): amount, names and total value
+    garnishes = pc.struct_field(flat, 'garnishItems')
+    garnish_values = pc.struct_field(pc.struct_field(garnishes.values, 'totalValue'), 'value').cast(pa.float64())
+    garnish_item = np.repeat(np.arange(len(garnishes)), np.diff(garnishes.offsets.to_numpy()))
+    start = garnishes.offsets[0].as_py() if len(garnishes) else 0
+
+    columns['garnish_count'] = pc.fill_null(pc.list_value_length(garnishes), 0).cast(pa.int16())
+    columns['garnish_names'] = pa.ListArray.from_arrays(garnishes.offsets, pc.struct_field(garnishes.values, 'name'))
+    columns['garnish_total'] = pa.array(np.bincount(
+        garnish_item,
+        weights=pc.fill_null(garnish_values, 0).to_numpy()[start:start + len(garnish_item)],
+        minlength=len(garnishes)
+    ))
+
+    result = pa.table(columns)
+    logger.info(f"Exploded {table.num_rows} orders into {result.num_rows} items")
+    return result
@@ -0,0 +1,135 @@
+# Out-of-core Processing
+# Helpers of the streaming mode of main.py (main(memory_budget=...) or --memory-budget): the datasets are extracted,
+#   transformed and loaded in chunks sized by the memory budget, instead of one DataFrame with the whole dataset
+#   The dedup spills the transformed chunks to disk and uses the on-disk index of remove_duplicates_chunked,
+#   so the output is the same of the in-memory path
+
+import logging
+import re
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.data.data_transformation import remove_duplicates_chunked
+from src.data.schemas import unify_dictionaries, cast_chunk, parquet_to_pandas
+from src.data.transform_engine import apply_spec
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('out_of_core')
+
+WORKING_SET_FACTOR = 8          # Copies of a chunk alive at the same time (parsed, pandas, transformed, arrow for the writers...)
+MIN_CHUNK_BYTES = 1024 * 1024
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+
+#==============================
+# Memory budget
+#==============================
+def parse_size(size):
+    """
+    Parse a size as bytes, ex.: '512MB', '2GB', '1.5 GB' or 1073741824
+
+    Returns:
+        int: bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', str(size).upper())
+    if not match:
+        raise ValueError(f"Invalid size '{size}', use ex.: 512MB or 2GB")
+    value, unit = match.groups()
+    unit = unit if unit in SIZE_UNITS else unit + 'B'
+    return int(float(value) * SIZE_UNITS[unit])
+
+
+def chunk_bytes(memory_budget: int):
+    """
+    Bytes of data per chunk so that the working set of a stage stays within its memory budget
+    """
+    return max(MIN_CHUNK_BYTES, int(memory_budget) // WORKING_SET_FACTOR)
+
+
+
+#==============================
+# Chunks
+#==============================
+def iter_parquet_chunks(path: Path, chunk_size: int):
+    """
+    Read a parquet file in chunks of about chunk_size bytes (decoded), with the same dtypes of the in-memory path
+
+    Parameters:
+        path (Path): parquet file
+        chunk_size (int): bytes per chunk, the rows per chunk come from the uncompressed size on the file metadata
+
+    Returns:
+        Generator of pd.DataFrame
+    """
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    if metadata.num_rows == 0:
+        return
+    uncompressed = sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+    rows = max(1_000, chunk_size * metadata.num_rows // max(uncompressed, 1))
+
+    for batch in parquet_file.iter_batches(batch_size=rows):
+        # The batches don't carry the schema metadata, that has the pandas dtypes of the columns
+        yield parquet_to_pandas(pa.Table.from_batches([batch]).replace_schema_metadata(parquet_file.schema_arrow.metadata))
+
+
+def transform_chunks(chunks, spec: dict, engine: str = 'arrow'):
+    """
+    Apply the row by row steps of a transform spec (NA rules, conversions, derived columns) to each chunk
+
+    The dedup is not applied, it needs all the rows: see dedup_chunks
+
+    Returns:
+        Generator of pd.DataFrame
+    """
+    row_spec = {key: value for key, value in spec.items() if key != 'dedup'}
+    for chunk in chunks:
+        yield apply_spec(chunk, row_spec, engine=engine)
+
+
+def dedup_chunks(chunks, dedup: tuple, spill_dir: Path, chunk_size: int):
+    """
+    Keep the latest row of each key over all the chunks, with the result of remove_duplicates on the whole data
+
+    The chunks are spilled to a parquet file, read twice by remove_duplicates_chunked (on-disk index of the keys)
+
+    Parameters:
+        chunks: iterable of pd.DataFrame, already transformed
+        dedup (tuple): (key column, column to keep the latest row), as the transform specs
+        spill_dir (Path): folder of the spill files, removed by the caller
+        chunk_size (int): bytes per chunk read back from the spill file
+
+    Returns:
+        Generator of pd.DataFrame: deduplicated chunks, rows in the input order
+    """
+    spill_path = Path(spill_dir) / 'dedup_spill.parquet'
+    writer = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(spill_path, unify_dictionaries(table).schema)
+            writer.write_table(cast_chunk(table, writer.schema))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        return
+    logger.info(f"Spilled {rows} rows to {spill_path} for the dedup")
+
+    yield from remove_duplicates_chunked(
+        lambda: iter_parquet_chunks(spill_path, chunk_size),
+        *dedup,
+        index_path=Path(spill_dir) / 'dedup_index.sqlite'
+    )
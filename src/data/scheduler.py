@@ -0,0 +1,156 @@
+# Stage Scheduler
+# Runs the ETL stages as a dependency graph, executing the independent stages in parallel on a process pool
+#   Network/disk bound stages (io=True, ex.: downloads) run on threads of the main process, without taking a worker
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Callable
+
+from src.data import instrumentation
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('scheduler')
+
+MAX_WORKERS = os.cpu_count() or 2  # Stages running at the same time
+MAX_LARGE_STAGES = 1               # Large stages running at the same time, to not run out of memory
+MAX_IO_STAGES = 8                  # io stages running at the same time, on threads
+
+
+
+#==============================
+# Stage definition
+#==============================
+@dataclass
+class Stage:
+    """
+    Node of the ETL graph
+
+    Attributes:
+        name (str): unique name of the stage, used on depends_on and logs
+        func (Callable): top level function to execute (must be picklable to run on the process pool)
+        args (tuple): arguments of func
+        depends_on (list): names of the stages that must succeed before this one
+        large (bool | Callable): if the stage holds a large dataset in memory;
+            a callable is evaluated right before submitting (ex.: checking the size of a downloaded file)
+        check_result (bool): if a falsy return of func must be treated as a failure
+        io (bool): if the stage mostly waits on network/disk; it runs on a thread of the main process and
+            doesn't count on max_workers, so all of them start at once (ex.: the downloads)
+    """
+    name: str
+    func: Callable
+    args: tuple = ()
+    depends_on: list = field(default_factory=list)
+    large: bool | Callable = False
+    check_result: bool = False
+    io: bool = False
+
+
+
+#==============================
+# Run the graph
+#==============================
+def _run_stage(name: str, func: Callable, args: tuple):
+    # Runs on the worker process, measured as the top level stage of the metrics (see instrumentation.py)
+    with instrumentation.stage(name):
+        return func(*args)
+
+
+def run_stages(stages: list, max_workers: int = MAX_WORKERS, max_large: int = MAX_LARGE_STAGES, max_io: int = MAX_IO_STAGES):
+    """
+    Execute the stages respecting their dependencies
+
+    A failing stage is logged and only its dependents are skipped, the other stages keep running.
+
+    Parameters:
+        stages (list): list of Stage
+        max_workers (int): concurrency limit of the run
+        max_large (int): limit of large stages running at the same time
+        max_io (int): limit of io stages running at the same time
+
+    Returns:
+        dict: stage name -> 'success', 'failed' or 'skipped'
+    """
+    by_name = {stage.name: stage for stage in stages}
+    if len(by_name) != len(stages):
+        raise ValueError("Stage names must be unique.")
+
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in by_name:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dependency}'.")
+
+    status = {}
+    pending = list(stages)  # Keeps the declared order as priority
+    running = {}            # future -> (stage, is_large)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor, ThreadPoolExecutor(max_workers=max_io) as io_executor:
+        while pending or running:
+
+            #--------------
+            # Skip stages whose dependencies failed
+            #--------------
+            for stage in list(pending):
+                if any(status.get(dep) in ('failed', 'skipped') for dep in stage.depends_on):
+                    logger.warning(f"Skipping stage {stage.name}, a dependency did not succeed")
+                    status[stage.name] = 'skipped'
+                    pending.remove(stage)
+
+            #--------------
+            # Submit the stages that are ready
+            #--------------
+            large_running = sum(is_large for _, is_large in running.values())
+            io_running = sum(stage.io for stage, _ in running.values())
+            for stage in list(pending):
+                if not all(status.get(dep) == 'success' for dep in stage.depends_on):
+                    continue
+
+                if stage.io:
+                    if io_running >= max_io:
+                        continue
+                    logger.info(f"Starting stage {stage.name}")
+                    running[io_executor.submit(_run_stage, stage.name, stage.func, stage.args)] = (stage, False)
+                    io_running += 1
+                    pending.remove(stage)
+                    continue
+
+                if len(running) - io_running >= max_workers:
+                    continue
+
+                is_large = stage.large() if callable(stage.large) else stage.large
+                if is_large and large_running >= max_large:
+                    continue
+
+                logger.info(f"Starting stage {stage.name}")
+                running[executor.submit(_run_stage, stage.name, stage.func, stage.args)] = (stage, is_large)
+                large_running += is_large
+                pending.remove(stage)
+
+            if not running:
+                if pending:
+                    # Nothing running and nothing can start: only happens with a dependency cycle
+                    raise ValueError(f"Stages can't be scheduled, check for cycles: {[s.name for s in pending]}")
+                break
+
+            #--------------
+            # Wait for any stage to finish
+            #--------------
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, _ = running.pop(future)
+                try:
+                    result = future.result()
+                    if stage.check_result and not result:
+                        raise RuntimeError(f"Stage returned {result!r}")
+                    status[stage.name] = 'success'
+                    logger.info(f"Finished stage {stage.name}")
+
+                except Exception as e:
+                    status[stage.name] = 'failed'
+                    logger.error(f"Error on stage {stage.name}: {str(e)}", exc_info=True)
+
+    return status
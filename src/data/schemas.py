@@ -0,0 +1,246 @@
+# Schema Registry
+# Compact types of each dataset, enforced by the readers of data_extraction.py at read time
+#   Before, every dataset was read with the default pandas inference (object columns and int64/float64)
+
+import logging
+import pandas as pd
+import pyarrow as pa
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('schemas')
+
+# Low cardinality strings (cities, states, platforms...) are dictionary encoded -> pandas category
+category = pa.dictionary(pa.int32(), pa.string())
+
+# Timestamps stay as strings here, their conversion is done by the transform specs (transform_specs.py)
+# Columns not listed keep the default inference (ex.: the nested items of the orders)
+SCHEMAS = {
+    'orders': pa.schema([
+        ('cpf', pa.string()),
+        ('customer_id', pa.string()),
+        ('customer_name', category),
+        ('delivery_address_city', category),
+        ('delivery_address_country', category),
+        ('delivery_address_district', category),
+        ('delivery_address_external_id', pa.string()),
+        ('delivery_address_latitude', pa.string()),
+        ('delivery_address_longitude', pa.string()),
+        ('delivery_address_state', category),
+        ('delivery_address_zip_code', pa.string()),
+        ('merchant_id', pa.string()),
+        ('merchant_latitude', pa.string()),
+        ('merchant_longitude', pa.string()),
+        ('merchant_timezone', category),
+        ('order_created_at', pa.string()),
+        ('order_id', pa.string()),
+        ('order_scheduled', pa.bool_()),
+        ('order_total_amount', pa.float64()),  # Kept as float64, revenue sums must not change
+        ('origin_platform', category),
+        ('order_scheduled_date', pa.string())
+    ]),
+
+    'consumers': pa.schema([
+        ('customer_id', pa.string()),
+        ('language', category),
+        ('created_at', pa.string()),
+        ('active', pa.bool_()),
+        ('customer_name', category),
+        ('customer_phone_area', pa.int8()),      # DDD, 11 to 99
+        ('customer_phone_number', pa.int32())    # Up to 9 digits
+    ]),
+
+    'restaurants': pa.schema([
+        ('id', pa.string()),
+        ('created_at', pa.string()),
+        ('enabled', pa.bool_()),
+        ('price_range', pa.int8()),
+        ('average_ticket', pa.float64()),
+        ('takeout_time', pa.int16()),
+        ('delivery_time', pa.float64()),
+        ('minimum_order_value', pa.float64()),
+        ('merchant_zip_code', pa.int32()),
+        ('merchant_city', category),
+        ('merchant_state', category),
+        ('merchant_country', category)
+    ]),
+
+    'ab_test': pa.schema([
+        ('customer_id', pa.string()),
+        ('is_target', category)
+    ])
+}
+
+# Arrow type -> pandas dtype; the ints and bools are nullable, as the 'int' conversion of convert_column
+PANDAS_DTYPES = {
+    pa.string(): pd.StringDtype('pyarrow'),
+    pa.large_string(): pd.StringDtype('pyarrow'),
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+    pa.date32(): pd.ArrowDtype(pa.date32())  # Same date32 column of the 'date' conversion, instead of python date objects
+}
+
+
+
+#==============================
+# Schema helpers
+#==============================
+def pandas_dtypes(dataset: str):
+    """
+    Get the pandas dtypes of a dataset, in the format of the dtype argument of pd.read_csv
+
+    Parameters:
+        dataset (str): name of the dataset on SCHEMAS
+
+    Returns:
+        dict: column -> pandas dtype
+    """
+    dtypes = {}
+    for field in SCHEMAS.get(dataset, []):
+        if pa.types.is_dictionary(field.type):
+            dtypes[field.name] = 'category'
+        else:
+            dtypes[field.name] = PANDAS_DTYPES.get(field.type, field.type.to_pandas_dtype())
+    return dtypes
+
+
+def parse_schema(schema: pa.Schema):
+    """
+    Schema to parse the raw values, with the value type instead of dictionaries (parsers don't build dictionaries)
+
+    Parameters:
+        schema (pa.Schema): schema of the registry
+
+    Returns:
+        pa.Schema
+    """
+    return pa.schema([
+        (field.name, field.type.value_type if pa.types.is_dictionary(field.type) else field.type)
+        for field in schema
+    ])
+
+
+def to_pandas(table: pa.Table):
+    """
+    Convert an Arrow table to pandas keeping the compact types (Arrow backed strings and nullable small ints)
+
+    Parameters:
+        table (pa.Table): table to convert
+
+    Returns:
+        pd.DataFrame
+    """
+    return table.to_pandas(types_mapper=PANDAS_DTYPES.get)
+
+
+def parquet_to_pandas(table: pa.Table):
+    """
+    Convert a table read from parquet to pandas with the same types of the in-memory path
+    Files written by pandas keep their dtypes on the schema metadata; files written by Arrow (ex.: stream_tar_csv)
+    don't have it, so they get the compact types of to_pandas
+
+    Parameters:
+        table (pa.Table): table read with pq.read_table / ParquetFile, with its schema metadata
+
+    Returns:
+        pd.DataFrame
+    """
+    if b'pandas' in (table.schema.metadata or {}):
+        return table.to_pandas()
+    return to_pandas(table)
+
+
+def unify_dictionaries(table: pa.Table):
+    """
+    Use int32 indices on every dictionary column (pandas picks int8/int16 by the amount of categories of each chunk)
+
+    Parameters:
+        table (pa.Table): table converted from pandas
+
+    Returns:
+        pa.Table
+    """
+    fields = [
+        field.with_type(pa.dictionary(pa.int32(), field.type.value_type)) if pa.types.is_dictionary(field.type) else field
+        for field in table.schema
+    ]
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+
+def cast_chunk(table: pa.Table, schema: pa.Schema):
+    """
+    Cast a chunk to the schema of the first chunk written to a file (a parquet writer only takes one schema)
+
+    Parameters:
+        table (pa.Table): chunk to write
+        schema (pa.Schema): schema of the writer
+
+    Returns:
+        pa.Table
+
+    Raises:
+        ValueError: the chunk has other columns, or a value that can't be cast (ex.: a column all null on the first chunk)
+    """
+    if table.column_names != schema.names:
+        raise ValueError(f"Chunk columns {table.column_names} don't match the written columns {schema.names}")
+    try:
+        return unify_dictionaries(table).cast(schema)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        raise ValueError(f"Chunk types don't match the written types: {e}")
+
+
+def enforce_schema(df: pd.DataFrame, dataset: str):
+    """
+    Convert a DataFrame read with the default inference to the registry types
+
+    Used when a reader can't apply the types at read time (ex.: a value that doesn't fit the declared type);
+    numbers that can't be converted become NA, as the 'int'/'float' conversions of convert_column
+
+    Parameters:
+        df (pd.DataFrame): DataFrame to convert
+        dataset (str): name of the dataset on SCHEMAS
+
+    Returns:
+        pd.DataFrame: DataFrame with the registry types
+    """
+    for column, dtype in pandas_dtypes(dataset).items():
+        if column not in df.columns:
+            continue
+        if dtype != 'category' and pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def schema_report(df: pd.DataFrame):
+    """
+    Bytes used by each column with the compact types against the default inference
+
+    Parameters:
+        df (pd.DataFrame): DataFrame with the registry types
+
+    Returns:
+        pd.DataFrame: column, dtype, bytes, default_bytes and bytes_saved
+    """
+    rows = []
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype) or isinstance(series.dtype, pd.StringDtype):
+            default = series.astype(object)
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            default = series.astype('float64' if series.hasnans else 'int64')
+        elif pd.api.types.is_bool_dtype(series.dtype):
+            default = series.astype(object if series.hasnans else bool)
+        else:
+            default = series
+
+        compact_bytes = series.memory_usage(deep=True, index=False)
+        default_bytes = default.memory_usage(deep=True, index=False)
+        rows.append((column, str(series.dtype), compact_bytes, default_bytes, default_bytes - compact_bytes))
+
+    return pd.DataFrame(rows, columns=['column', 'dtype', 'bytes', 'default_bytes', 'bytes_saved'])
@@ -0,0 +1,155 @@
+# Star Schema
+# Dense int32 surrogate keys for customers and merchants, and the orders fact table already joined to the
+#   experiment group and the main consumer and restaurant attributes
+#   Before, every notebook merged orders_processed with ab_test/consumers/restaurants on the 64 chars string ids
+
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+from src.data.data_load import load_data, read_data, processed_dir
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('star_schema')
+
+keys_dir = processed_dir / "keys"  # Dictionary files: key -> original id
+
+# Columns of each dataset on the fact table; the dimension attributes are renamed to not collide
+FACT_COLUMNS = [
+    'order_id', 'customer_id', 'merchant_id', 'order_created_at', 'order_created_date',
+    'order_total_amount', 'origin_platform', 'order_scheduled', 'delivery_address_city', 'delivery_address_state'
+]
+CONSUMER_COLUMNS = {'active': 'customer_active', 'created_at': 'customer_created_at'}
+RESTAURANT_COLUMNS = {
+    'enabled': 'merchant_enabled', 'price_range': 'merchant_price_range', 'average_ticket': 'merchant_average_ticket',
+    'delivery_time': 'merchant_delivery_time', 'merchant_city': 'merchant_city', 'merchant_state': 'merchant_state'
+}
+
+
+
+#==============================
+# Surrogate keys
+#==============================
+def surrogate_keys(name: str, ids, folder: Path = keys_dir):
+    """
+    Dense int32 key of each id, keeping the keys of the previous runs
+
+    The dictionary file (<folder>/<name>_keys.parquet, columns key and id) only grows: ids already there keep their key,
+    new ids get the next keys, so keys saved elsewhere stay valid
+
+    Parameters:
+        name (str): name of the key (ex.: 'customer')
+        ids: ids that need a key, any iterable of strings (repeated values and nulls are ignored)
+        folder (Path): folder of the dictionary files
+
+    Returns:
+        pd.Index: ids in key order (the position of an id is its key), use .get_indexer(values) to map values to keys
+    """
+    path = Path(folder) / f"{name}_keys.parquet"
+    known = pd.Index(pq.read_table(path, columns=['id'])['id'].to_pandas() if path.exists() else [], dtype=object)
+
+    ids = pd.Index(pd.unique(pd.Series(ids, dtype=object).dropna()))
+    new_ids = ids[known.get_indexer(ids) < 0]
+    if len(new_ids) == 0 and path.exists():
+        return known
+
+    dictionary = known.append(new_ids)
+    if len(dictionary) > np.iinfo(np.int32).max:
+        raise ValueError(f"Too many ids for an int32 key: {len(dictionary)}")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.table({'key': pa.array(np.arange(len(dictionary), dtype=np.int32)), 'id': pa.array(dictionary.to_numpy(), pa.string())})
+    tmp_path = path.with_name(path.name + '.tmp')
+    pq.write_table(table, tmp_path)
+    tmp_path.replace(path)
+
+    logger.info(f"{name} keys: {len(known)} known, {len(new_ids)} new")
+    return dictionary
+
+
+def map_keys(dictionary: pd.Index, values):
+    """
+    Map ids to their int32 keys, -1 for ids out of the dictionary
+    """
+    return dictionary.get_indexer(values).astype(np.int32)
+
+
+def _attributes_by_key(dim: pd.DataFrame, id_column: str, dictionary: pd.Index, columns: dict):
+    # Attributes of a dimension (one row per key) and the row of each key on them, so the fact table gets them by position
+    #   instead of a join; keys without a row on the dimension and the unknown key -1 (the last item) point to row -1
+    keys = map_keys(dictionary, dim[id_column])
+    dim = dim.loc[keys >= 0, list(columns)].rename(columns=columns)
+    keys = keys[keys >= 0]
+    first = ~pd.Index(keys).duplicated(keep='first')
+    rows = np.full(len(dictionary) + 1, -1, dtype=np.int64)
+    rows[keys[first]] = np.arange(first.sum())
+    return dim[first].reset_index(drop=True), rows
+
+
+def _take_attributes(attributes: pd.DataFrame, rows: np.ndarray, keys: np.ndarray):
+    # Attributes of each fact row, null for the rows of unknown keys or of keys out of the dimension
+    #   numpy bool/int columns are taken as nullable arrays, so the nulls don't turn them into object/float
+    positions = rows[keys]
+    taken = {}
+    for column in attributes.columns:
+        values = attributes[column]
+        values = pd.array(values.to_numpy()) if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biu' else values.array
+        taken[column] = values.take(positions, allow_fill=True)
+    return taken
+
+
+
+#==============================
+# Fact table
+#==============================
+def build_star(folder: Path = processed_dir, keys_folder: Path = keys_dir):
+    """
+    Build the keys and the orders_star fact table from the processed datasets
+
+    orders_star has one row per order with customer_key and merchant_key (int32), the experiment group (is_target),
+    the consumer and restaurant attributes of CONSUMER_COLUMNS / RESTAURANT_COLUMNS, sorted by customer_key
+    Orders with a null id (key -1) or an id out of a dimension have null attributes of that dimension
+
+    Parameters:
+        folder (Path): folder of the processed datasets, where orders_star is written
+        keys_folder (Path): folder of the key dictionaries
+
+    Returns:
+        Path: path of orders_star
+    """
+    orders = read_data('orders_processed', columns=FACT_COLUMNS, folder=folder)
+    ab_test = read_data('ab_test', folder=folder)
+    consumers = read_data('consumers_processed', columns=['customer_id'] + list(CONSUMER_COLUMNS), folder=folder)
+    restaurants = read_data('restaurants_processed', columns=['id'] + list(RESTAURANT_COLUMNS), folder=folder)
+
+    #--------------
+    # Keys of every id of any dataset
+    #--------------
+    customers = surrogate_keys('customer', pd.concat([orders['customer_id'], ab_test['customer_id'], consumers['customer_id']]).astype(object), keys_folder)
+    merchants = surrogate_keys('merchant', pd.concat([orders['merchant_id'], restaurants['id']]).astype(object), keys_folder)
+
+    customer_key = map_keys(customers, orders['customer_id'])
+    merchant_key = map_keys(merchants, orders['merchant_id'])
+
+    #--------------
+    # Dimension attributes taken by key position
+    #--------------
+    groups = _attributes_by_key(ab_test, 'customer_id', customers, {'is_target': 'is_target'})
+    consumer_attributes = _attributes_by_key(consumers, 'customer_id', customers, CONSUMER_COLUMNS)
+    restaurant_attributes = _attributes_by_key(restaurants, 'id', merchants, RESTAURANT_COLUMNS)
+
+    star = orders.drop(columns=['customer_id', 'merchant_id'])
+    star.insert(1, 'customer_key', customer_key)
+    star.insert(2, 'merchant_key', merchant_key)
+    for (attributes, rows), keys in [(groups, customer_key), (consumer_attributes, customer_key), (restaurant_attributes, merchant_key)]:
+        for column, values in _take_attributes(attributes, rows, keys).items():
+            star[column] = values
+
+    logger.info(f"orders_star: {len(star)} orders, {len(customers)} customer keys, {len(merchants)} merchant keys")
+    return load_data(star, 'orders_star', folder=folder)
@@ -0,0 +1,250 @@
+# Transform Engine
+# Applies a transform spec (see transform_specs.py) in a single pass over an Arrow table
+#   The functions of data_transformation.py remain as the reference path (engine='pandas')
+
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from src.data import schemas
+from src.data.geo import LOOKUPS
+from src.data.instrumentation import stage
+from src.data.data_transformation import handle_na_data, convert_column, parse_datetime, remove_duplicates, latest_per_key, dedup_order_values
+
+
+#==============================
+# Define constants
+#==============================
+logger = logging.getLogger('transform_engine')
+
+ARROW_TYPES = {
+    'datetime': pa.timestamp('ns', tz='UTC'),
+    'date': pa.date32(),
+    'int': pa.int64(),
+    'float': pa.float64()
+}
+
+
+
+#==============================
+# Reference path
+#==============================
+def apply_spec_pandas(df: pd.DataFrame, spec: dict):
+    """
+    Apply a transform spec with the pandas functions of data_transformation.py (one pass per step)
+
+    Parameters:
+        df (pd.DataFrame): DataFrame to transform
+        spec (dict): transform spec
+
+    Returns:
+        pd.DataFrame: transformed DataFrame
+    """
+    for columns, action, value in spec.get('na', []):
+        df = handle_na_data(df, columns, action, value)
+
+    if spec.get('conversions'):
+        df = convert_column(df, spec['conversions'], formats=spec.get('formats'))
+
+    for new_column, column, dtype in spec.get('derive', []):
+        df[new_column] = df[column]
+        df = convert_column(df, [(new_column, dtype)])
+
+    for new_column, column, lookup in spec.get('enrich', []):
+        if column not in df.columns:
+            logger.warning(f"Column '{column}' not found in DataFrame. Skipping.")
+            continue
+        df[new_column] = LOOKUPS[lookup][0](df[column])
+
+    if spec.get('dedup'):
+        df = remove_duplicates(df, *spec['dedup'])
+
+    return df
+
+
+
+#==============================
+# Arrow path
+#==============================
+def _convert_arrow_column(column: pa.ChunkedArray, name: str, dtype: str, fmt='detect'):
+    """
+    Convert one column with an Arrow cast (the datetime parser of convert_column for timestamps), falling back to
+    convert_column when Arrow can't parse it
+
+    Parameters:
+        column (pa.ChunkedArray): column to convert
+        name (str): name of the column
+        dtype (str): dtype on the convert_column format ('datetime', 'date', 'int', 'float', 'str')
+        fmt (str, optional): datetime format, see parse_datetime
+
+    Returns:
+        pa.ChunkedArray: converted column
+    """
+    if dtype in ('datetime', 'date'):
+        parsed = parse_datetime(column, name, fmt)
+        return parsed.cast(pa.date32()) if dtype == 'date' else parsed
+
+    if dtype in ARROW_TYPES:
+        try:
+            return pc.cast(column, ARROW_TYPES[dtype])
+
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            logger.info(f"Arrow could not convert '{name}' to {dtype}, using pandas: {e}")
+
+    # Pandas reference conversion for values Arrow can't cast (ex.: coercing invalid numbers to NA) and 'str'
+    df_column = convert_column(pd.DataFrame({name: column.to_pandas()}), [(name, dtype)])
+    return pa.chunked_array([pa.Array.from_pandas(df_column[name])])
+
+
+def _latest_per_key(table: pa.Table, column: str, column_deduplicate: str):
+    """
+    Get the indices of the latest row of each key, with the same hash group + arg-max of remove_duplicates
+
+    Parameters:
+        table (pa.Table): table with the key and the ordering columns
+        column (str): key column
+        column_deduplicate (str): column used to keep the latest row
+
+    Returns:
+        np.ndarray: row indices of the table to keep
+    """
+    # Arrow hashes the keys into dictionary codes, avoiding converting the key strings to python objects
+    codes = pc.dictionary_encode(table[column].combine_chunks(), null_encoding='encode').indices
+    order_values = table[column_deduplicate]
+    if pa.types.is_timestamp(order_values.type) or pa.types.is_date(order_values.type):
+        order_values = pc.fill_null(pc.cast(order_values, pa.int64()), np.iinfo('int64').min).to_numpy()
+    else:
+        order_values = dedup_order_values(order_values.to_pandas())
+
+    return latest_per_key(codes.to_numpy(zero_copy_only=False), order_values)
+
+
+def apply_spec_arrow(data, spec: dict, to_pandas: bool = True):
+    """
+    Apply a transform spec in a single pass over an Arrow table
+
+    The NA rules, conversions and derived columns create new columns without copying the others, and the rows dropped by
+    NA rules and dedup are gathered only once at the end
+
+    Parameters:
+        data (pd.DataFrame | pa.Table): data to transform
+        spec (dict): transform spec
+        to_pandas (bool): return a pd.DataFrame (True) or a pa.Table (False)
+
+    Returns:
+        pd.DataFrame | pa.Table: transformed data, same values of apply_spec_pandas
+    """
+    table = pa.Table.from_pandas(data, preserve_index=False) if isinstance(data, pd.DataFrame) else data
+    columns = {name: table[name] for name in table.column_names}
+    keep_mask = None
+
+    logger.info("Applying transform spec with the arrow engine")
+
+    #--------------
+    # NA rules
+    #--------------
+    for na_columns, action, value in spec.get('na', []):
+        if action == 'fill':
+            if value is None:
+                raise ValueError("Please, provide what will be used to fill na on 'add_param', it must be provided for the 'fill' action.")
+            for col in na_columns:
+                if pa.types.is_dictionary(columns[col].type):
+                    # Filling on the values, a new value is added to the dictionary
+                    filled = pc.fill_null(columns[col].cast(columns[col].type.value_type), pa.scalar(value, type=columns[col].type.value_type))
+                    columns[col] = pc.dictionary_encode(filled)
+                else:
+                    columns[col] = pc.fill_null(columns[col], pa.scalar(value, type=columns[col].type))
+
+        elif action == 'drop':
+            for col in na_columns:
+                valid = pc.is_valid(columns[col])
+                keep_mask = valid if keep_mask is None else pc.and_(keep_mask, valid)
+
+        else:
+            raise ValueError("Invalid action. Use 'fill' or 'drop'.")
+
+    #--------------
+    # Conversions
+    #--------------
+    int_columns = []
+    formats = spec.get('formats') or {}
+    with stage('conversions', rows_in=table.num_rows) as record:
+        coerced = {}
+        for column, dtype in spec.get('conversions', []):
+            if column not in columns:
+                logger.warning(f"Column '{column}' not found in table. Skipping.")
+                continue
+            nulls_before = columns[column].null_count
+            columns[column] = _convert_arrow_column(columns[column], column, dtype, formats.get(column, 'detect'))
+            coerced[column] = columns[column].null_count - nulls_before
+            if coerced[column]:
+                logger.warning(f"{coerced[column]} values of '{column}' could not be converted to {dtype}, now null")
+            if dtype == 'int':
+                int_columns.append(column)
+
+        for new_column, column, dtype in spec.get('derive', []):
+            columns[new_column] = _convert_arrow_column(columns[column], new_column, dtype)
+            if dtype == 'int':
+                int_columns.append(new_column)
+        record.set(coerced_nulls=coerced)
+
+    #--------------
+    # Enrichment (array lookups, see geo.py)
+    #--------------
+    for new_column, column, lookup in spec.get('enrich', []):
+        if column not in columns:
+            logger.warning(f"Column '{column}' not found in table. Skipping.")
+            continue
+        columns[new_column] = LOOKUPS[lookup][1](columns[column])
+
+    table = pa.table(columns)
+
+    #--------------
+    # Rows to keep: NA drops + dedup, gathered once
+    #--------------
+    if keep_mask is not None:
+        table = table.filter(keep_mask)
+
+    if spec.get('dedup'):
+        with stage('dedup', rows_in=table.num_rows) as record:
+            column, column_deduplicate = spec['dedup']
+            table = table.take(_latest_per_key(table.select([column, column_deduplicate]), column, column_deduplicate))
+            record.set(rows_out=table.num_rows)
+
+    if not to_pandas:
+        return table
+
+    with stage('to_pandas', rows_in=table.num_rows):
+        df = schemas.to_pandas(table)
+    for column in int_columns:
+        # Same nullable int of convert_column
+        df[column] = df[column].astype('Int64')
+    return df
+
+
+
+#==============================
+# Apply spec
+#==============================
+def apply_spec(data, spec: dict, engine: str = 'arrow'):
+    """
+    Apply a transform spec with the chosen engine
+
+    Parameters:
+        data (pd.DataFrame | pa.Table): data to transform
+        spec (dict): transform spec
+        engine (str): 'arrow' (single pass) or 'pandas' (reference functions)
+
+    Returns:
+        pd.DataFrame: transformed DataFrame
+    """
+    if engine == 'arrow':
+        return apply_spec_arrow(data, spec)
+
+    elif engine == 'pandas':
+        df = data.to_pandas() if isinstance(data, pa.Table) else data
+        return apply_spec_pandas(df, spec)
+
+    raise ValueError("Invalid engine. Use 'arrow' or 'pandas'.")
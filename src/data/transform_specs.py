@@ -0,0 +1,56 @@
+# Transform Specs
+# Declarative description of the transformation of each dataset, used by the transform engine
+#   Before, the NA rules, conversions and dedup keys were hard coded on each process_*_file of main.py
+
+#==============================
+# Specs
+#==============================
+# Each spec has:
+#   na: list of (columns, action, value) -> same arguments of handle_na_data; applied in order
+#   conversions: list of (column, dtype) -> same arguments of convert_column
+#       numbers and flags are already typed at read time by the schema registry (schemas.py), only timestamps are converted here
+#   formats: {column: datetime format} -> formats argument of convert_column; columns not listed have it detected; optional
+#   derive: list of (new column, source column, dtype) -> new column converted from an already converted column; optional
+#   enrich: list of (new column, source column, lookup) -> new column looked up from the source, lookup on geo.LOOKUPS; optional
+#   dedup: (key column, column to keep the latest row) -> same arguments of remove_duplicates; or None
+TRANSFORM_SPECS = {
+    'restaurants': {
+        'na': [
+            (['minimum_order_value'], 'fill', 0)
+        ],
+        'conversions': [
+            ('created_at', 'datetime')
+        ],
+        'formats': {'created_at': 'ISO8601'},
+        'dedup': ('id', 'created_at')
+    },
+
+    'consumers': {
+        'na': [
+            (['customer_name'], 'fill', 'n/d')
+        ],
+        'conversions': [
+            ('created_at', 'datetime')
+        ],
+        'formats': {'created_at': 'ISO8601'},
+        'enrich': [
+            ('customer_state', 'customer_phone_area', 'phone_area_state')  # State of the phone area code (DDD)
+        ],
+        'dedup': ('customer_id', 'created_at')
+    },
+
+    'orders': {
+        'na': [
+            (['customer_id'], 'drop', None)  # Deleting rows without a customer_id as we wont be able to join with the other datasets to understand the a/b tests
+        ],
+        'conversions': [
+            ('order_created_at', 'datetime'),
+            ('order_scheduled_date', 'datetime')
+        ],
+        'formats': {'order_created_at': 'ISO8601', 'order_scheduled_date': 'ISO8601'},  # 2019-01-01T10:00:00.000Z
+        'derive': [
+            ('order_created_date', 'order_created_at', 'date')  # Partition column of the processed orders
+        ],
+        'dedup': ('order_id', 'order_created_at')
+    }
+}
@@ -0,0 +1,131 @@
+# Parity checks between src/analysis/ab_metrics.experiment_report and the KPI loop and t-tests that were on
+#   notebooks/02_ab_test_analysis.ipynb (kept here as the reference)
+# Usage: python tests/ab_metrics_parity.py [amount_of_orders] [data_folder]
+#   With a data_folder (ex.: data/processed) the processed orders and ab_test are also checked
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy import stats
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.analysis.ab_metrics import experiment_report
+
+
+#==============================
+# Notebook reference
+#==============================
+def notebook_kpis(df_orders, df_ab_test):
+    # The per group loop of the notebook, rounded as it was
+    df_orders_group = df_orders.merge(df_ab_test, on='customer_id', how='inner')
+    results = {}
+    for group in ['target', 'control']:
+        total_users = df_ab_test[df_ab_test["is_target"] == group]['customer_id'].nunique()
+        df_group_orders = df_orders_group[['order_id', 'order_total_amount', 'customer_id', 'is_target']] \
+                                        .query(f'is_target == "{group}"')
+        total_orders = df_group_orders["order_id"].nunique()
+        active_users = df_group_orders[["order_id", "customer_id"]].groupby('customer_id').count().reset_index()
+        retained_users = active_users[active_users['order_id'] > 1]['customer_id'].nunique()
+        total_revenue = df_group_orders['order_total_amount'].sum()
+        results[group] = {
+            'total_users': total_users,
+            'active_users': len(active_users),
+            'activation_rate': round(len(active_users) / total_users, 4),
+            'retention_rate': round(retained_users / total_users, 4),
+            'avg_orders_per_user': round(total_orders / total_users, 4),
+            'avg_order_value': round(df_group_orders['order_total_amount'].mean(), 4),
+            'revenue_per_user': round(total_revenue / total_users, 4),
+            'total_revenue': total_revenue
+        }
+    return pd.DataFrame.from_dict(results, orient='index')
+
+
+def notebook_tests(df_orders, df_ab_test):
+    # The t-tests of the notebook, on the orders per active user of each group
+    df_orders_group = df_orders.merge(df_ab_test, on='customer_id', how='inner')
+    metrics = {
+        group: df_orders_group[df_orders_group['is_target'] == group].groupby('customer_id').agg({
+            'order_id': 'count',
+            'order_total_amount': 'mean'
+        }).rename(columns={'order_id': 'qt_orders', 'order_total_amount': 'avg_value'})
+        for group in ['target', 'control']
+    }
+    return {
+        metric: stats.ttest_ind(metrics['target'][metric].dropna(), metrics['control'][metric].dropna(), equal_var=False)
+        for metric in ['qt_orders', 'avg_value']
+    }
+
+
+
+#==============================
+# Checks
+#==============================
+def make_frames(n: int, seed: int = 42):
+    """
+    Orders and ab_test with users out of the test, test users without orders and NA order values
+
+    Parameters:
+        n: amount of orders
+
+    Returns:
+        tuple: (orders, ab_test)
+    """
+    rng = np.random.default_rng(seed)
+    n_users = max(n // 4, 10)
+    users = np.array([f'{k:064x}' for k in range(n_users)], dtype=object)
+    ab_test = pd.DataFrame({'customer_id': users[:int(n_users * 0.9)]})
+    ab_test['is_target'] = np.where(rng.random(len(ab_test)) < 0.55, 'target', 'control')
+
+    values = np.round(rng.gamma(2, 25, n), 2)
+    values[rng.random(n) < 0.01] = np.nan
+    orders = pd.DataFrame({
+        'customer_id': users[rng.zipf(1.5, n) % n_users],
+        'order_id': [f'{k:032x}' for k in range(n)],
+        'order_total_amount': values
+    })
+    return orders, ab_test
+
+
+def check(orders, ab_test, label):
+    start = time.perf_counter()
+    expected_kpis, expected_tests = notebook_kpis(orders, ab_test), notebook_tests(orders, ab_test)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report = experiment_report(orders, ab_test)
+    report_time = time.perf_counter() - start
+
+    kpis = report['kpis'].loc[expected_kpis.index, expected_kpis.columns]
+    rounded = kpis.drop(columns=['total_users', 'active_users', 'total_revenue']).round(4)
+    expected_rounded = expected_kpis[rounded.columns].astype(float)
+    assert np.allclose(rounded.to_numpy(dtype=float), expected_rounded.to_numpy(), atol=1e-4), f"{label}: KPIs differ\n{kpis}\n{expected_kpis}"
+    assert (kpis[['total_users', 'active_users']].to_numpy() == expected_kpis[['total_users', 'active_users']].to_numpy()).all(), f"{label}: users differ"
+    assert np.allclose(kpis['total_revenue'].to_numpy(dtype=float), expected_kpis['total_revenue'].to_numpy(dtype=float)), f"{label}: revenue differs"
+
+    tests = report['tests'].set_index('metric')
+    for metric, (t_stat, p_value) in expected_tests.items():
+        assert np.isclose(tests.loc[metric, 't_stat'], t_stat) and np.isclose(tests.loc[metric, 'p_value'], p_value), \
+            f"{label}: t-test of {metric} differs ({tests.loc[metric, 't_stat']}, {tests.loc[metric, 'p_value']}) != ({t_stat}, {p_value})"
+
+    # The lift is the % difference that the notebook computed for the comparison plot
+    lift = (kpis.loc['target'] - kpis.loc['control']) / kpis.loc['control'] * 100
+    assert np.allclose(report['lift'].loc['target', lift.index].to_numpy(dtype=float), lift.to_numpy(dtype=float)), f"{label}: lift differs"
+
+    print(f"OK {label}: {len(orders)} orders, notebook {reference_time:.2f}s, experiment_report {report_time:.2f}s")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    check(*make_frames(n), 'synthetic')
+
+    if len(sys.argv) > 2:
+        folder = Path(sys.argv[2])
+        orders = pd.read_parquet(folder / 'orders_processed.parquet', columns=['customer_id', 'order_id', 'order_total_amount'])
+        check(orders, pd.read_parquet(folder / 'ab_test.parquet'), str(folder))
@@ -0,0 +1,66 @@
+# Checks of src/analysis/assignment.py: assign against variant, the split of each stratum, the same groups on reruns,
+#   and strata weights without a default ('*') when every customer has a known stratum
+# Usage: python tests/assignment_checks.py [amount_of_customers]
+
+import sys
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.analysis.assignment import StratifiedAssignment
+
+
+#==============================
+# Checks
+#==============================
+def make_customers(n: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'customer_id': [f'{k:064x}' for k in range(n)],
+        'hybrid_segment': pd.Categorical(rng.choice(['VIP Customers', 'New Explorers', 'Core Customers'], n),
+                                         categories=['VIP Customers', 'New Explorers', 'Core Customers', 'Other Customers'])
+    })
+
+
+def check(n: int):
+    customers = make_customers(n)
+    weights = {
+        '*': {'target': 0.8, 'control': 0.2},
+        'VIP Customers': {'target': 0.5, 'control': 0.5}
+    }
+    experiment = StratifiedAssignment('checks', weights=weights, stratum_column='hybrid_segment')
+    assignments = experiment.assign(customers)
+
+    # Same group of the single customer lookup, and the split of each stratum
+    sample = assignments.sample(200, random_state=1)
+    for customer_id, segment, group in sample[['customer_id', 'hybrid_segment', 'is_target']].itertuples(index=False):
+        assert experiment.variant(customer_id, stratum=segment) == group, customer_id
+    shares = assignments.groupby('hybrid_segment', observed=True)['is_target'].apply(lambda groups: (groups == 'target').mean())
+    assert abs(shares['VIP Customers'] - 0.5) < 0.02 and abs(shares['Core Customers'] - 0.8) < 0.02, shares
+
+    # Reruns with more customers keep the group of the previous ones
+    rerun = experiment.assign(pd.concat([customers, make_customers(n // 10, seed=7).assign(customer_id=lambda df: 'new' + df['customer_id'])]))
+    assert (rerun.set_index('customer_id').loc[assignments['customer_id'], 'is_target'].to_numpy() == assignments['is_target'].to_numpy()).all()
+
+    # Weights of every stratum without a default: fine while every customer has one of them (unused categories included)
+    no_default = StratifiedAssignment('checks', weights={
+        segment: {'target': 0.5, 'control': 0.5} for segment in ['VIP Customers', 'New Explorers', 'Core Customers']
+    }, stratum_column='hybrid_segment')
+    assert len(no_default.assign(customers)) == n
+    try:
+        no_default.assign(customers.assign(hybrid_segment=customers['hybrid_segment'].where(customers.index > 0)))
+        raise AssertionError("A customer without stratum was assigned without default weights")
+    except ValueError:
+        pass
+
+    print(f"OK assignment: {n} customers, target share by stratum {shares.round(3).to_dict()}")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    check(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -0,0 +1,81 @@
+# Benchmark of remove_duplicates: previous sort + drop_duplicates vs hash group + arg-max vs chunked (on-disk index)
+# Usage: python tests/benchmark_dedup.py [amount_of_rows]
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.data_transformation import remove_duplicates, remove_duplicates_chunked
+
+
+#==============================
+# Previous implementation
+#==============================
+def remove_duplicates_sorted(df: pd.DataFrame, column: str, column_deduplicate: str):
+    df = df.sort_values(by=column_deduplicate, ascending=False)
+    return df.drop_duplicates(subset=column, keep='first')
+
+
+#==============================
+# Synthetic orders
+#==============================
+def make_orders(n: int, duplicate_rate: float = 0.1, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    order_ids = np.arange(n)
+    duplicated = rng.random(n) < duplicate_rate
+    order_ids[duplicated] = rng.integers(0, n, duplicated.sum())
+
+    return pd.DataFrame({
+        'order_id': pd.Series(order_ids).map('{:032x}'.format),
+        'order_created_at': pd.to_datetime(rng.integers(1_546_300_800, 1_548_979_200, n), unit='s', utc=True),
+        'order_total_amount': rng.uniform(0, 150, n)
+    })
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    chunk_size = 1_000_000
+    df = make_orders(n)
+
+    start = time.perf_counter()
+    df_sorted = remove_duplicates_sorted(df, 'order_id', 'order_created_at')
+    time_sorted = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_hash = remove_duplicates(df, 'order_id', 'order_created_at')
+    time_hash = time.perf_counter() - start
+
+    start = time.perf_counter()
+    read_chunks = lambda: (df.iloc[i:i + chunk_size] for i in range(0, n, chunk_size))
+    df_chunked = pd.concat(remove_duplicates_chunked(read_chunks, 'order_id', 'order_created_at'))
+    time_chunked = time.perf_counter() - start
+
+    # Ties on the timestamp may keep different rows on the sorted version, comparing the latest timestamp of each key
+    latest = lambda d: d.set_index('order_id')['order_created_at'].sort_index()
+    assert latest(df_sorted).equals(latest(df_hash)), "hash dedup differs from the sorted one"
+    assert df_hash.index.equals(df_chunked.index), "chunked dedup differs from the in memory one"
+
+    # String order values on other chunks (their factorize codes are not comparable between chunks), with missing values
+    df_text = df.assign(order_created_at=df['order_created_at'].dt.strftime('%Y-%m-%dT%H:%M:%S').astype(object))
+    df_text.loc[df_text.index[::97], 'order_created_at'] = None
+    read_text = lambda: (df_text.iloc[i:i + chunk_size // 10] for i in range(0, n, chunk_size // 10))
+    df_text_chunked = pd.concat(remove_duplicates_chunked(read_text, 'order_id', 'order_created_at'))
+    assert remove_duplicates(df_text, 'order_id', 'order_created_at').index.equals(df_text_chunked.index), \
+        "chunked dedup by a string column differs from the in memory one"
+
+    # The index is closed when the consumer stops early
+    chunks = remove_duplicates_chunked(read_chunks, 'order_id', 'order_created_at')
+    next(chunks)
+    chunks.close()
+
+    print(f"Rows: {n}, after dedup: {len(df_hash)}")
+    print(f"sort + drop_duplicates: {time_sorted:.2f}s")
+    print(f"hash + arg-max:         {time_hash:.2f}s ({time_sorted / time_hash:.2f}x)")
+    print(f"chunked, on-disk index: {time_chunked:.2f}s")
@@ -0,0 +1,34 @@
+# Benchmark of the json decoders of extract_files ('python' line by line vs 'arrow' multi-threaded)
+# Usage: python tests/benchmark_json_decoder.py [amount_of_lines]
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.data_extraction import extract_files
+from tests.synthetic_data import generate, BASE_ROWS
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        generate(tmp, scale=n_lines / BASE_ROWS['orders'], duplicate_rate=0)
+
+        timings = {}
+        frames = {}
+        for decoder in ['python', 'arrow']:
+            start = time.perf_counter()
+            frames[decoder] = extract_files('orders.json.gz', 'gzip_json', read_path=tmp, extract_path=tmp, json_decoder=decoder)
+            timings[decoder] = time.perf_counter() - start
+            print(f"{decoder:>6} decoder: {timings[decoder]:.2f}s")
+
+        print(f"Speedup: {timings['python'] / timings['arrow']:.2f}x for {n_lines} lines")
+        print("Same DataFrame:", frames['python'].astype(object).equals(frames['arrow'].astype(object)))
@@ -0,0 +1,220 @@
+# Benchmark of every stage of the pipeline on synthetic data (see synthetic_data.py), at several scales
+# Measures the time and the peak memory (RSS) of each stage, saving the results as json to compare between changes
+# Usage: python tests/benchmark_stages.py [--scales 0.5 1 5] [--output results.json] [--compare previous.json]
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import psutil
+import pyarrow as pa
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.data_extraction import extract_files
+from src.data.data_transformation import convert_column, remove_duplicates, handle_na_data
+from src.data.transform_engine import apply_spec
+from src.data.transform_specs import TRANSFORM_SPECS
+from src.data.data_load import load_data, read_data
+from src.data.column_profile import DatasetProfiler
+from tests.synthetic_data import generate
+
+
+#==============================
+# Define constants
+#==============================
+DATASETS = [
+    ('orders.json.gz', 'gzip_json', 'orders'),
+    ('consumers.csv.gz', 'gzip_csv', 'consumers'),
+    ('restaurants.csv.gz', 'gzip_csv', 'restaurants'),
+    ('ab_test.tar.gz', 'tar_csv', 'ab_test')
+]
+REGRESSION_RATIO = 1.2  # Stages 20% slower (or with 20% more memory) than the compared results are flagged
+
+
+
+#==============================
+# Measurement
+#==============================
+class PeakMemory:
+    """
+    Sample the RSS of the process on a background thread, keeping the peak of the current measurement
+    """
+    def __init__(self, interval: float = 0.01):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def reset(self):
+        self.peak = self.process.memory_info().rss
+        return self.peak
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+@contextmanager
+def measure(results: dict, stage: str, memory: PeakMemory):
+    """
+    Save the seconds and the peak memory above the start of the stage on results[stage]
+    """
+    start_rss = memory.reset()
+    start = time.perf_counter()
+    yield
+    results[stage] = {
+        'seconds': round(time.perf_counter() - start, 4),
+        'peak_mb': round(max(memory.peak - start_rss, 0) / 1024**2, 2)
+    }
+    print(f"  {stage:<40} {results[stage]['seconds']:>9.3f}s {results[stage]['peak_mb']:>10.1f} MB")
+
+
+
+#==============================
+# Stages
+#==============================
+def run_scale(scale: float, memory: PeakMemory):
+    """
+    Run every stage on synthetic data of a scale
+
+    Parameters:
+        scale: scale of the synthetic data
+        memory: sampler of the peak memory
+
+    Returns:
+        dict: stage -> {'seconds', 'peak_mb'}, plus the rows of each dataset
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        raw_dir, extract_dir, processed_dir = tmp / 'raw', tmp / 'extracted', tmp / 'processed'
+        extract_dir.mkdir()
+
+        with measure(results, 'generate', memory):
+            rows = generate(raw_dir, scale)
+
+        for file_name, file_type, name in DATASETS:
+            with measure(results, f'extract_files[{name}]', memory):
+                df = extract_files(file_name, file_type, read_path=raw_dir, extract_path=extract_dir)
+
+            spec = TRANSFORM_SPECS.get(name)
+            if spec:
+                # The steps of the pandas reference path, each one on a copy of the extracted data
+                for columns, action, value in spec.get('na', []):
+                    with measure(results, f'handle_na_data[{name}]', memory):
+                        handle_na_data(df.copy(), columns, action, value)
+
+                df_converted = df.copy()
+                with measure(results, f'convert_column[{name}]', memory):
+                    df_converted = convert_column(df_converted, spec['conversions'])
+
+                with measure(results, f'remove_duplicates[{name}]', memory):
+                    remove_duplicates(df_converted, *spec['dedup'])
+                del df_converted
+
+                for engine in ['pandas', 'arrow']:
+                    with measure(results, f'apply_spec_{engine}[{name}]', memory):
+                        df_processed = apply_spec(df.copy(), spec, engine=engine)
+            else:
+                df_processed = df
+
+            file_name_processed = f'{name}_processed' if name != 'ab_test' else name
+            with measure(results, f'load_data[{name}]', memory):
+                load_data(df_processed, file_name_processed, folder=processed_dir)
+
+            # Part of load_data, measured alone to follow the cost of the column profiles
+            table = pa.Table.from_pandas(df_processed, preserve_index=False)
+            with measure(results, f'profile[{name}]', memory):
+                DatasetProfiler().update(table)
+            del table
+
+            with measure(results, f'read_data[{name}]', memory):
+                read_data(file_name_processed, folder=processed_dir)
+
+            del df, df_processed
+
+    return {'rows': rows, 'stages': results}
+
+
+
+#==============================
+# Comparison
+#==============================
+def compare(current: dict, previous: dict):
+    """
+    Print the ratio current / previous of each stage, flagging regressions
+
+    Returns:
+        int: amount of regressions
+    """
+    regressions = 0
+    for scale, result in current['scales'].items():
+        if scale not in previous['scales']:
+            print(f"Scale {scale} not found on the compared results")
+            continue
+
+        print(f"\nScale {scale} (current / previous)")
+        previous_stages = previous['scales'][scale]['stages']
+        for stage, values in result['stages'].items():
+            if stage not in previous_stages:
+                continue
+            ratios = {}
+            for metric in ['seconds', 'peak_mb']:
+                # Tiny values are noise, at least 10ms / 1MB of difference to count
+                floor = 0.01 if metric == 'seconds' else 1
+                ratios[metric] = max(values[metric], floor) / max(previous_stages[stage][metric], floor)
+
+            flag = ' <- regression' if max(ratios.values()) > REGRESSION_RATIO else ''
+            regressions += bool(flag)
+            print(f"  {stage:<40} time {ratios['seconds']:>6.2f}x   memory {ratios['peak_mb']:>6.2f}x{flag}")
+
+    return regressions
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline stages on synthetic data")
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 1, 5], help="Scales of the synthetic data (1 = 100k orders)")
+    parser.add_argument('--output', default=f"benchmark_stages_{datetime.now():%Y%m%d_%H%M%S}.json", help="Json file of the results")
+    parser.add_argument('--compare', help="Json file of previous results to compare with")
+    args = parser.parse_args()
+
+    memory = PeakMemory()
+    results = {
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpus': psutil.cpu_count(),
+        'scales': {}
+    }
+    for scale in args.scales:
+        print(f"\nScale {scale}")
+        results['scales'][str(scale)] = run_scale(scale, memory)
+    memory.stop()
+
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f"\nResults saved on {args.output}")
+
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,133 @@
+# Checks of src/analysis/cohorts.py: the cohort matrices against a groupby over the orders merged with the test and the
+#   consumers, for each cohort definition and frequency, and fold_in_activity with every day folded in twice
+# Usage: python tests/cohort_checks.py [amount_of_orders]
+
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.analysis.cohorts import cohort_matrices, customer_activity, fold_in_activity
+
+
+#==============================
+# Groupby reference
+#==============================
+def _bin_start(days: pd.Series, freq: str):
+    # First day of the day / week (monday) of each date
+    days = pd.to_datetime(days)
+    return days - pd.to_timedelta(days.dt.dayofweek, unit='D') if freq == 'W' else days
+
+
+def groupby_cohorts(orders, consumers, ab_test, cohort_by, cohort_freq, period_freq):
+    """
+    Customers, active customers and revenue of each (group, cohort) x period, merging the orders with the test
+    """
+    orders = orders.merge(ab_test, on='customer_id')
+    orders['day'] = pd.to_datetime(orders['order_created_at'].dt.tz_convert(None).dt.date)
+    if cohort_by == 'signup':
+        starts = consumers.drop_duplicates('customer_id').set_index('customer_id')['created_at'].dt.tz_convert(None).dt.floor('D')
+    else:
+        starts = orders.groupby('customer_id')['day'].min()
+    customers = ab_test[ab_test['customer_id'].isin(starts.index)].copy()
+    customers['cohort'] = _bin_start(customers['customer_id'].map(starts), cohort_freq).dt.date
+
+    cohort_start = _bin_start(orders['customer_id'].map(starts), cohort_freq)
+    orders['cohort'] = cohort_start.dt.date
+    orders['period'] = (_bin_start(orders['day'], period_freq) - _bin_start(cohort_start, period_freq)).dt.days // (7 if period_freq == 'W' else 1)
+    orders = orders[orders['period'] >= 0]
+
+    keys = ['is_target', 'cohort', 'period']
+    return {
+        'customers': customers.groupby(['is_target', 'cohort'], observed=True).size(),
+        'active': orders.groupby(keys, observed=True)['customer_id'].nunique().unstack(fill_value=0),
+        'revenue': orders.groupby(keys, observed=True)['order_total_amount'].sum().unstack(fill_value=0)
+    }
+
+
+
+#==============================
+# Checks
+#==============================
+def make_frames(n: int, seed: int = 42):
+    """
+    Orders of 6 weeks, consumers that signed up in the 4 weeks before (some without orders, some ordering before their
+    signup) and the ab_test, without some of the customers
+
+    Returns:
+        tuple: (orders, consumers, ab_test)
+    """
+    rng = np.random.default_rng(seed)
+    n_customers = max(n // 5, 10)
+    customer_ids = np.array([f'{k:064x}' for k in range(n_customers)], dtype=object)
+    consumers = pd.DataFrame({
+        'customer_id': customer_ids,
+        'created_at': pd.to_datetime(rng.integers(1_541_030_400, 1_543_622_400, n_customers), unit='s', utc=True)  # Nov/2018
+    })
+    ab_test = pd.DataFrame({'customer_id': customer_ids, 'is_target': pd.Categorical(rng.choice(['control', 'target'], n_customers))})
+    ab_test = ab_test[rng.random(n_customers) < 0.95].reset_index(drop=True)
+
+    created_at = pd.to_datetime(rng.integers(1_541_030_400, 1_544_659_200, n), unit='s', utc=True)  # Nov/2018 to mid Dec/2018
+    orders = pd.DataFrame({
+        'customer_id': customer_ids[rng.integers(0, int(n_customers * 0.9), n)],
+        'order_id': [f'{k:032x}' for k in range(n)],
+        'order_total_amount': np.round(rng.gamma(2, 25, n), 2),
+        'order_created_at': created_at,
+        'order_created_date': created_at.date
+    })
+    return orders, consumers, ab_test
+
+
+def check_matrices(orders, consumers, ab_test):
+    activity = customer_activity(orders)
+    for cohort_by in ['signup', 'first_order']:
+        for cohort_freq, period_freq in [('W', 'W'), ('D', 'D'), ('W', 'D')]:
+            start = time.perf_counter()
+            result = cohort_matrices(activity, consumers, ab_test, cohort_by=cohort_by, cohort_freq=cohort_freq, period_freq=period_freq)
+            elapsed = time.perf_counter() - start
+            expected = groupby_cohorts(orders, consumers, ab_test, cohort_by, cohort_freq, period_freq)
+            label = f"{cohort_by} {cohort_freq}/{period_freq}"
+
+            assert result['customers'].sum() == expected['customers'].sum(), f"{label}: sizes differ"
+            assert (result['customers'].reindex(expected['customers'].index) == expected['customers']).all(), f"{label}: sizes differ"
+            active = result['active'].reindex_like(expected['active']).fillna(0)
+            assert (active.to_numpy() == expected['active'].to_numpy()).all() and result['active'].to_numpy().sum() == expected['active'].to_numpy().sum(), \
+                f"{label}: active customers differ"
+            revenue = result['revenue'].reindex_like(expected['revenue']).fillna(0)
+            assert np.allclose(revenue.to_numpy(), expected['revenue'].to_numpy()), f"{label}: revenue differs"
+            assert np.allclose(result['retention'].to_numpy(), result['active'].div(result['customers'], axis=0).to_numpy())
+            print(f"OK cohort_matrices {label}: {result['retention'].shape} in {elapsed:.3f}s")
+    return activity
+
+
+def check_fold_in(orders, consumers, ab_test, activity):
+    # Days folded in one by one, each twice, and a batch of an old and a new day: the same matrices of all the orders at once
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / 'customer_activity.parquet'
+        dates = sorted(orders['order_created_date'].unique())
+        for date in dates[:-1]:
+            day = orders[orders['order_created_date'] == date]
+            fold_in_activity(day, path)
+            fold_in_activity(day, path)
+        fold_in_activity(orders[orders['order_created_date'].isin(dates[-2:])], path)
+        folded = pd.read_parquet(path)
+
+    assert len(folded) == len(activity), f"{len(folded)} customer days folded, expected {len(activity)}"
+    result, expected = cohort_matrices(folded, consumers, ab_test), cohort_matrices(activity, consumers, ab_test)
+    assert all(result[name].equals(expected[name]) for name in ['customers', 'active', 'orders']), "folded matrices differ"
+    assert np.allclose(result['revenue'].to_numpy(), expected['revenue'].to_numpy()), "folded revenue differs"
+    print(f"OK fold_in_activity: {len(dates)} days folded in twice, {len(folded)} customer days")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    orders, consumers, ab_test = make_frames(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
+    activity = check_matrices(orders, consumers, ab_test)
+    check_fold_in(orders, consumers, ab_test, activity)
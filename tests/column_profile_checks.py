@@ -0,0 +1,81 @@
+# Checks of src/data/column_profile.py: profiles by chunks against pandas, and no value of the ids, personal data or raw
+#   JSON columns on the sidecar
+# Usage: python tests/column_profile_checks.py [amount_of_rows]
+
+import json
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.column_profile import DatasetProfiler, read_profile
+
+
+#==============================
+# Checks
+#==============================
+def make_frame(n: int, seed: int = 42):
+    """
+    Orders like frame with ids, personal data, a raw JSON column and NAs
+    """
+    rng = np.random.default_rng(seed)
+    amounts = np.round(rng.gamma(2, 25, n), 2)
+    amounts[rng.random(n) < 0.02] = np.nan
+    return pd.DataFrame({
+        'order_id': [f'{k:032x}' for k in range(n)],
+        'customer_id': [f'{k:064x}' for k in rng.integers(0, n // 4, n)],
+        'cpf': [f'{k:011d}' for k in rng.integers(0, 10 ** 11, n)],
+        'customer_name': pd.Categorical(rng.choice(['MARIA', 'JOAO', 'ANA'], n)),
+        'items': [json.dumps([{'name': 'PIZZA', 'quantity': int(k)}]) for k in rng.integers(1, 5, n)],
+        'origin_platform': pd.Categorical(rng.choice(['ANDROID', 'IOS', 'DESKTOP', None], n)),
+        'order_total_amount': amounts
+    })
+
+
+def check(n: int):
+    df = make_frame(n)
+    profiler = DatasetProfiler()
+    for start in range(0, n, n // 5):
+        profiler.update(pa.Table.from_pandas(df.iloc[start:start + n // 5], preserve_index=False))
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = profiler.save(Path(folder) / 'orders.profile.json')
+        sidecar = path.read_text()
+        profile = read_profile('orders', folder)
+
+    # No value of the redacted and JSON columns on the sidecar
+    for column in ['order_id', 'customer_id', 'cpf', 'customer_name', 'items']:
+        for value in df[column].astype(str).unique()[:1000]:
+            assert value not in sidecar, f"value of {column} on the sidecar: {value}"
+        info = profile.columns[column]
+        assert info['min'] is None and info['max'] is None and 'top_values' not in info, f"{column} has values on the profile"
+        try:
+            profile.value_counts(column)
+            raise AssertionError(f"value_counts of {column} was answered")
+        except ValueError:
+            pass
+
+    # Counts of every column, and the values of the others, as pandas
+    summary = profile.summary()
+    assert (summary['nulls'] == df.isna().sum()[summary.index]).all(), summary['nulls']
+    for column in ['customer_id', 'cpf', 'customer_name']:
+        assert abs(summary.loc[column, 'distinct'] - df[column].nunique()) <= 0.05 * df[column].nunique(), column
+    assert profile.columns['items']['kind'] == 'nested'
+    assert (profile.value_counts('origin_platform') == df['origin_platform'].value_counts()).all()
+    assert summary.loc['order_total_amount', 'min'] == df['order_total_amount'].min()
+    assert summary.loc['order_total_amount', 'max'] == df['order_total_amount'].max()
+
+    print(f"OK column_profile: {n} rows, {len(profile.columns)} columns, redacted: "
+          f"{[column for column, info in profile.columns.items() if info['redacted']]}")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    check(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
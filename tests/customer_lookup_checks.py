@@ -0,0 +1,136 @@
+# Checks of src/data/customer_lookup.py: the records of the index against segment_customers and the A/B test, lookups of
+#   unknown, over-long, truncated and non ASCII ids, the HTTP endpoint, and an index replaced while it is read
+# Usage: python tests/customer_lookup_checks.py [amount_of_orders]
+
+import json
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.data_load import load_data
+from src.data.customer_lookup import CustomerIndex, build_customer_index, make_server
+from src.analysis.segmentation import segment_customers
+
+
+#==============================
+# Processed datasets
+#==============================
+def make_processed(folder: Path, n: int, seed: int = 42):
+    """
+    Write orders_processed and ab_test, with customers of the test without orders and orders out of the test
+
+    Returns:
+        tuple: (orders, ab_test)
+    """
+    rng = np.random.default_rng(seed)
+    n_customers = max(n // 4, 10)
+    customer_ids = np.array([f'{k:064x}' for k in range(n_customers)], dtype=object)
+    created_at = pd.to_datetime(rng.integers(1_543_622_400, 1_546_300_800, n), unit='s', utc=True)
+    orders = pd.DataFrame({
+        'customer_id': pd.array(customer_ids[rng.integers(0, n_customers, n)], dtype='str'),
+        'order_id': pd.array([f'{k:032x}' for k in range(n)], dtype='str'),
+        'order_created_at': created_at,
+        'order_total_amount': np.round(rng.gamma(2, 25, n), 2),
+        'order_created_date': pd.array(created_at.date, dtype='date32[pyarrow]')
+    })
+    ab_test = pd.DataFrame({
+        'customer_id': pd.array(customer_ids[rng.random(n_customers) < 0.9], dtype='str'),
+    })
+    ab_test['is_target'] = pd.Categorical(rng.choice(['control', 'target'], len(ab_test)))
+    load_data(orders, 'orders_processed', folder=folder, profile=False)
+    load_data(ab_test, 'ab_test', folder=folder, profile=False)
+    return orders, ab_test
+
+
+
+#==============================
+# Checks
+#==============================
+def check_records(index, orders, ab_test):
+    rfm = segment_customers(orders).set_index('customer_id')
+    groups = ab_test.set_index('customer_id')['is_target']
+    ids = list(pd.Index(groups.index).union(rfm.index))
+    records = index.get_many(ids)
+    assert len(index) == len(ids) and all(record is not None for record in records), "customers missing on the index"
+
+    for customer_id, record in zip(ids, records):
+        assert record['customer_id'] == customer_id
+        assert record['is_target'] == (groups[customer_id] if customer_id in groups.index else None), customer_id
+        if customer_id in rfm.index:
+            row = rfm.loc[customer_id]
+            assert record['hybrid_segment'] == row['hybrid_segment'] and record['frequency'] == row['frequency'], customer_id
+            assert isinstance(record['frequency'], int) and record['recency_days'] == row['recency_days'], customer_id
+            assert np.isclose(record['total_spend'], row['total_spend']), customer_id
+        else:
+            assert record['frequency'] is None and record['hybrid_segment'] is None, customer_id
+    assert index.get(ids[0]) == records[0]
+    print(f"OK records: {len(ids)} customers, {len(ids) - len(rfm)} without orders")
+    return ids
+
+
+def check_unknown(index, ids):
+    # Ids that are not on the index, including the ones numpy would truncate or change into an id of the index
+    existing = ids[0]
+    unknown = ['nope', '', existing + 'XYZ', existing + '\x00', existing[:-1], existing[:-1] + 'ç', 'ção' * 30, existing.upper() + 'A']
+    assert all(index.get(customer_id) is None for customer_id in unknown), [index.get(customer_id) for customer_id in unknown]
+    assert all(customer_id not in index for customer_id in unknown)
+
+    records = index.get_many(unknown + [existing])
+    assert records[:-1] == [None] * len(unknown) and records[-1]['customer_id'] == existing, records
+    print(f"OK unknown ids: {len(unknown)} never found, over-long and non ASCII included")
+
+
+def check_http(index, ids):
+    server = make_server(index, port=0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        record = json.loads(urllib.request.urlopen(f"{url}/customers/{ids[0]}").read())
+        assert record['customer_id'] == ids[0], record
+        for customer_id in ['nope', ids[0] + 'XYZ']:
+            try:
+                urllib.request.urlopen(f"{url}/customers/{customer_id}")
+                raise AssertionError(f"{customer_id} was found")
+            except urllib.error.HTTPError as e:
+                assert e.code == 404, e.code
+
+        request = urllib.request.Request(f"{url}/customers", data=json.dumps({'customer_ids': [ids[0], ids[0] + 'XYZ']}).encode(), method='POST')
+        records = json.loads(urllib.request.urlopen(request).read())['records']
+        assert records[0]['customer_id'] == ids[0] and records[1] is None, records
+    finally:
+        server.shutdown()
+        server.server_close()
+    print("OK HTTP endpoint: single, batched and unknown ids")
+
+
+def check_reload(index, folder: Path, orders, ab_test, ids):
+    # The index replaced in place (a customer without orders anymore) is picked up by the running reader
+    index.reload_interval = 0
+    load_data(orders[orders['customer_id'] != ids[0]], 'orders_processed', folder=folder, profile=False)
+    build_customer_index(folder, index.path)
+    record = index.get(ids[0])
+    assert record is None or record['frequency'] is None, record
+    print("OK reload: rebuilt index picked up")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        orders, ab_test = make_processed(folder, n)
+        index = CustomerIndex(build_customer_index(folder))
+        ids = check_records(index, orders, ab_test)
+        check_unknown(index, ids)
+        check_http(index, ids)
+        check_reload(index, folder, orders, ab_test, ids)
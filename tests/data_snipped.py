@@ -1,12 +1,25 @@
+import sys
+from datetime import date
+from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
 
-import pandas as pd
+from src.data.catalog import Catalog
 
 
-df_ab_test = pd.read_parquet("./data/processed/ab_test.parquet")
-df_consumers = pd.read_parquet("./data/processed/consumers_processed.parquet")
-df_orders = pd.read_parquet("./data/processed/orders_processed.parquet")
-df_restaurants = pd.read_parquet("./data/processed/restaurants_processed.parquet")
+catalog = Catalog(root=Path(__file__).resolve().parents[1])
+print(catalog)
+
+df_ab_test = catalog.read("ab_test")
+df_consumers = catalog.read("consumers_processed")
+df_restaurants = catalog.read("restaurants_processed")
+
+# Orders are partitioned by day, reading only the needed columns of a single day
+df_orders = catalog.read(
+    "orders_processed",
+    columns=['order_id', 'customer_id', 'order_created_at', 'order_total_amount'],
+    filters=[('order_created_date', '=', date(2019, 1, 1))]
+)
 
 
 print(df_ab_test.head())
@@ -0,0 +1,117 @@
+# Checks of convert_column (src/data/data_transformation.py): the datetime format detected for ISO and other formats,
+#   a cached format detected again when a later batch doesn't match it, and the invalid values turned into null with
+#   their amount on the stage metrics (coerced_nulls)
+# Usage: python tests/datetime_conversion_checks.py [rows]
+
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data import instrumentation
+from src.data.data_transformation import convert_column, _detected_formats
+
+
+#==============================
+# Define constants
+#==============================
+# Column -> (format written, format that must be detected); '%Y-%m-%d %H:%M:%S' is also read by the ISO8601 parser
+FORMATS = {
+    'iso_utc': ('%Y-%m-%dT%H:%M:%S.000Z', 'ISO8601'),
+    'iso_space': ('%Y-%m-%d %H:%M:%S', 'ISO8601'),
+    'day_first_time': ('%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S'),
+    'day_first': ('%d/%m/%Y', '%d/%m/%Y'),
+    'month_first': ('%m/%d/%Y', '%m/%d/%Y'),
+    'written_month': ('%B %d, %Y %H:%M', None),
+}
+
+
+
+#==============================
+# Data
+#==============================
+def make_timestamps(n: int, seed: int = 42):
+    # Timestamps of the period of the sources, to the second; the day goes past 12 so day and month first differ
+    rng = np.random.default_rng(seed)
+    return pd.Series(pd.to_datetime(rng.integers(1_543_622_400, 1_548_979_200, n), unit='s'))
+
+
+def expected_values(timestamps: pd.Series, written: str):
+    # What the strings written with a format hold: the date only or the minute, on UTC for the 'Z' suffix
+    expected = pd.to_datetime(timestamps.dt.strftime(written.replace('.000Z', '')), format=written.replace('.000Z', ''))
+    return expected.dt.tz_localize('UTC') if written.endswith('Z') else expected
+
+
+
+#==============================
+# Checks
+#==============================
+def check_detected(timestamps: pd.Series):
+    df = pd.DataFrame({column: timestamps.dt.strftime(written) for column, (written, _) in FORMATS.items()})
+    df = convert_column(df, [(column, 'datetime') for column in FORMATS])
+
+    for column, (written, detected) in FORMATS.items():
+        assert _detected_formats[column] == detected, f"{column}: detected {_detected_formats[column]}, expected {detected}"
+        expected = expected_values(timestamps, written)
+        assert df[column].notna().all(), f"{column}: {df[column].isna().sum()} nulls"
+        assert (df[column].to_numpy() == expected.to_numpy()).all(), f"{column}: values differ"
+    print(f"OK detected formats: {', '.join(str(detected) for _, detected in FORMATS.values())}")
+
+
+def check_cached(timestamps: pd.Series):
+    # Batches of the same column: ISO, then day first (not read by the cached ISO8601), then ISO again
+    column = 'created_at'
+    for written, detected in [('%Y-%m-%dT%H:%M:%S.000Z', 'ISO8601'), ('%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S'), ('%Y-%m-%dT%H:%M:%S.000Z', 'ISO8601')]:
+        df = convert_column(pd.DataFrame({column: timestamps.dt.strftime(written)}), [(column, 'datetime')])
+        assert _detected_formats[column] == detected, f"{written}: cached {_detected_formats[column]}, expected {detected}"
+        assert df[column].notna().all(), f"{written}: {df[column].isna().sum()} nulls with the cached format"
+        assert (df[column].to_numpy() == expected_values(timestamps, written).to_numpy()).all(), f"{written}: values differ"
+    print("OK cached format: detected again on a batch that doesn't match it, no values turned into null")
+
+
+def check_coerced_nulls(timestamps: pd.Series, folder: Path):
+    # Invalid values of each dtype among valid ones, and values already null that are not counted
+    n = len(timestamps)
+    df = pd.DataFrame({
+        'order_created_at': timestamps.dt.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'order_created_date': timestamps.dt.strftime('%Y-%m-%d'),
+        'quantity': pd.Series(np.arange(n).astype(str), dtype=object),
+        'price': pd.Series(np.arange(n) / 4, dtype=object)
+    })
+    invalid = {'order_created_at': ['2019-13-01T00:00:00.000Z', 'yesterday', ''], 'order_created_date': ['2019-02-30'],
+               'quantity': ['two', '1.5.0'], 'price': ['R$ 10']}
+    for column, values in invalid.items():
+        df.loc[:len(values) - 1, column] = values
+    df.loc[n - 2:, list(invalid)] = None
+    conversions = [('order_created_at', 'datetime'), ('order_created_date', 'date'), ('quantity', 'int'), ('price', 'float')]
+
+    path = instrumentation.configure(run_id='datetime_conversion_checks', folder=folder)
+    try:
+        df = convert_column(df, conversions)
+    finally:
+        instrumentation.configure(enabled=False)
+
+    for column, values in invalid.items():
+        assert df[column].iloc[:len(values)].isna().all(), f"{column}: invalid values not null"
+        assert df[column].isna().sum() == len(values) + 2, f"{column}: {df[column].isna().sum()} nulls"
+    assert df['order_created_at'].iloc[len(invalid['order_created_at'])] == expected_values(timestamps, '%Y-%m-%dT%H:%M:%S.000Z').iloc[3]
+
+    record = next(entry for entry in instrumentation.read_metrics(path) if entry['stage'] == 'convert_column')
+    assert record['coerced_nulls'] == {column: len(values) for column, values in invalid.items()}, record['coerced_nulls']
+    assert record['rows_in'] == n, record
+    print(f"OK coerced nulls: {record['coerced_nulls']} on the stage metrics, values already null not counted")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    timestamps = make_timestamps(int(sys.argv[1]) if len(sys.argv) > 1 else 5_000)
+    check_detected(timestamps)
+    check_cached(timestamps)
+    with tempfile.TemporaryDirectory() as folder:
+        check_coerced_nulls(timestamps, Path(folder))
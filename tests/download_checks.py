@@ -0,0 +1,218 @@
+# Checks of the downloader (src/data/downloader.py) against a local HTTP server standing in for S3
+# The server sends ETags (MD5 of the files), answers Range requests and can drop the connection in the middle of a file
+# Usage: python tests/download_checks.py [file_mb]
+
+import hashlib
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import requests
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.downloader import download, download_all, make_session, DownloadError
+
+
+#==============================
+# Local server
+#==============================
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _file(self):
+        path = self.server.folder / self.path.lstrip('/')
+        return path if path.is_file() else None
+
+    def _headers(self, path: Path, status: int, length: int, content_range: str = None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', f'"{hashlib.md5(path.read_bytes()).hexdigest()}"')
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._file()
+        if path is None:
+            self.send_error(404)
+            return
+        self._headers(path, 200, path.stat().st_size)
+
+    def do_GET(self):
+        path = self._file()
+        if path is None:
+            self.send_error(404)
+            return
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.path.lstrip('/') in self.server.fail:
+            self.send_error(500)
+            return
+        time.sleep(self.server.delay.get(self.path.lstrip('/'), 0))
+
+        data = path.read_bytes()
+        start = 0
+        if self.server.ranges and self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self._headers(path, 206, len(data) - start, f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self._headers(path, 200, len(data))
+
+        # Drops the connection once, after sending part of the body
+        cut = self.server.cut_after.pop(self.path.lstrip('/'), None)
+        body = data[start:start + cut] if cut is not None else data[start:]
+        self.wfile.write(body)
+        if cut is not None:
+            self.close_connection = True
+            self.wfile.flush()
+            self.connection.shutdown(2)
+
+
+@contextmanager
+def serve(folder: Path, ranges: bool = True):
+    """
+    Serve the files of a folder on a random local port
+
+    Yields:
+        ThreadingHTTPServer: with base_url, requests (path, Range header) and the settings delay, cut_after (file -> bytes)
+            and fail (files whose GET answers 500)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.folder = Path(folder)
+    server.ranges = ranges
+    server.requests = []
+    server.delay = {}
+    server.cut_after = {}
+    server.fail = set()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+
+#==============================
+# Checks
+#==============================
+def run_checks(file_mb: int = 8):
+    rng = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as tmp:
+        remote, local = Path(tmp) / 'remote', Path(tmp) / 'local'
+        remote.mkdir()
+        sizes = {'orders.json.gz': file_mb, 'consumers.csv.gz': 2, 'restaurants.csv.gz': 1, 'ab_test.tar.gz': 1}
+        for name, mb in sizes.items():
+            (remote / name).write_bytes(rng.bytes(mb * 1024 * 1024))
+
+        with serve(remote) as server:
+            urls = {name: f"{server.base_url}/{name}" for name in sizes}
+            session = make_session()
+
+            # Concurrent: the cold start takes about the slowest file, not the sum
+            server.delay = {name: 0.5 for name in sizes}
+            start = time.perf_counter()
+            results = download_all(urls, local, session=session)
+            elapsed = time.perf_counter() - start
+            assert all(isinstance(path, Path) for path in results.values()), results
+            assert all((local / name).read_bytes() == (remote / name).read_bytes() for name in sizes)
+            assert elapsed < 0.5 * len(sizes), elapsed
+            print(f"concurrent: OK - {len(sizes)} files in {elapsed:.2f}s (each file waits 0.5s)")
+            server.delay = {}
+
+            # Already verified: no GET
+            server.requests.clear()
+            download_all(urls, local, session=session)
+            assert not server.requests, server.requests
+            print("verified files skipped: OK")
+
+            # Connection dropped in the middle: resumed with a Range request
+            name = 'orders.json.gz'
+            for path in local.glob(f"{name}*"):
+                path.unlink()
+            server.requests.clear()
+            server.cut_after = {name: 3 * 1024 * 1024 + 7}
+            download(urls[name], local / name, session=session)
+            assert (local / name).read_bytes() == (remote / name).read_bytes()
+            # Resumed from the bytes written before the drop (whole chunks)
+            assert len(server.requests) == 2 and server.requests[-1][1] == f"bytes={3 * 1024 * 1024}-", server.requests
+            print("interrupted download resumed: OK")
+
+            # Partial file left by the old downloader (no .download.json): resumed, not taken as complete
+            (local / 'consumers.csv.gz.download.json').unlink()
+            (local / 'consumers.csv.gz').write_bytes((remote / 'consumers.csv.gz').read_bytes()[:1000])
+            server.requests.clear()
+            download(urls['consumers.csv.gz'], local / 'consumers.csv.gz', session=session)
+            assert (local / 'consumers.csv.gz').read_bytes() == (remote / 'consumers.csv.gz').read_bytes()
+            assert server.requests == [('/consumers.csv.gz', 'bytes=1000-')], server.requests
+            print("legacy partial file resumed: OK")
+
+            # Failed fetch of a file without .download.json: the file is kept for the offline runs, and resumed on the next one
+            name = 'consumers.csv.gz'
+            (local / f"{name}.download.json").unlink()
+            (local / name).write_bytes((remote / name).read_bytes()[:1000])
+            server.fail = {name}
+            try:
+                download(urls[name], local / name, session=make_session(retries=0))
+                raise AssertionError("The failed fetch was accepted")
+            except requests.RequestException:
+                pass
+            assert (local / name).read_bytes() == (remote / name).read_bytes()[:1000], "the existing file was lost"
+            server.fail = set()
+            server.requests.clear()
+            download(urls[name], local / name, session=session)
+            assert (local / name).read_bytes() == (remote / name).read_bytes()
+            assert server.requests == [(f'/{name}', 'bytes=1000-')], server.requests
+            print("existing file kept on a failed fetch: OK")
+
+            # Corrupted part: fails the MD5 check, is deleted, and the next try downloads it again
+            name = 'restaurants.csv.gz'
+            download(urls[name], local / name, session=session)
+            (local / name).unlink()
+            (local / f"{name}.download.json").unlink()
+            data = bytearray((remote / name).read_bytes())
+            data[10] ^= 0xFF
+            (local / f"{name}.part").write_bytes(bytes(data))
+            (local / f"{name}.part.download.json").write_text(f'{{"etag": "\\"{hashlib.md5((remote / name).read_bytes()).hexdigest()}\\""}}')
+            try:
+                download(urls[name], local / name, session=session)
+                raise AssertionError("The corrupted part was accepted")
+            except DownloadError:
+                pass
+            assert not (local / f"{name}.part").exists() and not (local / name).exists()
+            download(urls[name], local / name, session=session)
+            assert (local / name).read_bytes() == (remote / name).read_bytes()
+            print("corrupted part rejected: OK")
+
+            # Remote file changed (new ETag): downloaded again
+            (remote / 'ab_test.tar.gz').write_bytes(rng.bytes(1024 * 1024))
+            download(urls['ab_test.tar.gz'], local / 'ab_test.tar.gz', session=session)
+            assert (local / 'ab_test.tar.gz').read_bytes() == (remote / 'ab_test.tar.gz').read_bytes()
+            print("changed remote downloaded again: OK")
+
+        # Server without Range support: an interrupted download starts again from zero
+        with serve(remote, ranges=False) as server:
+            name = 'orders.json.gz'
+            for path in local.glob(f"{name}*"):
+                path.unlink()
+            server.cut_after = {name: 1024 * 1024}
+            download(f"{server.base_url}/{name}", local / name, session=make_session())
+            assert (local / name).read_bytes() == (remote / name).read_bytes()
+            assert all(header is None for _, header in server.requests), server.requests
+            print("server without ranges: OK")
+
+
+if __name__ == "__main__":
+    run_checks(int(sys.argv[1]) if len(sys.argv) > 1 else 8)
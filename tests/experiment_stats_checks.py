@@ -0,0 +1,108 @@
+# Checks of src/analysis/experiment_stats.py against src/analysis/ab_metrics.py: the accumulators updated with batches,
+#   merged from chunks and refreshed day by day (with days added twice) give the KPIs and Welch t-tests of all the orders
+# Usage: python tests/experiment_stats_checks.py [amount_of_orders]
+
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy import stats
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.analysis.ab_metrics import group_kpis, ttest_arrays, user_metrics, welch_tests
+from src.analysis.experiment_stats import ExperimentAccumulator, refresh_experiment
+
+
+#==============================
+# Checks
+#==============================
+def make_frames(n: int, seed: int = 42):
+    """
+    Orders of 10 days and the ab_test, with orders of users out of the test and NA order values
+
+    Parameters:
+        n: amount of orders
+
+    Returns:
+        tuple: (orders, ab_test)
+    """
+    rng = np.random.default_rng(seed)
+    n_users = max(n // 5, 10)
+    ab_test = pd.DataFrame({
+        'customer_id': pd.array([f'u{k}' for k in range(n_users)], dtype='str'),
+        'is_target': pd.Categorical(rng.choice(['control', 'target'], n_users))
+    })
+    created_at = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 10, n), 'D')
+    orders = pd.DataFrame({
+        'customer_id': pd.array([f'u{k}' for k in rng.integers(0, n_users + n_users // 20, n)], dtype='str'),
+        'order_total_amount': np.where(rng.random(n) < 0.05, np.nan, rng.gamma(2, 30, n)),
+        'order_created_date': created_at.date
+    })
+    return orders, ab_test
+
+
+def assert_same(accumulator, per_user, label):
+    # KPIs and t-tests of the accumulator against ab_metrics on all the orders
+    kpis, expected_kpis = accumulator.kpis(), group_kpis(per_user)
+    assert np.allclose(kpis.to_numpy(dtype=float), expected_kpis.to_numpy(dtype=float), rtol=1e-9), f"{label}: KPIs differ\n{kpis}\n{expected_kpis}"
+
+    columns = ['mean_variant', 'mean_control', 't_stat', 'p_value']
+    tests, expected_tests = accumulator.welch_tests(), welch_tests(per_user)
+    assert (tests[['variant', 'metric']].to_numpy() == expected_tests[['variant', 'metric']].to_numpy()).all(), f"{label}: tests differ"
+    assert np.allclose(tests[columns].to_numpy(dtype=float), expected_tests[columns].to_numpy(dtype=float), rtol=1e-9), \
+        f"{label}: t-tests differ\n{tests}\n{expected_tests}"
+
+
+def check(orders, ab_test):
+    per_user = user_metrics(orders, ab_test)
+
+    start = time.perf_counter()
+    full = ExperimentAccumulator(ab_test).update(orders)
+    full_time = time.perf_counter() - start
+    assert_same(full, per_user, 'one update')
+
+    # Confidence interval of the difference of the means, as scipy's Welch t-test
+    arrays = ttest_arrays(per_user)
+    tests = full.welch_tests().set_index('metric')
+    for metric in ['qt_orders', 'avg_value']:
+        interval = stats.ttest_ind(arrays['target'][metric], arrays['control'][metric], equal_var=False).confidence_interval(0.95)
+        assert np.allclose([tests.loc[metric, 'ci_low'], tests.loc[metric, 'ci_high']], [interval.low, interval.high]), f"CI of {metric} differs"
+
+    # Many small batches: the users of a batch already seen move their moments
+    incremental = ExperimentAccumulator(ab_test)
+    for batch in range(37):
+        incremental.update(orders.iloc[batch::37])
+    assert_same(incremental, per_user, 'batches')
+
+    # Accumulators of separate chunks (ex.: worker processes) merged
+    parts = [ExperimentAccumulator(ab_test).update(orders.iloc[part::4]) for part in range(4)]
+    merged = parts[0]
+    for part in parts[1:]:
+        merged.merge(part)
+    assert_same(merged, per_user, 'merge')
+
+    # Daily refresh from the stored state, with every day added twice
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / 'experiment_state.parquet'
+        start = time.perf_counter()
+        for _, day in orders.groupby('order_created_date'):
+            refresh_experiment(day, ab_test, path)
+            refreshed = refresh_experiment(day, ab_test, path)
+        refresh_time = time.perf_counter() - start
+        assert_same(refreshed, per_user, 'refresh')
+        assert_same(ExperimentAccumulator.load(path)[0], per_user, 'stored state')
+
+    print(f"OK experiment_stats: {len(orders)} orders, one update {full_time:.2f}s, "
+          f"{orders['order_created_date'].nunique()} days refreshed twice {refresh_time:.2f}s")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    check(*make_frames(n))
@@ -0,0 +1,113 @@
+# Checks of src/data/geo.py: the DDD -> state lookups against STATE_DDD, merchant_locations by chunks against the whole
+#   orders, and the radius / nearest queries of MerchantIndex against a brute force scan of every merchant
+# Usage: python tests/geo_checks.py [amount_of_merchants] [amount_of_queries]
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.geo import STATE_DDD, MerchantIndex, haversine_km, merchant_locations, phone_area_state, phone_area_state_arrow
+
+
+#==============================
+# Checks
+#==============================
+def check_states():
+    areas = pd.Series(pd.array([11, 21, 23, 99, 0, None, 100, -5, 85], dtype='Int16'))
+    expected = areas.map(STATE_DDD)
+    states = phone_area_state(areas).astype(object)
+    assert (states.isna() == expected.isna()).all() and (states.dropna() == expected.dropna()).all(), f"{states}\n{expected}"
+
+    arrow_states = phone_area_state_arrow(pa.chunked_array([pa.array(areas.astype(object).where(areas.notna(), None), pa.int16())]))
+    assert arrow_states.to_pylist() == [None if pd.isna(state) else state for state in expected], arrow_states.to_pylist()
+    print(f"OK phone_area_state: {len(areas)} areas")
+
+
+def make_orders(rng, n_merchants: int, n_orders: int):
+    """
+    Orders of merchants spread over the globe (also on the poles and the antimeridian), with invalid and missing
+    coordinates and merchants that moved
+    """
+    latitude = np.concatenate([rng.uniform(-25, -20, n_merchants // 2), rng.uniform(-90, 90, n_merchants - n_merchants // 2 - 4), [89.99, -89.99, 0, 0]])
+    longitude = np.concatenate([rng.uniform(-48, -43, n_merchants // 2), rng.uniform(-180, 180, n_merchants - n_merchants // 2 - 4), [10, -10, 179.99, -179.99]])
+    merchant = rng.integers(0, n_merchants, n_orders)
+    moved = rng.random(n_orders) < 0.1
+    orders = pd.DataFrame({
+        'merchant_id': np.array([f'm{k:063d}' for k in range(n_merchants)], dtype=object)[merchant],
+        'merchant_latitude': np.where(moved, latitude[merchant] + 0.01, latitude[merchant]).round(6).astype(str),
+        'merchant_longitude': longitude[merchant].round(6).astype(str),
+        'order_created_at': pd.to_datetime(rng.integers(1_543_622_400, 1_546_300_800, n_orders), unit='s', utc=True)
+    })
+    orders.loc[rng.random(n_orders) < 0.01, 'merchant_latitude'] = None
+    orders.loc[rng.random(n_orders) < 0.01, 'merchant_longitude'] = '999'
+    return orders
+
+
+def check_locations(orders):
+    locations = merchant_locations(orders)
+
+    # Reference: the latest order with valid coordinates of each merchant
+    latitude = pd.to_numeric(orders['merchant_latitude'], errors='coerce')
+    longitude = pd.to_numeric(orders['merchant_longitude'], errors='coerce')
+    valid = orders[latitude.between(-90, 90) & longitude.between(-180, 180)].assign(lat=latitude, lon=longitude)
+    latest = valid.sort_values(['merchant_id', 'order_created_at', 'lat', 'lon']).drop_duplicates('merchant_id', keep='last').set_index('merchant_id')
+    latest = latest.loc[locations['merchant_id']]
+    assert (locations['merchant_latitude'].to_numpy() == latest['lat'].to_numpy()).all(), "latitudes differ"
+    assert (locations['merchant_longitude'].to_numpy() == latest['lon'].to_numpy()).all(), "longitudes differ"
+
+    # Chunks combined with the same function give the same locations
+    size = len(orders) // 7 + 1
+    chunks = pd.concat([merchant_locations(orders.iloc[start:start + size]) for start in range(0, len(orders), size)], ignore_index=True)
+    combined = merchant_locations(chunks)
+    assert combined.equals(locations), "chunked locations differ"
+    print(f"OK merchant_locations: {len(locations)} merchants of {len(orders)} orders, by chunks too")
+    return locations
+
+
+def check_index(locations, rng, n_queries: int):
+    index = MerchantIndex(locations)
+    latitude = locations['merchant_latitude'].to_numpy()
+    longitude = locations['merchant_longitude'].to_numpy()
+    merchant_id = locations['merchant_id'].to_numpy()
+
+    points = [(89.9, 0), (-89.9, 170), (0, 179.99), (0, -179.99), (-23.55, -46.63)] + \
+             list(zip(rng.uniform(-90, 90, n_queries), rng.uniform(-180, 180, n_queries)))
+    index_time = scan_time = 0
+    for latitude_point, longitude_point in points:
+        for radius_km in (1, 50, 800):
+            start = time.perf_counter()
+            result = index.within(latitude_point, longitude_point, radius_km)
+            index_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            distance = haversine_km(latitude_point, longitude_point, latitude, longitude)
+            expected = set(merchant_id[distance <= radius_km])
+            scan_time += time.perf_counter() - start
+
+            assert set(result['merchant_id']) == expected, f"within({latitude_point}, {longitude_point}, {radius_km}) differs"
+            assert result['distance_km'].is_monotonic_increasing
+
+        nearest = index.nearest(latitude_point, longitude_point, k=5)
+        expected = np.sort(haversine_km(latitude_point, longitude_point, latitude, longitude))[:5]
+        assert np.allclose(nearest['distance_km'].to_numpy(), expected), f"nearest({latitude_point}, {longitude_point}) differs"
+
+    print(f"OK MerchantIndex: {len(points) * 3} radius queries, index {index_time:.2f}s, scan {scan_time:.2f}s")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n_merchants = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rng = np.random.default_rng(42)
+
+    check_states()
+    locations = check_locations(make_orders(rng, n_merchants, n_merchants * 5))
+    check_index(locations, rng, n_queries)
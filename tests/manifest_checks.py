@@ -0,0 +1,270 @@
+# Checks of the run manifest (src/data/manifest.py and the code lists of main.py) on a copy of the repo with synthetic
+#   raw files: the code lists cover every module of the stages, a warm rerun (or a touch without changes) writes nothing,
+#   and a change of a raw file, a transform spec, the dtype registry or each file of the code lists writes again only
+#   the outputs that depend on it
+# Usage: python tests/manifest_checks.py [scale]
+
+import ast
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from dataclasses import replace
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from tests.synthetic_data import generate
+
+
+#==============================
+# Define constants
+#==============================
+repo_dir = Path(__file__).resolve().parents[1]
+
+# Modules of the stages that don't change what they write (logs, metrics, scheduling, the downloads are hashed as raw files)
+NO_OUTPUT_CODE = {'src/data/instrumentation.py', 'src/data/scheduler.py', 'src/data/manifest.py', 'src/data/downloader.py'}
+
+# Modules run by each code list of main.py, with the modules they import
+STAGE_MODULES = {
+    'EXTRACT_CODE': ['src/data/data_extraction.py'],
+    'PROCESS_CODE': ['src/data/data_extraction.py', 'src/data/transform_engine.py', 'src/data/transform_specs.py',
+                     'src/data/order_items.py', 'src/data/geo.py', 'src/data/out_of_core.py', 'src/data/data_load.py'],
+    'STAR_CODE': ['src/data/star_schema.py'],
+    'INDEX_CODE': ['src/data/customer_lookup.py']
+}
+# The fingerprint of a stage has the fingerprints of the stages it reads, so it covers their code lists too
+UPSTREAM_CODE = {'PROCESS_CODE': ['EXTRACT_CODE'], 'STAR_CODE': ['EXTRACT_CODE'], 'INDEX_CODE': ['EXTRACT_CODE']}
+# Imported by a stage but not used on its outputs: the extracted parquet is written without a profile
+UNUSED_CODE = {'EXTRACT_CODE': {'src/data/column_profile.py'}}
+
+# Manifest entries of the extracted and processed files of each raw file; every processed dataset is read by the star
+RAW_OUTPUTS = {
+    'orders.json.gz': {'extracted__orders.parquet', 'processed__orders_processed.parquet', 'processed__order_items.parquet',
+                       'processed__merchant_locations.parquet'},
+    'consumers.csv.gz': {'extracted__consumers.parquet', 'processed__consumers_processed.parquet'},
+    'restaurants.csv.gz': {'extracted__restaurants.parquet', 'processed__restaurants_processed.parquet'},
+    'ab_test.tar.gz': {'extracted__ab_test.parquet', 'processed__ab_test.parquet'}
+}
+STAR_OUTPUT = 'processed__orders_star.parquet'
+INDEX_OUTPUT = 'processed__customer_index.parquet'
+
+
+
+#==============================
+# Pipeline on a copy of the repo
+#==============================
+def make_workspace(folder: Path, scale: float):
+    """
+    Copy main.py and src/ to a folder, with synthetic raw files on its data/raw
+    """
+    shutil.copy(repo_dir / 'main.py', folder / 'main.py')
+    shutil.copytree(repo_dir / 'src', folder / 'src', ignore=shutil.ignore_patterns('__pycache__'))
+    generate(folder / 'data/raw', scale)
+    return folder
+
+
+def run_stages_offline(memory_budget: int = None):
+    # Worker of run_pipeline: the stages of main.py from the current folder, without the downloads (raw files already there)
+    sys.path.insert(0, os.getcwd())
+    import main
+    from src.data.scheduler import run_stages
+    assert Path(main.__file__).resolve().parent == Path.cwd().resolve(), f"main.py of the repo imported: {main.__file__}"
+
+    for folder in ['data/extracted', 'data/processed']:
+        Path(folder).mkdir(parents=True, exist_ok=True)
+    stages = [
+        replace(item, depends_on=[name for name in item.depends_on if not name.startswith('download_')])
+        for item in main.build_stages(main.URLS, memory_budget=memory_budget) if not item.io
+    ]
+    status = run_stages(stages, max_workers=2)
+    assert all(result == 'success' for result in status.values()), status
+
+
+def run_pipeline(workspace: Path, memory_budget: int = None):
+    """
+    Run the pipeline of the workspace on another process (its modules, not the ones of this repo)
+
+    Parameters:
+        workspace: folder made by make_workspace
+        memory_budget: bytes for data of each process stage (out-of-core mode), None to process in memory
+
+    Returns:
+        set: outputs written by the run, as the names of their manifest entries (ex.: 'processed__orders_star.parquet')
+    """
+    before = manifest_entries(workspace)
+    command = [sys.executable, str(Path(__file__).resolve()), '--run'] + ([str(memory_budget)] if memory_budget else [])
+    result = subprocess.run(command, cwd=workspace, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr[-3000:]
+    after = manifest_entries(workspace)
+    return {name for name, created_at in after.items() if before.get(name) != created_at}
+
+
+def manifest_entries(workspace: Path):
+    # Entry of each output -> when it was recorded
+    return {path.stem: json.loads(path.read_text())['created_at'] for path in (workspace / 'data/manifest').glob('*.json')}
+
+
+def edit(path: Path, old: str, new: str):
+    content = path.read_text()
+    assert old in content, f"{old} not found on {path}"
+    path.write_text(content.replace(old, new))
+
+
+
+#==============================
+# Checks
+#==============================
+def _imported_files(module: str, seen: set):
+    # src modules imported by a module, and by the modules it imports
+    if module in seen:
+        return seen
+    seen.add(module)
+    for node in ast.walk(ast.parse((repo_dir / module).read_text())):
+        if isinstance(node, ast.ImportFrom) and node.module and node.module.startswith('src'):
+            names = [node.module] if node.module != 'src.data' else [f"src.data.{alias.name}" for alias in node.names]
+            for name in names:
+                _imported_files(name.replace('.', '/') + '.py', seen)
+    return seen
+
+
+def check_code_lists():
+    # Every module run by a stage is on its code list, so a change on it makes the outputs stale
+    import main
+    for code_list, modules in STAGE_MODULES.items():
+        listed = {
+            path.relative_to(repo_dir).as_posix()
+            for name in [code_list] + UPSTREAM_CODE.get(code_list, []) for path in getattr(main, name)
+        }
+        imported = set()
+        for module in modules:
+            _imported_files(module, imported)
+        missing = imported - listed - NO_OUTPUT_CODE - UNUSED_CODE.get(code_list, set())
+        assert not missing, f"{code_list} misses {sorted(missing)}"
+    print(f"OK code lists: {', '.join(STAGE_MODULES)} cover the modules of their stages")
+
+
+def check_spec_fingerprints(workspace: Path):
+    # The spec of a dataset is only on its processed fingerprint (an edit of transform_specs.py changes PROCESS_CODE too)
+    import main
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    try:
+        before = {filename: main.stage_fingerprints(filename, filename.split('.')[0]) for filename in main.URLS}
+        spec = main.TRANSFORM_SPECS['consumers']
+        main.TRANSFORM_SPECS['consumers'] = dict(spec, na=[(['customer_name'], 'fill', 'unknown')])
+        try:
+            after = {filename: main.stage_fingerprints(filename, filename.split('.')[0]) for filename in main.URLS}
+        finally:
+            main.TRANSFORM_SPECS['consumers'] = spec
+    finally:
+        os.chdir(cwd)
+
+    changed = {filename for filename in main.URLS if before[filename][1] != after[filename][1]}
+    assert changed == {'consumers.csv.gz'}, f"processed fingerprints changed by the consumers spec: {sorted(changed)}"
+    assert all(before[filename][0] == after[filename][0] for filename in main.URLS), "extracted fingerprint changed by a spec"
+    print("OK spec fingerprints: a spec changes only the processed fingerprint of its dataset")
+
+
+def check_warm_rerun(workspace: Path):
+    # Nothing changed, then the raw files and a code file touched (same content, new mtime): every output is skipped
+    assert not (rewritten := run_pipeline(workspace)), f"written again on a warm rerun: {sorted(rewritten)}"
+    for path in list((workspace / 'data/raw').iterdir()) + [workspace / 'src/data/star_schema.py']:
+        os.utime(path)
+    assert not (rewritten := run_pipeline(workspace)), f"written again after a touch: {sorted(rewritten)}"
+    print("OK warm rerun: every stage skipped, also after touching the raw files and a code file")
+
+
+def check_raw_changes(workspace: Path):
+    # Each raw file with new bytes (the gzip header with another mtime, same data): its outputs, the star and the index
+    import main
+    for filename, raw_outputs in RAW_OUTPUTS.items():
+        path = workspace / 'data/raw' / filename
+        content = path.read_bytes()
+        path.write_bytes(gzip.compress(gzip.decompress(content), mtime=int.from_bytes(content[4:8], 'little') + 1))
+
+        expected = raw_outputs | {STAR_OUTPUT} | ({INDEX_OUTPUT} if filename in main.INDEX_INPUTS else set())
+        rewritten = run_pipeline(workspace)
+        assert rewritten == expected, f"{filename}: written again {sorted(rewritten)}, expected {sorted(expected)}"
+    print(f"OK raw changes: each of the {len(RAW_OUTPUTS)} raw files makes only its outputs, the star and the index stale")
+
+
+def check_spec_edit(workspace: Path, outputs: set):
+    # A transform spec edited: every processed output, as transform_specs.py is on PROCESS_CODE, none of the extracted
+    edit(workspace / 'src/data/transform_specs.py', "(['customer_name'], 'fill', 'n/d')", "(['customer_name'], 'fill', 'unknown')")
+    rewritten = run_pipeline(workspace)
+    expected = {name for name in outputs if name.startswith('processed__')}
+    assert rewritten == expected, f"spec edit: written again {sorted(rewritten)}, expected {sorted(expected)}"
+    print(f"OK spec edit: the {len(expected)} processed outputs written again, the extracted ones reused")
+
+
+def expected_for_code(file: str, outputs: set):
+    # Outputs whose code list has a file: the process, star and index lists start with PROCESS_CODE
+    import main
+    lists = {name for name in ['EXTRACT_CODE', 'PROCESS_CODE', 'STAR_CODE', 'INDEX_CODE']
+             if file in {path.relative_to(repo_dir).as_posix() for path in getattr(main, name)}}
+    if 'EXTRACT_CODE' in lists:
+        return set(outputs)
+    if 'PROCESS_CODE' in lists:
+        return {name for name in outputs if name.startswith('processed__')}
+    return ({STAR_OUTPUT} if 'STAR_CODE' in lists else set()) | ({INDEX_OUTPUT} if 'INDEX_CODE' in lists else set())
+
+
+def check_code_edits(workspace: Path, outputs: set):
+    # A comment added to each file of the code lists, one at a time
+    import main
+    files = sorted({
+        path.relative_to(repo_dir).as_posix()
+        for name in ['EXTRACT_CODE', 'PROCESS_CODE', 'STAR_CODE', 'INDEX_CODE'] for path in getattr(main, name)
+    })
+    for file in files:
+        with open(workspace / file, 'a') as f:
+            f.write('\n# Edited by tests/manifest_checks.py\n')
+        rewritten = run_pipeline(workspace)
+        expected = expected_for_code(file, outputs)
+        assert rewritten == expected, f"{file}: written again {sorted(rewritten)}, expected {sorted(expected)}"
+    assert expected_for_code('src/data/star_schema.py', outputs) == {STAR_OUTPUT}
+    assert expected_for_code('src/analysis/segmentation.py', outputs) == {INDEX_OUTPUT}
+    print(f"OK code edits: each of the {len(files)} files of the code lists makes only the outputs of its stages stale")
+
+
+def check_registry_edit(workspace: Path, outputs: set):
+    # A dtype of the registry changed: the extracted and processed consumers are written again with it
+    edit(workspace / 'src/data/schemas.py', "('customer_phone_number', pa.int32())", "('customer_phone_number', pa.int64())")
+    rewritten = run_pipeline(workspace)
+    assert rewritten == outputs, f"not written again after the registry edit: {sorted(outputs - rewritten)}"
+
+    for path in [workspace / 'data/extracted/consumers.parquet', workspace / 'data/processed/consumers_processed.parquet']:
+        dtype = pq.read_table(path, columns=['customer_phone_number']).schema.field('customer_phone_number').type
+        assert dtype == pa.int64(), f"{path.name}: customer_phone_number is {dtype}"
+    print(f"OK registry edit: {len(rewritten)} outputs written again, customer_phone_number is int64")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--run']:
+        run_stages_offline(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        sys.exit()
+
+    check_code_lists()
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 0.02
+    with tempfile.TemporaryDirectory() as folder:
+        workspace = make_workspace(Path(folder), scale)
+        outputs = run_pipeline(workspace)
+        assert outputs == set().union(*RAW_OUTPUTS.values(), {STAR_OUTPUT, INDEX_OUTPUT}), sorted(outputs)
+        print(f"OK first run: {len(outputs)} outputs recorded")
+        check_spec_fingerprints(workspace)
+        check_warm_rerun(workspace)
+        check_raw_changes(workspace)
+        check_spec_edit(workspace, outputs)
+        check_registry_edit(workspace, outputs)
+        check_code_edits(workspace, outputs)
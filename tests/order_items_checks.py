@@ -0,0 +1,119 @@
+# Checks of src/data/order_items.py: explode_items against a json.loads of each order, and orders with invalid items
+#   (not json, a pretty printed array, numbers as money values, values out of the items schema) among valid ones
+# Usage: python tests/order_items_checks.py [scale]
+
+import json
+import logging
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.order_items import explode_items
+from tests.synthetic_data import generate
+
+
+#==============================
+# Checks
+#==============================
+class _Warnings(logging.Handler):
+    # Warnings logged by order_items
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def make_orders(scale: float):
+    with tempfile.TemporaryDirectory() as folder:
+        generate(folder, scale)
+        orders = pd.read_json(Path(folder) / 'orders.json.gz', lines=True, dtype=False)
+    orders['order_created_date'] = pd.to_datetime(orders['order_created_at']).dt.date
+    # One row per order, as the pipeline explodes the items after the dedup
+    return orders.drop_duplicates('order_id', ignore_index=True)[['order_id', 'order_created_date', 'items']]
+
+
+def python_items(orders):
+    # One row per item, with json.loads
+    rows = []
+    for order_id, items in zip(orders['order_id'], orders['items']):
+        for item_index, item in enumerate(json.loads(items) if isinstance(items, str) else []):
+            garnishes = item['garnishItems']
+            rows.append((order_id, item_index, item['name'], item['quantity'], float(item['totalValue']['value']),
+                         len(garnishes), sum(float(garnish['totalValue']['value']) for garnish in garnishes)))
+    return pd.DataFrame(rows, columns=['order_id', 'item_index', 'name', 'quantity', 'total_value', 'garnish_count', 'garnish_total'])
+
+
+def assert_same_items(result, expected, label):
+    result = result.to_pandas()[expected.columns]
+    assert len(result) == len(expected), f"{label}: {len(result)} items, expected {len(expected)}"
+    for column in expected.columns:
+        if expected[column].dtype.kind == 'f':
+            assert np.allclose(result[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float)), f"{label}: {column} differs"
+        else:
+            assert result[column].astype(str).tolist() == expected[column].astype(str).tolist(), f"{label}: {column} differs"
+
+
+def check_valid(orders):
+    assert_same_items(explode_items(orders), python_items(orders), 'valid items')
+    print(f"OK valid items: {len(orders)} orders as json.loads")
+
+
+def check_invalid(orders):
+    # Orders 0 to 5 with invalid or unusual items, the others unchanged
+    broken = orders.copy()
+    first = json.loads(orders['items'].iloc[1])
+    numbers = json.loads(orders['items'].iloc[2], object_hook=lambda value: dict(value, value=float(value['value'])) if 'currency' in value else value)
+    broken.loc[0, 'items'] = orders['items'].iloc[0][:-5]               # Not json
+    broken.loc[1, 'items'] = json.dumps(first, indent=2)                # Line breaks inside the value
+    broken.loc[2, 'items'] = json.dumps(numbers)                        # Numbers as money values
+    broken.loc[3, 'items'] = None                                       # No items
+    broken.loc[4, 'items'] = '[{"name": "X", "quantity": "two"}]'        # Out of the items schema
+    broken.loc[5, 'items'] = '{"name": "X"}'                            # Not an array
+
+    handler = _Warnings()
+    logging.getLogger('order_items').addHandler(handler)
+    try:
+        result = explode_items(broken)
+    finally:
+        logging.getLogger('order_items').removeHandler(handler)
+
+    # The invalid orders get no items, the others the items of the valid values
+    expected = orders.copy()
+    expected.loc[[0, 3, 4, 5], 'items'] = None
+    assert_same_items(result, python_items(expected), 'invalid items')
+    assert not set(result['order_id'].to_pylist()) & set(orders['order_id'].iloc[[0, 3, 4, 5]]), "invalid orders have items"
+    assert any('Nulled the items of 3 orders' in message for message in handler.messages), handler.messages
+    print(f"OK invalid items: 3 orders nulled, pretty printed and numbers read ({len(result)} items)")
+
+
+def check_first_error(orders):
+    # Strings and numbers as money values on the same document: the error logged is the one of the first type (strings)
+    mixed = orders.iloc[:2].copy()
+    mixed.loc[1, 'items'] = json.dumps(json.loads(mixed['items'].iloc[1], object_hook=lambda value: dict(value, value=float(value['value'])) if 'currency' in value else value))
+
+    handler = _Warnings()
+    logging.getLogger('order_items').addHandler(handler)
+    try:
+        explode_items(mixed)
+    finally:
+        logging.getLogger('order_items').removeHandler(handler)
+    reader_error = next(message for message in handler.messages if message.startswith('Arrow json reader failed'))
+    assert 'changed from string to number' in reader_error, reader_error
+    print("OK reader error: the one of the first type tried")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    orders = make_orders(float(sys.argv[1]) if len(sys.argv) > 1 else 0.2)
+    check_valid(orders)
+    check_invalid(orders)
+    check_first_error(orders)
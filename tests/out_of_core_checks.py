@@ -0,0 +1,76 @@
+# Checks of the out-of-core mode (src/data/out_of_core.py and process_streaming of main.py): the pipeline run on the
+#   same synthetic raw files in memory and with a small memory budget writes the same processed files, with keys
+#   duplicated across the chunks so the spilled dedup is exercised
+# Usage: python tests/out_of_core_checks.py [scale]
+
+import sys
+import tempfile
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.out_of_core import parse_size, chunk_bytes, iter_parquet_chunks
+from src.data.transform_specs import TRANSFORM_SPECS
+from tests.manifest_checks import make_workspace, run_pipeline
+
+
+#==============================
+# Define constants
+#==============================
+# Budget of each process stage: chunks of 1MB (the minimum), a few thousand orders each
+MEMORY_BUDGET = parse_size('8MB')
+
+
+
+#==============================
+# Checks
+#==============================
+def check_chunk_duplicates(workspace: Path):
+    # Keys of the deduplicated datasets whose rows are on different chunks of the budget run
+    spanning = {}
+    for name, spec in TRANSFORM_SPECS.items():
+        if not spec.get('dedup'):
+            continue
+        key = spec['dedup'][0]
+        chunks = [
+            chunk[[key]].assign(chunk=number)
+            for number, chunk in enumerate(iter_parquet_chunks(workspace / f'data/extracted/{name}.parquet', chunk_bytes(MEMORY_BUDGET)))
+        ]
+        keys = pd.concat(chunks, ignore_index=True).groupby(key, observed=True)['chunk'].nunique()
+        spanning[name] = (len(chunks), int((keys > 1).sum()))
+
+    assert spanning['orders'][0] > 1 and spanning['orders'][1] > 0, f"no order_id duplicated across chunks: {spanning}"
+    print("OK chunk duplicates: " + ', '.join(f"{name} {count} keys over {chunks} chunks" for name, (chunks, count) in spanning.items()))
+
+
+def check_same_outputs(in_memory: Path, out_of_core: Path, outputs: set):
+    # Every processed file of both runs, same rows in the same order and the same dtypes
+    names = sorted(name.split('__', 1)[1] for name in outputs if name.startswith('processed__'))
+    for name in names:
+        expected = pd.read_parquet(in_memory / 'data/processed' / name)
+        result = pd.read_parquet(out_of_core / 'data/processed' / name)
+        pd.testing.assert_frame_equal(result, expected, obj=name)
+
+    orders = [pd.read_parquet(workspace / 'data/extracted/orders.parquet', columns=['order_id']) for workspace in [in_memory, out_of_core]]
+    processed = pd.read_parquet(out_of_core / 'data/processed/orders_processed.parquet', columns=['order_id'])
+    assert len(orders[0]) == len(orders[1]) > len(processed) == processed['order_id'].nunique(), "duplicated orders not removed"
+    print(f"OK same outputs: {len(names)} processed files equal, {len(orders[1]) - len(processed)} duplicated orders removed")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    with tempfile.TemporaryDirectory() as folder:
+        in_memory, out_of_core = Path(folder) / 'in_memory', Path(folder) / 'out_of_core'
+        for workspace in [in_memory, out_of_core]:
+            workspace.mkdir()
+            make_workspace(workspace, scale)
+        outputs = run_pipeline(in_memory)
+        assert run_pipeline(out_of_core, MEMORY_BUDGET) == outputs, "outputs of the runs differ"
+
+        check_chunk_duplicates(out_of_core)
+        check_same_outputs(in_memory, out_of_core, outputs)
@@ -0,0 +1,158 @@
+# Parity checks between src/analysis/segmentation.py and the RFM groupby and row by row segments that were on
+#   notebooks/03_segmentations.ipynb (kept here as the reference), and of fold_in_orders with days folded in twice
+# Usage: python tests/segmentation_parity.py [amount_of_orders]
+
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.analysis.segmentation import customer_aggregates, fold_in_orders, segment_customers, segment_profile
+
+
+#==============================
+# Notebook reference
+#==============================
+def create_hybrid_segment(row):
+    if row['is_high_frequency'] and row['is_low_aov'] and row['is_active']:
+        return 'Frequent Small Baskets'
+    elif row['is_low_frequency'] and row['is_high_aov'] and row['is_active']:
+        return 'Big Spenders, Rare Visits'
+    elif row['is_high_value'] and not row['is_active'] and not row['is_inactive']:
+        return 'At-Risk High Value'
+    elif row['is_high_value'] and row['is_inactive']:
+        return 'Churned High Value'
+    elif row['is_new']:
+        return 'New Explorers'
+    elif row['is_high_frequency'] and row['is_high_aov'] and row['is_active']:
+        return 'VIP Customers'
+    elif row['is_active'] and not row['is_low_frequency'] and not row['is_high_frequency']:
+        return 'Core Customers'
+    elif row['is_inactive'] and not row['is_high_value']:
+        return 'Dormant Low Value'
+    elif row['is_high_frequency'] and not row['is_high_aov'] and not row['is_low_aov'] and row['is_active']:
+        return 'Frequent Medium Spenders'
+    elif not row['is_high_frequency'] and not row['is_low_frequency'] and not row['is_high_aov'] and not row['is_low_aov'] and row['is_active']:
+        return 'Steady Customers'
+    elif row['is_active'] and not row['is_new']:
+        return 'Active Inconsistent'
+    else:
+        return 'Other Customers'
+
+
+def notebook_segments(df_orders):
+    # RFM, flags and segments as the notebook computed them
+    analysis_end_date = df_orders['order_created_at'].max()
+    rfm = df_orders.groupby('customer_id').agg({
+        'order_created_at': lambda x: (analysis_end_date - x.max()).days,
+        'order_id': 'count',
+        'order_total_amount': 'mean'
+    }).reset_index()
+    rfm['total_spend'] = df_orders.groupby('customer_id')['order_total_amount'].sum().reset_index()['order_total_amount']
+    rfm.columns = ['customer_id', 'recency_days', 'frequency', 'avg_order_value', 'total_spend']
+
+    rfm['is_active'] = rfm['recency_days'] <= 7
+    rfm['is_inactive'] = rfm['recency_days'] > 15
+    rfm['is_high_frequency'] = rfm['frequency'] >= rfm['frequency'].quantile(0.75)
+    rfm['is_low_frequency'] = rfm['frequency'] <= rfm['frequency'].quantile(0.25)
+    rfm['is_high_aov'] = rfm['avg_order_value'] >= rfm['avg_order_value'].quantile(0.75)
+    rfm['is_low_aov'] = rfm['avg_order_value'] <= rfm['avg_order_value'].quantile(0.25)
+    rfm['is_high_value'] = rfm['total_spend'] >= rfm['total_spend'].quantile(0.75)
+    rfm['is_new'] = (rfm['frequency'] <= 3) & (rfm['recency_days'] <= 20)
+    rfm['hybrid_segment'] = rfm.apply(create_hybrid_segment, axis=1)
+    return rfm
+
+
+
+#==============================
+# Checks
+#==============================
+def make_orders(n: int, seed: int = 42):
+    """
+    Orders of a month, with customers of very different frequencies and NA amounts
+
+    Parameters:
+        n: amount of orders
+
+    Returns:
+        pd.DataFrame: customer_id, order_id, order_created_at, order_created_date and order_total_amount
+    """
+    rng = np.random.default_rng(seed)
+    n_customers = max(n // 3, 10)
+    seconds = rng.integers(1_543_622_400, 1_546_300_800, n)  # 2018-12-01 to 2019-01-01
+    created_at = pd.to_datetime(seconds, unit='s', utc=True)
+    amounts = np.round(rng.gamma(2, 25, n), 2)
+    amounts[rng.random(n) < 0.01] = np.nan
+    return pd.DataFrame({
+        'customer_id': np.array([f'{k:064x}' for k in range(n_customers)], dtype=object)[rng.zipf(1.3, n) % n_customers],
+        'order_id': [f'{k:032x}' for k in range(n)],
+        'order_created_at': created_at,
+        'order_created_date': created_at.date,
+        'order_total_amount': amounts
+    })
+
+
+def check_segments(orders):
+    start = time.perf_counter()
+    expected = notebook_segments(orders)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rfm = segment_customers(orders)
+    segment_time = time.perf_counter() - start
+
+    expected = expected.set_index('customer_id').loc[rfm['customer_id']]
+    assert (rfm['recency_days'].to_numpy() == expected['recency_days'].to_numpy()).all(), "recency differs"
+    assert (rfm['frequency'].to_numpy() == expected['frequency'].to_numpy()).all(), "frequency differs"
+    for column in ['avg_order_value', 'total_spend']:
+        assert np.allclose(rfm[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float), equal_nan=True), f"{column} differs"
+    flags = [column for column in expected.columns if column.startswith('is_')]
+    assert (rfm[flags].to_numpy() == expected[flags].to_numpy()).all(), "flags differ"
+    assert (rfm['hybrid_segment'].astype(str).to_numpy() == expected['hybrid_segment'].to_numpy()).all(), "segments differ"
+
+    profile = segment_profile(rfm).set_index('hybrid_segment')['customer_id']
+    counts = expected['hybrid_segment'].value_counts()
+    assert (profile.rename(index=str).sort_index() == counts.sort_index()).all(), "profile counts differ"
+
+    print(f"OK segments: {len(rfm)} customers, notebook {reference_time:.2f}s, segment_customers {segment_time:.2f}s")
+
+
+def check_fold_in(orders):
+    # Folding in the days one by one, with every day folded in twice, gives the aggregates of all the orders at once
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / 'customer_aggregates.parquet'
+        dates = sorted(orders['order_created_date'].unique())
+        for date in dates:
+            day = orders[orders['order_created_date'] == date]
+            fold_in_orders(day, path)
+            aggregates = fold_in_orders(day, path)
+
+        # A batch with an old day and a new one only adds the new day
+        aggregates = fold_in_orders(orders[orders['order_created_date'].isin(dates[:2])], path)
+        stored = pd.read_parquet(path)
+
+    expected = customer_aggregates(orders)
+    for result in (aggregates, stored):
+        result = result.loc[expected.index]
+        assert (result['frequency'].to_numpy() == expected['frequency'].to_numpy()).all(), "folded frequency differs"
+        assert (result['qt_amounts'].to_numpy() == expected['qt_amounts'].to_numpy()).all(), "folded qt_amounts differs"
+        assert np.allclose(result['total_spend'].to_numpy(), expected['total_spend'].to_numpy()), "folded total_spend differs"
+        assert (result['first_order_at'] == expected['first_order_at']).all(), "folded first_order_at differs"
+        assert (result['last_order_at'] == expected['last_order_at']).all(), "folded last_order_at differs"
+
+    print(f"OK fold_in_orders: {len(dates)} days folded in twice, {len(expected)} customers")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    orders = make_orders(n)
+    check_segments(orders)
+    check_fold_in(orders)
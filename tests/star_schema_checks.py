@@ -0,0 +1,122 @@
+# Checks of src/data/star_schema.py: surrogate keys kept between runs, and the attributes of the orders_star fact table
+#   against a merge on the string ids, with orders of unknown merchants and customers and a null merchant_id
+# Usage: python tests/star_schema_checks.py
+
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.data_load import load_data, read_data
+from src.data.star_schema import build_star, surrogate_keys, CONSUMER_COLUMNS, RESTAURANT_COLUMNS
+
+
+#==============================
+# Processed datasets
+#==============================
+def make_processed(folder: Path):
+    """
+    Write small orders/ab_test/consumers/restaurants processed datasets
+
+    The last orders are of a merchant out of the restaurants, of a null merchant_id and of a customer out of the
+    consumers and the test; the dimensions have a duplicated id (the first row is kept)
+
+    Parameters:
+        folder: folder of the processed datasets
+    """
+    customers = [f'c{k:063d}' for k in range(4)]
+    merchants = [f'm{k:063d}' for k in range(3)]
+    created_at = pd.Timestamp('2019-01-01', tz='UTC')
+
+    orders = pd.DataFrame({
+        'order_id': [f'o{k:031d}' for k in range(8)],
+        'customer_id': pd.array(customers[:3] * 2 + [customers[0], customers[3]], dtype='str'),
+        'merchant_id': pd.array(merchants[:2] * 3 + ['unknown_merchant', None], dtype='str'),
+        'order_created_at': pd.date_range(created_at, periods=8, freq='h'),
+        'order_total_amount': np.arange(8, dtype=np.float64) * 10,
+        'origin_platform': pd.Categorical(['ANDROID', 'IOS'] * 4),
+        'order_scheduled': np.zeros(8, dtype=bool),
+        'delivery_address_city': pd.Categorical(['SAO PAULO'] * 8),
+        'delivery_address_state': pd.Categorical(['SP'] * 8)
+    })
+    orders['order_created_date'] = pd.array(orders['order_created_at'].dt.date, dtype='date32[pyarrow]')
+
+    ab_test = pd.DataFrame({'customer_id': pd.array(customers[:3], dtype='str'), 'is_target': pd.Categorical(['target', 'control', 'target'])})
+    consumers = pd.DataFrame({
+        'customer_id': pd.array(customers[:3] + [customers[0]], dtype='str'),
+        'active': [True, False, True, False],
+        'created_at': pd.date_range(created_at - pd.Timedelta(days=30), periods=4, freq='D')
+    })
+    restaurants = pd.DataFrame({
+        'id': pd.array(merchants + [merchants[1]], dtype='str'),
+        'enabled': [True, False, True, True],
+        'price_range': np.array([1, 3, 5, 2], dtype=np.int8),
+        'average_ticket': [40.0, 60.0, 80.0, 10.0],
+        'delivery_time': [30.0, 45.0, 60.0, 10.0],
+        'merchant_city': pd.Categorical(['SAO PAULO', 'CAMPINAS', 'RECIFE', 'RECIFE']),
+        'merchant_state': pd.Categorical(['SP', 'SP', 'PE', 'PE'])
+    })
+
+    for df, name in [(orders, 'orders_processed'), (ab_test, 'ab_test'), (consumers, 'consumers_processed'), (restaurants, 'restaurants_processed')]:
+        load_data(df, name, folder=folder, profile=False)
+    return orders, ab_test, consumers, restaurants
+
+
+
+#==============================
+# Checks
+#==============================
+def check_star(folder: Path):
+    orders, ab_test, consumers, restaurants = make_processed(folder)
+    keys_folder = folder / 'keys'
+    build_star(folder, keys_folder)
+    star = read_data('orders_star', folder=folder).sort_values('order_id').reset_index(drop=True)
+
+    # Reference: left merges on the string ids, keeping the first row of each id of the dimensions
+    expected = orders.merge(ab_test, on='customer_id', how='left') \
+        .merge(consumers.drop_duplicates('customer_id').rename(columns=CONSUMER_COLUMNS), on='customer_id', how='left') \
+        .merge(restaurants.drop_duplicates('id').rename(columns={'id': 'merchant_id', **RESTAURANT_COLUMNS}), on='merchant_id', how='left') \
+        .sort_values('order_id').reset_index(drop=True)
+
+    columns = ['is_target'] + list(CONSUMER_COLUMNS.values()) + list(RESTAURANT_COLUMNS.values())
+    for column in columns:
+        values, expected_values = star[column].astype(object), expected[column].astype(object)
+        same = (values.isna() == expected_values.isna()) & ((values == expected_values).fillna(False) | values.isna())
+        assert same.all(), f"{column} differs:\n{star[column]}\n{expected[column]}"
+
+    # Unknown merchant and null merchant_id: null attributes, not the ones of another merchant
+    unknown = star['order_id'].isin(orders['order_id'].iloc[-2:])
+    assert star.loc[unknown, list(RESTAURANT_COLUMNS.values())].isna().all().all(), "unknown merchants got attributes"
+    assert star.loc[star.index[-1], 'merchant_key'] == -1, "null merchant_id must have the key -1"
+    assert star.loc[star.index[-1], ['is_target', 'customer_active']].isna().all(), "unknown customer got attributes"
+
+    # The dtypes of the dimensions are kept (nullable when there are nulls), not object/float
+    assert star['merchant_enabled'].dtype == 'boolean', star['merchant_enabled'].dtype
+    assert star['merchant_price_range'].dtype == 'Int8', star['merchant_price_range'].dtype
+    assert star['customer_active'].dtype == 'boolean', star['customer_active'].dtype
+    assert isinstance(star['merchant_city'].dtype, pd.CategoricalDtype), star['merchant_city'].dtype
+
+    print(f"OK build_star: {len(star)} orders, {int(unknown.sum())} of unknown merchants")
+    return keys_folder
+
+
+def check_keys(keys_folder: Path):
+    # Ids of a previous run keep their keys, new ids get the next ones
+    before = surrogate_keys('merchant', [], keys_folder)
+    after = surrogate_keys('merchant', ['new_merchant', before[0], None], keys_folder)
+    assert list(after[:len(before)]) == list(before), "keys of the previous run changed"
+    assert list(after[len(before):]) == ['new_merchant'], list(after[len(before):])
+    print(f"OK surrogate_keys: {len(before)} kept, 1 new")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as folder:
+        keys_folder = check_star(Path(folder))
+        check_keys(keys_folder)
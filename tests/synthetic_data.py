@@ -0,0 +1,245 @@
+# Synthetic Data Generator
+# Writes orders.json.gz, consumers.csv.gz, restaurants.csv.gz and ab_test.tar.gz on the same format of the sources,
+#   at a chosen scale and with controlled duplicate and NA rates; no network access needed
+# Usage: python tests/synthetic_data.py [scale] [output_folder]
+
+import gzip
+import io
+import json
+import sys
+import tarfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+#==============================
+# Define constants
+#==============================
+# Rows of each dataset on scale 1 (the sources have ~3.6M orders, ~800k consumers and ~7k restaurants, close to scale 35)
+BASE_ROWS = {
+    'orders': 100_000,
+    'consumers': 25_000,
+    'restaurants': 250
+}
+
+CITIES = [
+    ('SAO PAULO', 'SP', 11, -23.55, -46.63), ('CAMPINAS', 'SP', 19, -22.90, -47.06), ('RIO DE JANEIRO', 'RJ', 21, -22.91, -43.17),
+    ('BELO HORIZONTE', 'MG', 31, -19.92, -43.94), ('CURITIBA', 'PR', 41, -25.43, -49.27), ('PORTO ALEGRE', 'RS', 51, -30.03, -51.23),
+    ('BRASILIA', 'DF', 61, -15.79, -47.88), ('SALVADOR', 'BA', 71, -12.97, -38.50), ('RECIFE', 'PE', 81, -8.05, -34.88),
+    ('FORTALEZA', 'CE', 85, -3.73, -38.52)
+]
+NAMES = ['ANA', 'JOAO', 'MARIA', 'PEDRO', 'LUCAS', 'JULIA', 'GABRIEL', 'BEATRIZ', 'RAFAEL', 'LARISSA', 'HELTON', 'PAULA']
+PLATFORMS = ['ANDROID', 'IOS', 'DESKTOP']
+ITEMS = [('X-BURGUER', 24.9), ('PIZZA MUSSARELA', 49.9), ('COMBO SUSHI', 69.9), ('ACAI 500ML', 19.9), ('REFRIGERANTE', 6.5)]
+GARNISHES = [('BACON', 3.0), ('QUEIJO EXTRA', 2.5), ('GRANOLA', 2.0)]
+
+
+
+#==============================
+# Helpers
+#==============================
+def _hex_ids(rng, n):
+    # Unique 64 chars ids, as the hashed ids of the sources
+    return pd.Series(rng.choice(n * 4, n, replace=False)).map('{:064x}'.format)
+
+
+def _timestamps(rng, n, start, end):
+    seconds = rng.integers(pd.Timestamp(start).timestamp(), pd.Timestamp(end).timestamp(), n)
+    millis = rng.integers(0, 1000, n)
+    return (pd.to_datetime(seconds, unit='s') + pd.to_timedelta(millis, unit='ms')).strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3] + 'Z'
+
+
+def _money(value):
+    return {'value': f'{value:.2f}', 'currency': 'BRL'}
+
+
+def _items_pool(rng, size=200):
+    """
+    Pool of json strings of the nested items field, each order picks one
+    """
+    pool = []
+    for _ in range(size):
+        items = []
+        for sequence in range(1, rng.integers(1, 4) + 1):
+            name, price = ITEMS[rng.integers(len(ITEMS))]
+            quantity = float(rng.integers(1, 3))
+            garnish_items = []
+            if rng.random() < 0.4:
+                garnish_name, garnish_price = GARNISHES[rng.integers(len(GARNISHES))]
+                garnish_items.append({
+                    'name': garnish_name, 'addition': _money(0), 'discount': _money(0), 'quantity': 1.0, 'sequence': 2,
+                    'unitPrice': _money(garnish_price), 'categoryId': 'ADD', 'externalId': f'G{sequence}',
+                    'totalValue': _money(garnish_price), 'categoryName': 'ADICIONAIS', 'integrationId': None
+                })
+            discount = round(price * 0.1, 2) if rng.random() < 0.2 else 0
+            items.append({
+                'name': name, 'addition': _money(0), 'discount': _money(discount), 'quantity': quantity, 'sequence': sequence,
+                'unitPrice': _money(price), 'externalId': f'I{sequence}', 'totalValue': _money(price * quantity - discount),
+                'customerNote': None, 'garnishItems': garnish_items, 'integrationId': None,
+                'totalAddition': _money(0), 'totalDiscount': _money(discount)
+            })
+        pool.append(json.dumps(items))
+    return np.array(pool, dtype=object)
+
+
+def _with_duplicates(rng, df, key, timestamp, duplicate_rate):
+    """
+    Append copies of a fraction of the rows with another timestamp, shuffling the result
+    """
+    duplicates = df.sample(frac=duplicate_rate, random_state=int(rng.integers(2**31))).copy()
+    duplicates[timestamp] = _timestamps(rng, len(duplicates), '2018-01-01', '2019-02-01').to_numpy()
+    df = pd.concat([df, duplicates], ignore_index=True)
+    return df.sample(frac=1, random_state=int(rng.integers(2**31))).reset_index(drop=True)
+
+
+
+#==============================
+# Datasets
+#==============================
+def make_consumers(rng, n, duplicate_rate, na_rate):
+    customer_ids = _hex_ids(rng, n)
+    city = rng.integers(len(CITIES), size=n)
+    # Some phone areas are not valid DDDs, as on the source
+    phone_area = np.where(rng.random(n) < 0.05, 10, np.array([c[2] for c in CITIES])[city] + rng.integers(0, 3, n))
+
+    df = pd.DataFrame({
+        'customer_id': customer_ids,
+        'language': np.where(rng.random(n) < 0.99, 'pt-br', 'en-us'),
+        'created_at': _timestamps(rng, n, '2017-06-01', '2019-01-01').to_numpy(),
+        'active': rng.random(n) < 0.9,
+        'customer_name': np.array(NAMES, dtype=object)[rng.integers(len(NAMES), size=n)],
+        'customer_phone_area': phone_area,
+        'customer_phone_number': rng.integers(10**8, 10**9, n)
+    })
+    df.loc[rng.random(n) < na_rate, 'customer_name'] = None
+    return _with_duplicates(rng, df, 'customer_id', 'created_at', duplicate_rate)
+
+
+def make_restaurants(rng, n, duplicate_rate, na_rate):
+    city = rng.integers(len(CITIES), size=n)
+    cities = np.array(CITIES, dtype=object)
+
+    df = pd.DataFrame({
+        'id': _hex_ids(rng, n),
+        'created_at': _timestamps(rng, n, '2017-01-01', '2019-01-01').to_numpy(),
+        'enabled': rng.random(n) < 0.8,
+        'price_range': rng.integers(1, 6, n),
+        'average_ticket': rng.uniform(15, 120, n).round(1),
+        'takeout_time': rng.integers(0, 60, n),
+        'delivery_time': rng.integers(10, 90, n).astype(float),
+        'minimum_order_value': rng.uniform(0, 40, n).round(1),
+        'merchant_zip_code': rng.integers(10**4, 10**5, n),
+        'merchant_city': cities[city, 0],
+        'merchant_state': cities[city, 1],
+        'merchant_country': 'BR',
+        'merchant_latitude': (cities[city, 3].astype(float) + rng.normal(0, 0.05, n)).round(4),
+        'merchant_longitude': (cities[city, 4].astype(float) + rng.normal(0, 0.05, n)).round(4)
+    })
+    df.loc[rng.random(n) < na_rate, 'minimum_order_value'] = np.nan
+    df.loc[rng.random(n) < na_rate / 10, 'delivery_time'] = np.nan
+    return _with_duplicates(rng, df, 'id', 'created_at', duplicate_rate)
+
+
+def make_orders(rng, n, consumers, restaurants, duplicate_rate, na_rate):
+    customers = consumers['customer_id'].drop_duplicates().to_numpy()
+    merchants = restaurants.drop_duplicates('id')
+    merchant = rng.integers(len(merchants), size=n)
+    customer_city = rng.integers(len(CITIES), size=n)
+    cities = np.array(CITIES, dtype=object)
+
+    df = pd.DataFrame({
+        'cpf': pd.Series(rng.integers(0, 10**11, n)).map('{:011d}'.format),
+        'customer_id': customers[rng.integers(len(customers), size=n)],
+        'customer_name': np.array(NAMES, dtype=object)[rng.integers(len(NAMES), size=n)],
+        'delivery_address_city': cities[customer_city, 0],
+        'delivery_address_country': 'BR',
+        'delivery_address_district': np.array(['CENTRO', 'JARDINS', 'MOEMA', 'BOA VIAGEM'], dtype=object)[rng.integers(4, size=n)],
+        'delivery_address_external_id': pd.Series(rng.integers(0, 10**7, n)).astype(str),
+        'delivery_address_latitude': (cities[customer_city, 3].astype(float) + rng.normal(0, 0.05, n)).round(2).astype(str),
+        'delivery_address_longitude': (cities[customer_city, 4].astype(float) + rng.normal(0, 0.05, n)).round(2).astype(str),
+        'delivery_address_state': cities[customer_city, 1],
+        'delivery_address_zip_code': pd.Series(rng.integers(10**4, 10**5, n)).astype(str),
+        'items': _items_pool(rng)[rng.integers(200, size=n)],
+        'merchant_id': merchants['id'].to_numpy()[merchant],
+        'merchant_latitude': merchants['merchant_latitude'].to_numpy()[merchant].astype(str),
+        'merchant_longitude': merchants['merchant_longitude'].to_numpy()[merchant].astype(str),
+        'merchant_timezone': 'America/Sao_Paulo',
+        'order_created_at': _timestamps(rng, n, '2018-12-03', '2019-02-01').to_numpy(),
+        'order_id': pd.Series(np.arange(n)).map('{:064x}'.format),
+        'order_scheduled': rng.random(n) < 0.01,
+        'order_total_amount': rng.gamma(3, 16, n).round(2),
+        'origin_platform': np.array(PLATFORMS, dtype=object)[rng.integers(len(PLATFORMS), size=n)],
+        'order_scheduled_date': None
+    })
+    scheduled = df['order_scheduled'].to_numpy()
+    df.loc[scheduled, 'order_scheduled_date'] = _timestamps(rng, scheduled.sum(), '2018-12-03', '2019-02-01').to_numpy()
+    df.loc[rng.random(n) < na_rate, 'customer_id'] = None
+    return _with_duplicates(rng, df, 'order_id', 'order_created_at', duplicate_rate)
+
+
+
+#==============================
+# Write files
+#==============================
+def generate(output_folder, scale: float = 1, duplicate_rate: float = 0.02, na_rate: float = 0.01, seed: int = 42):
+    """
+    Write the four raw files on the output folder
+
+    Parameters:
+        output_folder: folder of the files (ex.: data/raw)
+        scale: multiplier of BASE_ROWS
+        duplicate_rate: fraction of rows duplicated with another timestamp
+        na_rate: fraction of NAs on the columns that have NAs on the sources
+        seed: seed of the random generator, same seed -> same files
+
+    Returns:
+        dict: file name -> amount of rows written
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    rows = {name: max(int(base * scale), 10) for name, base in BASE_ROWS.items()}
+
+    consumers = make_consumers(rng, rows['consumers'], duplicate_rate, na_rate)
+    restaurants = make_restaurants(rng, rows['restaurants'], duplicate_rate, na_rate)
+    orders = make_orders(rng, rows['orders'], consumers, restaurants, duplicate_rate, na_rate)
+
+    # Consumers and restaurants are csv.gz
+    # (the coordinates of the restaurants are only on the orders)
+    consumers.to_csv(output_folder / 'consumers.csv.gz', index=False, compression={'method': 'gzip', 'compresslevel': 1})
+    restaurants.drop(columns=['merchant_latitude', 'merchant_longitude']).to_csv(
+        output_folder / 'restaurants.csv.gz', index=False, compression={'method': 'gzip', 'compresslevel': 1}
+    )
+
+    # Orders are json lines in a .json.gz
+    with gzip.open(output_folder / 'orders.json.gz', 'wt', encoding='utf-8', compresslevel=1) as f:
+        for start in range(0, len(orders), 500_000):
+            f.write(orders.iloc[start:start + 500_000].to_json(orient='records', lines=True))
+            f.write('\n')
+
+    # The a/b test is a csv inside a tar.gz, one row per unique consumer
+    ab_test = pd.DataFrame({'customer_id': consumers['customer_id'].drop_duplicates()})
+    ab_test['is_target'] = np.where(rng.random(len(ab_test)) < 0.55, 'target', 'control')
+    content = ab_test.to_csv(index=False).encode()
+    with tarfile.open(output_folder / 'ab_test.tar.gz', 'w:gz') as tar:
+        member = tarfile.TarInfo('ab_test_ref.csv')
+        member.size = len(content)
+        tar.addfile(member, io.BytesIO(content))
+
+    return {
+        'orders.json.gz': len(orders),
+        'consumers.csv.gz': len(consumers),
+        'restaurants.csv.gz': len(restaurants),
+        'ab_test.tar.gz': len(ab_test)
+    }
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    output_folder = sys.argv[2] if len(sys.argv) > 2 else 'data/raw'
+    print(generate(output_folder, scale))
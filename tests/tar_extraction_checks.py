@@ -0,0 +1,154 @@
+# Checks of the tar extraction (stream_tar_csv of src/data/data_extraction.py): every matching csv member joined, with
+#   its rows on the 'source_members' metadata and on member_column, the registry types, and the fallback to pd.read_csv
+#   when a value doesn't fit the declared type, on extract_files (with and without the extracted copy) and extract_chunked
+# Usage: python tests/tar_extraction_checks.py [rows_per_member]
+
+import io
+import json
+import logging
+import sys
+import tarfile
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.data_extraction import extract_files, extract_chunked, stream_tar_csv
+from src.data.schemas import SCHEMAS
+
+
+#==============================
+# Define constants
+#==============================
+# Dataset of the checks with a typed column, so a value can miss its type (ab_test has only strings)
+SCORES = 'ab_scores'
+SCHEMAS[SCORES] = pa.schema(list(SCHEMAS['ab_test']) + [('score', pa.int16())])
+
+
+
+#==============================
+# Archive
+#==============================
+def make_members(n: int, seed: int = 42):
+    # Two members of the a/b test, as ab_test_ref.csv of the source, with a score of each customer
+    rng = np.random.default_rng(seed)
+    members = {}
+    for k, name in enumerate(['ab_test_ref.csv', 'extra/ab_test_late.csv']):
+        members[name] = pd.DataFrame({
+            'customer_id': [f'{k}{i:063x}' for i in range(n)],
+            'is_target': rng.choice(['target', 'control'], n),
+            'score': rng.integers(0, 1000, n)
+        })
+    return members
+
+
+def write_archive(path: Path, members: dict, bad_value: bool = False):
+    """
+    Write the members on a tar.gz, with files that don't match the prefix or aren't csv
+
+    Parameters:
+        path: path of the archive
+        members: member name -> DataFrame
+        bad_value: write a score that doesn't fit int16 on the last member
+    """
+    contents = {name: df.to_csv(index=False) for name, df in members.items()}
+    if bad_value:
+        name = list(members)[-1]
+        lines = contents[name].split('\n')
+        lines[5] = lines[5].rsplit(',', 1)[0] + ',abc'  # 5th row of the member
+        contents[name] = '\n'.join(lines)
+    contents.update({'other.csv': 'customer_id,is_target\nx,target\n', 'ab_test_notes.txt': 'not a csv member'})
+
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, content in contents.items():
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+
+#==============================
+# Checks
+#==============================
+class _Warnings(logging.Handler):
+    # Warnings logged by data_extraction
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def check_stream(folder: Path, members: dict):
+    # Both members, in the order of the archive, with their rows on the metadata and on the member column
+    archive = folder / 'ab_test.tar.gz'
+    write_archive(archive, {name: df[['customer_id', 'is_target']] for name, df in members.items()})
+    output = folder / 'streamed.parquet'
+    read = stream_tar_csv(archive, output, 'ab_test', member_column='source_member')
+
+    expected = pd.concat(members.values(), ignore_index=True)
+    table = pq.read_table(output)
+    metadata = json.loads(pq.read_metadata(output).metadata[b'source_members'])
+    assert [member['name'] for member in read] == list(members), read
+    assert metadata == read and [member['rows'] for member in metadata] == [len(df) for df in members.values()], metadata
+    assert table.num_rows == len(expected), f"{table.num_rows} rows, expected {len(expected)}"
+
+    assert table.schema.field('customer_id').type == pa.string(), table.schema
+    assert pa.types.is_dictionary(table.schema.field('is_target').type), table.schema
+    df = table.to_pandas()
+    assert df['customer_id'].tolist() == expected['customer_id'].tolist()
+    assert df['is_target'].astype(str).tolist() == expected['is_target'].tolist()
+    assert df['source_member'].astype(str).tolist() == [name for name, member in members.items() for _ in range(len(member))]
+    print(f"OK stream_tar_csv: {len(members)} members joined, {table.num_rows} rows, 'source_members' metadata and member column")
+
+
+def check_fallback(folder: Path, members: dict):
+    # A score that doesn't fit int16: the arrow reader fails, each chunk is read by pd.read_csv and the score becomes NA
+    archive = folder / f'{SCORES}.tar.gz'
+    write_archive(archive, members, bad_value=True)
+    expected = pd.concat(members.values(), ignore_index=True)
+    bad_row = len(members['ab_test_ref.csv']) + 4
+
+    for name in ['extracted', 'chunked']:
+        (folder / name).mkdir()
+
+    handler = _Warnings()
+    logging.getLogger('data_extraction').addHandler(handler)
+    try:
+        results = {
+            'extract_files': extract_files(archive.name, 'tar_csv', read_path=folder, extract_path=folder / 'extracted'),
+            'extract_files without the extracted copy': extract_files(archive.name, 'tar_csv', read_path=folder, write_extracted=False),
+        }
+        rows = extract_chunked(archive.name, 'tar_csv', 1024 * 1024, read_path=folder, extract_path=folder / 'chunked')
+        results['extract_chunked'] = pd.read_parquet(folder / 'chunked' / f'{SCORES}.parquet')
+    finally:
+        logging.getLogger('data_extraction').removeHandler(handler)
+
+    assert rows == len(expected), rows
+    assert sum('converting each chunk' in message for message in handler.messages) == 3, handler.messages
+    for label, df in results.items():
+        assert len(df) == len(expected), f"{label}: {len(df)} rows, expected {len(expected)}"
+        assert str(df['score'].dtype) == 'Int16' and isinstance(df['is_target'].dtype, pd.CategoricalDtype), f"{label}: {df.dtypes}"
+        assert df['score'].isna().sum() == 1 and pd.isna(df['score'].iloc[bad_row]), f"{label}: bad score not NA"
+        others = df.index != bad_row
+        assert (df['score'][others].to_numpy(dtype=int) == expected['score'][others].to_numpy()).all(), f"{label}: scores differ"
+        assert df['customer_id'].tolist() == expected['customer_id'].tolist(), f"{label}: ids differ"
+    print(f"OK fallback to pd.read_csv: {len(results)} extractions with the registry types and the bad value as NA")
+
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    members = make_members(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        check_stream(folder, members)
+        check_fallback(folder, members)
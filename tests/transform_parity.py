@@ -0,0 +1,106 @@
+# Parity checks between the arrow transform engine and the pandas reference functions
+# Usage: python tests/transform_parity.py [amount_of_rows]
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.data.transform_engine import apply_spec_arrow, apply_spec_pandas
+from src.data.transform_specs import TRANSFORM_SPECS
+from src.data.schemas import enforce_schema
+from src.data.geo import STATE_DDD
+
+
+#==============================
+# Synthetic frames
+#==============================
+def _timestamps(rng, n):
+    seconds = rng.integers(1_514_764_800, 1_548_979_200, n)  # 2018-01-01 to 2019-02-01
+    return pd.to_datetime(seconds, unit='s').strftime('%Y-%m-%dT%H:%M:%S.000Z').to_numpy(dtype=object)
+
+
+def make_frames(n: int, seed: int = 42):
+    """
+    Build raw frames, with duplicated keys and NAs, on the same format of the extracted datasets
+
+    Parameters:
+        n: amount of rows of each frame
+
+    Returns:
+        dict: dataset name -> pd.DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    keys = lambda: np.array([f'{k:064x}' for k in rng.integers(0, int(n * 0.8), n)], dtype=object)
+
+    orders = pd.DataFrame({
+        'customer_id': keys(),
+        'order_id': keys(),
+        'order_created_at': _timestamps(rng, n),
+        'order_total_amount': rng.uniform(0, 150, n).round(2),
+        'order_scheduled_date': np.where(rng.random(n) < 0.99, None, _timestamps(rng, n)).astype(object)
+    })
+    orders.loc[rng.random(n) < 0.02, 'customer_id'] = None
+
+    consumers = pd.DataFrame({
+        'customer_id': keys(),
+        'created_at': _timestamps(rng, n),
+        'customer_name': np.where(rng.random(n) < 0.01, None, 'NAME').astype(object),
+        'customer_phone_number': rng.integers(10**8, 10**9, n),
+        'customer_phone_area': np.where(rng.random(n) < 0.01, np.nan, rng.integers(10, 100, n))  # Also codes without a state
+    })
+
+    restaurants = pd.DataFrame({
+        'id': keys(),
+        'created_at': _timestamps(rng, n),
+        'price_range': rng.integers(1, 5, n),
+        'takeout_time': rng.integers(0, 60, n),
+        'average_ticket': rng.uniform(10, 100, n),
+        'delivery_time': rng.uniform(10, 90, n),
+        'minimum_order_value': np.where(rng.random(n) < 0.02, np.nan, rng.uniform(0, 30, n))
+    })
+
+    # Same types of the extraction (schema registry)
+    frames = {'orders': orders, 'consumers': consumers, 'restaurants': restaurants}
+    return {name: enforce_schema(df, name) for name, df in frames.items()}
+
+
+#==============================
+# Main
+#==============================
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    for name, df in make_frames(n).items():
+        spec = TRANSFORM_SPECS[name]
+        key = spec['dedup'][0]
+
+        start = time.perf_counter()
+        df_pandas = apply_spec_pandas(df.copy(), spec)
+        time_pandas = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df_arrow = apply_spec_arrow(df.copy(), spec)
+        time_arrow = time.perf_counter() - start
+
+        # Ties on the dedup timestamp have no defined order on the pandas path, so comparing by key
+        df_pandas = df_pandas.sort_values(key).reset_index(drop=True)
+        df_arrow = df_arrow.sort_values(key).reset_index(drop=True)
+
+        # Newer pandas may infer another datetime unit, comparing the values in ns
+        for column, dtype in spec['conversions']:
+            if dtype == 'datetime':
+                df_pandas[column] = df_pandas[column].astype('datetime64[ns, UTC]')
+                df_arrow[column] = df_arrow[column].astype('datetime64[ns, UTC]')
+        # Categories may be in another order after filling NAs, comparing the values
+        pd.testing.assert_frame_equal(df_pandas, df_arrow, check_dtype=False, check_categorical=False)
+
+        # Array lookup of the states, against the dict map of notebooks/01
+        if 'customer_state' in df_arrow.columns:
+            expected = df_arrow['customer_phone_area'].map(lambda area: STATE_DDD.get(int(area)) if pd.notna(area) else None)
+            assert (df_arrow['customer_state'].astype(object).fillna('NA') == expected.astype(object).fillna('NA')).all()
+
+        print(f"{name:>12}: parity OK - pandas {time_pandas:.2f}s, arrow {time_arrow:.2f}s")